@@ -25,8 +25,9 @@ if sys.version_info < MIN_PYTHON_VERSION:
     sys.exit(1)
 # --- End of Python Version Check ---
 
-# --- Debug Mode Flag ---
+# --- Mode Flags ---
 DEBUG_MODE = "--debug" in sys.argv
+LOW_BANDWIDTH_MODE = "--low-bandwidth" in sys.argv
 
 # --- Bootstrap: Intelligent & Robust Dependency Installer ---
 import subprocess, importlib.util, os, time
@@ -53,17 +54,19 @@ def bootstrap():
     except (subprocess.CalledProcessError, KeyboardInterrupt, EOFError) as e: print(f"\n[ERROR] Installation failed: {e}", file=sys.stderr); sys.exit(1)
 
 bootstrap()
-# Remove --debug after bootstrap (bootstrap may restart the process via os.execv)
+# Remove mode flags after bootstrap (bootstrap may restart the process via os.execv)
 if "--debug" in sys.argv:
     sys.argv.remove("--debug")
+if "--low-bandwidth" in sys.argv:
+    sys.argv.remove("--low-bandwidth")
 # --- End of Bootstrap ---
 
 # --- Main Application Imports ---
-import asyncio, json, re, logging, math, operator, ast, hashlib, hmac, secrets, sqlite3, uuid, threading, traceback
-from collections import OrderedDict
+import asyncio, bisect, functools, heapq, itertools, json, re, logging, math, operator, ast, hashlib, hmac, secrets, sqlite3, uuid, threading, traceback
+from collections import Counter, OrderedDict, deque
 from pathlib import Path
 from abc import ABC, abstractmethod
-from typing import AsyncGenerator, Dict, Any, List, Optional, Tuple, Callable, Union
+from typing import AsyncGenerator, Dict, Any, List, Optional, Tuple, Callable, Iterable, Iterator, Union
 from dataclasses import dataclass, field
 if sys.version_info >= (3, 11): import tomllib
 else: import tomli as tomllib
@@ -82,40 +85,275 @@ from prompt_toolkit.styles import Style
 from prompt_toolkit.formatted_text import FormattedText, ANSI, to_formatted_text
 from prompt_toolkit.key_binding import KeyBindings
 from prompt_toolkit.layout import Layout
-from prompt_toolkit.layout.containers import HSplit, VSplit, Window, ConditionalContainer
+from prompt_toolkit.layout.containers import HSplit, VSplit, Window, ConditionalContainer, ScrollOffsets, FloatContainer, Float
 from prompt_toolkit.layout.controls import FormattedTextControl, BufferControl
 from prompt_toolkit.buffer import Buffer
 from prompt_toolkit.layout.margins import ScrollbarMargin
 from prompt_toolkit.layout.processors import BeforeInput
 from prompt_toolkit.widgets import TextArea
 from prompt_toolkit.filters import Condition
+from prompt_toolkit.data_structures import Point
+from prompt_toolkit.output import ColorDepth
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from io import StringIO
+from array import array
+try:
+    import numpy as np  # Optional: vectorizes semantic memory recall
+except ImportError:
+    np = None
+
+class ScrollbackStore:
+    """Append-only on-disk store for chat output evicted from the TUI buffer.
+
+    Each spilled page of fragments is written as one JSON line, and an
+    in-memory list of byte offsets lets any page be read back with a single
+    seek. The file is created lazily on the first spill and removed on close().
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self._path = Path(path)
+        self._file = None
+        self._offsets: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def append(self, fragments: list) -> int:
+        """Append a page of (style, text) fragments. Returns its page number."""
+        if self._file is None:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self._path, "w+b")
+        data = json.dumps([[f[0], f[1]] for f in fragments], ensure_ascii=False).encode("utf-8") + b"\n"
+        self._file.seek(0, os.SEEK_END)
+        self._offsets.append(self._file.tell())
+        self._file.write(data)
+        return len(self._offsets) - 1
+
+    def read(self, page: int) -> list:
+        """Read a page of fragments back from disk."""
+        self._file.seek(self._offsets[page])
+        return [tuple(f) for f in json.loads(self._file.readline())]
+
+    def clear(self) -> None:
+        """Drop all spilled pages."""
+        if self._file is not None:
+            self._file.seek(0)
+            self._file.truncate()
+        self._offsets.clear()
+
+    def close(self) -> None:
+        """Close and remove the scrollback file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._offsets.clear()
+        try:
+            self._path.unlink()
+        except FileNotFoundError:
+            pass
+
+class TranscriptIndex:
+    """Trigram index over the lines of the chat transcript, used by /find.
+
+    Lines are numbered from the start of the transcript and indexed as they
+    are completed. Lookups intersect the posting sets of the query's trigrams
+    and verify the remaining candidates against the stored line text, so
+    search cost tracks the number of matches rather than the transcript size.
+
+    Lines spilled to disk scrollback keep no text in memory: their trigrams
+    are folded into per-page postings, and candidate pages are read back from
+    disk to verify a match. Queries shorter than a trigram only search the
+    lines still in memory.
+    """
+
+    def __init__(self):
+        self._lines: Dict[int, str] = {}      # line number -> lowercased text
+        self._order: deque = deque()          # indexed line numbers, oldest first
+        self._postings: Dict[str, set] = {}   # trigram -> line numbers
+        self._page_postings: Dict[str, set] = {}  # trigram -> spilled page numbers
+        self._pages: int = 0                  # number of spilled pages
+        self._pending: List[str] = []         # text of the unfinished last line
+        self.next_line: int = 0               # number of the unfinished last line
+
+    def __len__(self) -> int:
+        return len(self._lines)
+
+    @staticmethod
+    def _trigrams(text: str) -> set:
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def add_text(self, text: str) -> None:
+        """Feed transcript text; every completed line is indexed."""
+        *complete, rest = text.split('\n')
+        for part in complete:
+            self._pending.append(part)
+            self._add_line(self.next_line, ''.join(self._pending).lower())
+            self._pending = []
+            self.next_line += 1
+        if rest:
+            self._pending.append(rest)
+
+    def _add_line(self, line: int, text: str) -> None:
+        if not text.strip():
+            return
+        self._lines[line] = text
+        self._order.append(line)
+        for gram in self._trigrams(text):
+            self._postings.setdefault(gram, set()).add(line)
+
+    def _pop_lines_before(self, line: int):
+        """Unindex lines numbered below `line`, yielding the trigrams of each."""
+        while self._order and self._order[0] < line:
+            old = self._order.popleft()
+            grams = self._trigrams(self._lines.pop(old))
+            for gram in grams:
+                postings = self._postings.get(gram)
+                if postings is not None:
+                    postings.discard(old)
+                    if not postings:
+                        del self._postings[gram]
+            yield grams
+
+    def remove_lines_before(self, line: int) -> None:
+        """Forget lines numbered below `line` (dropped from the transcript)."""
+        for _ in self._pop_lines_before(line):
+            pass
+
+    def spill_lines_before(self, line: int, page: int) -> None:
+        """Move lines numbered below `line` (spilled to scrollback page `page`) to page postings."""
+        for grams in self._pop_lines_before(line):
+            for gram in grams:
+                self._page_postings.setdefault(gram, set()).add(page)
+        self._pages = page + 1
+
+    def search(self, query: str,
+               read_page: Optional[Callable[[int], Dict[int, str]]] = None) -> List[int]:
+        """Return the numbers of lines containing `query` (case-insensitive), oldest first.
+
+        `read_page` maps a spilled page number to its {line number: text}; without
+        it, or for a query too short to have trigrams, spilled lines are not searched.
+        """
+        needle = query.lower()
+        if not needle:
+            return []
+        grams = self._trigrams(needle)
+        if grams:
+            postings = sorted((self._postings.get(g, set()) for g in grams), key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+        else:
+            candidates = self._lines.keys()
+        matches = sorted(n for n in candidates if needle in self._lines[n])
+        if read_page is not None and grams:
+            postings = sorted((self._page_postings.get(g, set()) for g in grams), key=len)
+            pages = set(postings[0]).intersection(*postings[1:])
+            matches[:0] = [n for page in sorted(pages)
+                           for n, text in sorted(read_page(page).items())
+                           if needle in text.lower()]
+        if needle in ''.join(self._pending).lower():
+            matches.append(self.next_line)
+        return matches
+
+    def clear(self) -> None:
+        self._lines.clear()
+        self._order.clear()
+        self._postings.clear()
+        self._page_postings.clear()
+        self._pages = 0
+        self._pending = []
+        self.next_line = 0
 
 class TUIOutputBuffer:
     """Intercepts Rich Console output and converts to prompt_toolkit FormattedText
-    for display in the TUI chat area."""
+    for display in the TUI chat area.
 
-    def __init__(self, max_history: int = 10000):
+    Only the newest `max_history` fragments are kept in memory. With a
+    ScrollbackStore attached, older fragments are spilled to disk in pages
+    and paged back in (at most `max_paged_pages` at a time) when the view is
+    scrolled past the in-memory window.
+
+    Text is also fed to a TranscriptIndex so /find can locate matches in both
+    memory and scrollback and jump the view to them.
+    """
+
+    def __init__(self, max_history: int = 10000, scrollback: Optional[ScrollbackStore] = None,
+                 max_paged_pages: int = 10):
         self._history: list = []
+        self._history_lines: int = 0
         self._max_history = max_history
         self._typing: bool = False
+        self._scrollback = scrollback
+        self._page_size = max(1, max_history // 10)
+        self._max_paged_pages = max_paged_pages
+        self._paged: deque = deque()  # (page_no, fragments, line_count) read back from scrollback
+        self._scroll_top: Optional[int] = None  # Top line of the view; None follows the bottom
+        self._index = TranscriptIndex()
+        self._first_live_line: int = 0  # Transcript line number where _history starts
+        self._history_continues: bool = False  # Whether _history starts mid-line
+        self._page_first_lines: List[int] = []  # Transcript line number where each scrollback page starts
+        self._page_continues: List[bool] = []   # Whether each scrollback page starts mid-line
+        self._search_pattern: Optional[re.Pattern] = None
+        self._highlight_cache: Optional[tuple] = None  # (key, highlighted fragments)
         self._render_console = Console(
             file=StringIO(), force_terminal=True, width=80,
             no_color=False, color_system="truecolor"
         )
 
+    def set_color_system(self, color_system: Optional[str]) -> None:
+        """Change the Rich colour system used for new output (None for mono)."""
+        self._render_console = Console(
+            file=StringIO(), force_terminal=True, width=80,
+            no_color=color_system is None, color_system=color_system
+        )
+
     def _capture(self, *args, **kwargs):
         """Render via Rich to StringIO, convert ANSI to prompt_toolkit tuples."""
         self._render_console.file = StringIO()
         self._render_console.print(*args, **kwargs)
         ansi_str = self._render_console.file.getvalue()
         if ansi_str:
-            formatted = to_formatted_text(ANSI(ansi_str))
-            self._history.extend(formatted)
-            # Evict oldest entries if over limit
-            if len(self._history) > self._max_history:
-                self._history = self._history[-self._max_history:]
+            self._append(to_formatted_text(ANSI(ansi_str)))
+
+    def _append(self, fragments):
+        """Append fragments to the in-memory window, evicting the oldest over the cap."""
+        self._history.extend(fragments)
+        self._history_lines += sum(f[1].count('\n') for f in fragments)
+        for f in fragments:
+            self._index.add_text(f[1])
+        if len(self._history) > self._max_history:
+            self._evict()
+
+    def _evict(self):
+        """Drop the oldest fragments over the cap, spilling whole pages to scrollback if attached."""
+        if self._scrollback is None:
+            overflow = len(self._history) - self._max_history
+            dropped = sum(f[1].count('\n') for f in self._history[:overflow])
+            self._history_lines -= dropped
+            self._first_live_line += dropped
+            self._index.remove_lines_before(self._first_live_line)
+            del self._history[:overflow]
+            return
+        while len(self._history) > self._max_history:
+            page = self._history[:self._page_size]
+            del self._history[:self._page_size]
+            lines = sum(f[1].count('\n') for f in page)
+            self._history_lines -= lines
+            self._page_first_lines.append(self._first_live_line)
+            self._page_continues.append(self._history_continues)
+            self._first_live_line += lines
+            self._history_continues = not next((f[1] for f in reversed(page) if f[1]), '\n').endswith('\n')
+            # Keep a scrolled-back view stable: the spilled page is still on screen.
+            keep_visible = self._scroll_top is not None and self._showing_live()
+            page_no = self._scrollback.append(page)
+            self._index.spill_lines_before(self._first_live_line, page_no)
+            if keep_visible:
+                self._paged.append((page_no, page, lines))
+                while len(self._paged) > self._max_paged_pages:
+                    self._scroll_top = max(0, self._scroll_top - self._paged.popleft()[2])
+
+    def _showing_live(self) -> bool:
+        """True if the in-memory window is part of the current view."""
+        return not self._paged or self._paged[-1][0] == len(self._scrollback) - 1
 
     def print(self, *args, **kwargs):
         """Drop-in replacement for rich.Console.print()."""
@@ -131,10 +369,26 @@ class TUIOutputBuffer:
     def clear(self):
         """Clear chat history (used by /clear command)."""
         self._history.clear()
+        self._history_lines = 0
+        self._paged.clear()
+        self._scroll_top = None
+        self._index.clear()
+        self._first_live_line = 0
+        self._page_first_lines.clear()
+        self._page_continues.clear()
+        self._history_continues = False
+        self._highlight_cache = None
+        if self._scrollback is not None:
+            self._scrollback.clear()
+
+    def close(self):
+        """Release the scrollback file."""
+        if self._scrollback is not None:
+            self._scrollback.close()
 
     def get_formatted_text(self):
-        """Return the full chat history as prompt_toolkit FormattedText."""
-        if not self._history and not self._typing:
+        """Return the visible chat history as prompt_toolkit FormattedText."""
+        if not self._history and not self._paged and not self._typing:
             return [
                 ('', '\n'),
                 ('class:typing-indicator', '  Welcome to FreeChat!\n'),
@@ -142,11 +396,160 @@ class TUIOutputBuffer:
                 ('class:typing-indicator', '  Press Enter to send, F2 for sidebar.\n'),
                 ('', '\n'),
             ]
-        result = list(self._history)
+        result = [frag for _, page, _ in self._paged for frag in page]
+        if self._showing_live():
+            result.extend(self._history)
+        if self._search_pattern is not None:
+            result = self._highlight(result)
         if self._typing:
             result.append(('class:typing-indicator', '  AI is typing...'))
         return result
 
+    def _highlight(self, fragments: list) -> list:
+        """Split fragments at search matches and add the match style (cached per view)."""
+        key = (self._search_pattern.pattern, len(fragments), self._first_live_line,
+               tuple(p for p, _, _ in self._paged))
+        if self._highlight_cache is not None and self._highlight_cache[0] == key:
+            return list(self._highlight_cache[1])
+        text = ''.join(f[1] for f in fragments)
+        spans = [m.span() for m in self._search_pattern.finditer(text)]
+        result = fragments
+        if spans:
+            result, pos, i = [], 0, 0
+            for frag in fragments:
+                style, end = frag[0], pos + len(frag[1])
+                cursor = pos
+                while i < len(spans) and spans[i][0] < end:
+                    start, stop = max(spans[i][0], cursor), min(spans[i][1], end)
+                    if start > cursor:
+                        result.append((style, text[cursor:start]))
+                    result.append((f'{style} class:search-match', text[start:stop]))
+                    cursor = stop
+                    if spans[i][1] > end:
+                        break
+                    i += 1
+                if cursor < end:
+                    result.append((style, text[cursor:end]))
+                pos = end
+        self._highlight_cache = (key, result)
+        return list(result)
+
+    def find(self, query: str) -> List[int]:
+        """Highlight `query` and return the transcript lines containing it, oldest first."""
+        self._highlight_cache = None
+        self._search_pattern = re.compile(re.escape(query), re.IGNORECASE) if query else None
+        if not query:
+            return []
+        if self._scrollback is None:
+            return self._index.search(query)
+        # Pages read during this search, so stitching lines never reads a page twice
+        return self._index.search(query, functools.partial(self._read_spilled_lines, cache={}))
+
+    def _page_text(self, page_no: int, cache: Dict[int, str]) -> str:
+        if page_no not in cache:
+            cache[page_no] = ''.join(f[1] for f in self._scrollback.read(page_no))
+        return cache[page_no]
+
+    def _read_spilled_lines(self, page_no: int, cache: Dict[int, str]) -> Dict[int, str]:
+        """Read the transcript lines completed in scrollback page `page_no` back from disk."""
+        segments = self._page_text(page_no, cache).split('\n')
+        head, page = [], page_no
+        while self._page_continues[page]:
+            # The first line started on an earlier page (possibly spanning whole pages)
+            page -= 1
+            text = self._page_text(page, cache)
+            head.append(text[text.rfind('\n') + 1:])
+            if '\n' in text:
+                break
+        segments[0] = ''.join(reversed(head)) + segments[0]
+        first = self._page_first_lines[page_no]
+        return {first + i: text for i, text in enumerate(segments[:-1])}
+
+    def clear_search(self):
+        """Remove search highlighting."""
+        self._search_pattern = None
+        self._highlight_cache = None
+
+    def jump_to_line(self, line: int, window_height: int = 0):
+        """Scroll so transcript line `line` is near the top of the view, paging scrollback in if needed."""
+        context = min(2, window_height // 4)
+        self._paged.clear()
+        if line >= self._first_live_line or not self._page_first_lines:
+            self._scroll_top = max(0, line - self._first_live_line - context)
+            return
+        page_no = max(0, bisect.bisect_right(self._page_first_lines, line) - 1)
+        page = self._scrollback.read(page_no)
+        self._paged.append((page_no, page, sum(f[1].count('\n') for f in page)))
+        top = line - self._page_first_lines[page_no]
+        if top < context and self._page_in_older():
+            top += self._paged[0][2]
+        top = max(0, top - context)
+        # Fill the window below the match, without paging the match itself back out.
+        while (top + window_height >= self.line_count and not self._showing_live()
+               and len(self._paged) < self._max_paged_pages):
+            top -= self._page_in_newer()
+        self._scroll_top = max(0, top)
+
+    @property
+    def line_count(self) -> int:
+        """Number of line breaks in the current view."""
+        lines = sum(n for _, _, n in self._paged)
+        if self._showing_live():
+            lines += self._history_lines
+        return lines
+
+    def get_cursor_position(self) -> Point:
+        """Cursor for the chat control; the chat window keeps its line at the top of the view."""
+        return Point(x=0, y=self.line_count if self._scroll_top is None else self._scroll_top)
+
+    def scroll(self, lines: int, window_height: int = 0):
+        """Scroll the view by `lines` (negative = up), paging scrollback in and out at the edges."""
+        top = self._scroll_top
+        if top is None:
+            top = max(0, self.line_count - window_height)
+        top += lines
+        while top < 0:
+            added = self._page_in_older()
+            if not added:
+                break
+            top += added
+        if lines > 0:
+            while top + window_height >= self.line_count:
+                if self._showing_live():
+                    self.scroll_to_bottom()
+                    return
+                top -= self._page_in_newer()
+        self._scroll_top = max(0, top)
+
+    def scroll_to_bottom(self):
+        """Follow the newest output again and release paged-in scrollback."""
+        self._scroll_top = None
+        self._paged.clear()
+
+    def _page_in_older(self) -> int:
+        """Load the page before the view. Returns the number of lines added at the top."""
+        if self._scrollback is None:
+            return 0
+        first = self._paged[0][0] if self._paged else len(self._scrollback)
+        if first == 0:
+            return 0
+        page = self._scrollback.read(first - 1)
+        lines = sum(f[1].count('\n') for f in page)
+        self._paged.appendleft((first - 1, page, lines))
+        while len(self._paged) > self._max_paged_pages:
+            self._paged.pop()
+        return lines
+
+    def _page_in_newer(self) -> int:
+        """Load the page after the view. Returns the number of lines dropped from the top."""
+        page_no = self._paged[-1][0] + 1
+        page = self._scrollback.read(page_no)
+        self._paged.append((page_no, page, sum(f[1].count('\n') for f in page)))
+        removed = 0
+        while len(self._paged) > self._max_paged_pages:
+            removed += self._paged.popleft()[2]
+        return removed
+
     def show_typing(self):
         """Show typing indicator."""
         self._typing = True
@@ -157,15 +560,1053 @@ class TUIOutputBuffer:
 
     def append_formatted(self, style, text):
         """Append a single styled text segment directly (for streaming)."""
-        self._history.append((style, text))
-        if len(self._history) > self._max_history:
-            self._history = self._history[-self._max_history:]
+        self._append([(style, text)])
 
     def append_raw(self, text):
         """Append raw unstyled text."""
-        self._history.append(('', text))
-        if len(self._history) > self._max_history:
-            self._history = self._history[-self._max_history:]
+        self._append([('', text)])
+
+class FramePacer:
+    """Adaptive redraw scheduler for streaming output.
+
+    Measures how long each TUI frame takes to render and how long the
+    terminal write (output flush) takes, and derives both the minimum interval
+    between redraws and the stream flush threshold from those measurements.
+    Slow links (e.g. SSH) get fewer, larger frames; fast local terminals get
+    smoother ones.
+    """
+
+    MIN_INTERVAL = 1 / 60      # Never redraw faster than ~60 fps
+    MAX_INTERVAL = 0.25        # Never drop below 4 fps while streaming
+    MIN_THRESHOLD = 32         # Chars buffered before a flush, lower bound
+    MAX_THRESHOLD = 2048       # ... and upper bound
+    FRAME_BUDGET = 0.25        # Max share of wall time spent rendering
+    SMOOTHING = 0.2            # EWMA weight of the newest sample
+
+    def __init__(self, interval: float = 0.05, threshold: int = 128):
+        self._base_interval = interval
+        self._base_threshold = threshold
+        self.interval: float = interval
+        self.threshold: int = threshold
+        self.render_time: float = 0.0  # EWMA of layout/render seconds per frame
+        self.write_time: float = 0.0   # EWMA of terminal write seconds per frame
+        self.frames: int = 0
+        self._render_start: float = 0.0
+        self._frame_write: float = 0.0
+        self._last_invalidate: float = 0.0
+
+    @property
+    def fps(self) -> float:
+        """Current target frame rate."""
+        return 1.0 / self.interval if self.interval > 0 else 0.0
+
+    def attach(self, app: Application) -> None:
+        """Hook the render cycle of a prompt_toolkit Application."""
+        app.before_render += self._before_render
+        app.after_render += self._after_render
+        output = app.output
+        original_flush = output.flush
+
+        def timed_flush():
+            start = time.perf_counter()
+            try:
+                original_flush()
+            finally:
+                self._frame_write += time.perf_counter() - start
+
+        output.flush = timed_flush
+
+    def _before_render(self, _app=None) -> None:
+        self._render_start = time.perf_counter()
+        self._frame_write = 0.0
+
+    def _after_render(self, _app=None) -> None:
+        if not self._render_start:
+            return
+        total = time.perf_counter() - self._render_start
+        self._render_start = 0.0
+        self.record_frame(max(0.0, total - self._frame_write), self._frame_write)
+
+    def record_frame(self, render_time: float, write_time: float = 0.0) -> None:
+        """Fold one frame's measurements into the averages and re-tune."""
+        if self.frames == 0:
+            self.render_time, self.write_time = render_time, write_time
+        else:
+            a = self.SMOOTHING
+            self.render_time += a * (render_time - self.render_time)
+            self.write_time += a * (write_time - self.write_time)
+        self.frames += 1
+
+        frame_cost = self.render_time + self.write_time
+        self.interval = min(self.MAX_INTERVAL, max(self.MIN_INTERVAL, frame_cost / self.FRAME_BUDGET))
+        # Buffer proportionally more text per flush when frames are spaced out,
+        # so the number of chunks per redraw stays roughly constant.
+        threshold = int(self._base_threshold * self.interval / self._base_interval)
+        self.threshold = min(self.MAX_THRESHOLD, max(self.MIN_THRESHOLD, threshold))
+
+    def should_invalidate(self, now: Optional[float] = None) -> bool:
+        """Return True (and mark the frame) if a redraw is due."""
+        now = time.monotonic() if now is None else now
+        if (now - self._last_invalidate) >= self.interval:
+            self._last_invalidate = now
+            return True
+        return False
+
+    def mark_invalidated(self, now: Optional[float] = None) -> None:
+        """Record a forced redraw so the next throttled one is spaced from it."""
+        self._last_invalidate = time.monotonic() if now is None else now
+
+class BandwidthBudget:
+    """Meters bytes written to the terminal and gates redraws to a byte budget.
+
+    A token bucket refilled at `bytes_per_second` (holding at most one second
+    of budget). Every byte the Application writes is drawn from the bucket, and
+    a throttled redraw is only allowed once the bucket can pay for a typical
+    frame, so streaming text is batched into fewer, larger frames on slow links.
+    """
+
+    SMOOTHING = 0.2  # EWMA weight for the bytes-per-frame estimate
+
+    def __init__(self, bytes_per_second: int = 4096):
+        self.bytes_per_second = max(1, bytes_per_second)
+        self.bytes_written: int = 0
+        self.frame_bytes: float = 256.0  # Estimated bytes per redraw
+        self._tokens: float = float(self.bytes_per_second)
+        self._last_refill: float = time.monotonic()
+        self._frame_start: int = 0
+        self._response_start: int = 0
+
+    def attach(self, app: Application) -> None:
+        """Count the bytes an Application writes and learn the cost of a frame."""
+        output = app.output
+        write, write_raw = output.write, output.write_raw
+
+        def metered_write(data: str) -> None:
+            self.consume(len(data.encode('utf-8', 'replace')))
+            write(data)
+
+        def metered_write_raw(data: str) -> None:
+            self.consume(len(data.encode('utf-8', 'replace')))
+            write_raw(data)
+
+        output.write = metered_write
+        output.write_raw = metered_write_raw
+        app.before_render += self._before_render
+        app.after_render += self._after_render
+
+    def _before_render(self, _app=None) -> None:
+        self._frame_start = self.bytes_written
+
+    def _after_render(self, _app=None) -> None:
+        frame = self.bytes_written - self._frame_start
+        if frame:
+            self.frame_bytes += self.SMOOTHING * (frame - self.frame_bytes)
+
+    def _refill(self, now: float) -> None:
+        elapsed = max(0.0, now - self._last_refill)
+        self._last_refill = now
+        self._tokens = min(float(self.bytes_per_second), self._tokens + elapsed * self.bytes_per_second)
+
+    def consume(self, nbytes: int, now: Optional[float] = None) -> None:
+        """Record bytes written to the terminal."""
+        self._refill(time.monotonic() if now is None else now)
+        self.bytes_written += nbytes
+        self._tokens -= nbytes
+
+    def should_invalidate(self, now: Optional[float] = None) -> bool:
+        """Return True if the budget can pay for another frame."""
+        self._refill(time.monotonic() if now is None else now)
+        return self._tokens >= min(self.frame_bytes, self.bytes_per_second)
+
+    def start_response(self) -> None:
+        """Start measuring the output of one response."""
+        self._response_start = self.bytes_written
+
+    @property
+    def response_bytes(self) -> int:
+        """Bytes written since the last start_response()."""
+        return self.bytes_written - self._response_start
+
+class RenderProfiler:
+    """Collects TUI rendering statistics for the render profiler overlay.
+
+    Fed by hooks around the chat pane's get_formatted_text, the stream buffer
+    flush and the prompt_toolkit render cycle, plus an event-loop lag probe.
+    Recording is a no-op while the overlay is disabled.
+    """
+
+    RATE_WINDOW = 1.0           # Seconds of history used for per-second rates
+    LAG_PROBE_INTERVAL = 0.1    # Seconds between event-loop lag probes
+
+    def __init__(self):
+        self.enabled: bool = False
+        self.frame_time: float = 0.0     # Seconds for the last render
+        self.format_time: float = 0.0    # Seconds for the last chat get_formatted_text
+        self.fragments: int = 0          # Fragments returned for the last chat render
+        self.loop_lag: float = 0.0       # Seconds the last lag probe woke up late
+        self._render_start: float = 0.0
+        self._invalidations: deque = deque()
+        self._stream_chunks: deque = deque()  # (timestamp, chunk count)
+
+    def attach(self, app: Application) -> None:
+        """Hook the render cycle of a prompt_toolkit Application."""
+        app.before_render += self._before_render
+        app.after_render += self._after_render
+        app.on_invalidate += self._on_invalidate
+
+    def _before_render(self, _app=None) -> None:
+        if self.enabled:
+            self._render_start = time.perf_counter()
+
+    def _after_render(self, _app=None) -> None:
+        if self.enabled and self._render_start:
+            self.frame_time = time.perf_counter() - self._render_start
+            self._render_start = 0.0
+
+    def _on_invalidate(self, _app=None) -> None:
+        if self.enabled:
+            self._invalidations.append((time.monotonic(), 1))
+
+    def record_formatted(self, fragments: int, seconds: float) -> None:
+        """Record one chat pane get_formatted_text call."""
+        if self.enabled:
+            self.fragments = fragments
+            self.format_time = seconds
+
+    def record_stream_chunks(self, count: int) -> None:
+        """Record stream chunks flushed to the chat pane."""
+        if self.enabled and count:
+            self._stream_chunks.append((time.monotonic(), count))
+
+    def _rate(self, events: deque) -> float:
+        """Events per second over the last RATE_WINDOW seconds."""
+        cutoff = time.monotonic() - self.RATE_WINDOW
+        while events and events[0][0] < cutoff:
+            events.popleft()
+        return sum(count for _, count in events) / self.RATE_WINDOW
+
+    @property
+    def invalidations_per_second(self) -> float:
+        return self._rate(self._invalidations)
+
+    @property
+    def stream_chunks_per_second(self) -> float:
+        return self._rate(self._stream_chunks)
+
+    async def monitor_loop_lag(self) -> None:
+        """Measure how late the event loop wakes up while the overlay is enabled."""
+        loop = asyncio.get_running_loop()
+        while self.enabled:
+            start = loop.time()
+            await asyncio.sleep(self.LAG_PROBE_INTERVAL)
+            self.loop_lag = max(0.0, loop.time() - start - self.LAG_PROBE_INTERVAL)
+
+    def get_overlay_text(self) -> FormattedText:
+        """Return the overlay contents."""
+        rows = [
+            ('Frame time', f'{self.frame_time * 1000:.1f} ms'),
+            ('Format time', f'{self.format_time * 1000:.1f} ms'),
+            ('Fragments', str(self.fragments)),
+            ('Invalidations', f'{self.invalidations_per_second:.1f}/s'),
+            ('Loop lag', f'{self.loop_lag * 1000:.1f} ms'),
+            ('Stream chunks', f'{self.stream_chunks_per_second:.1f}/s'),
+        ]
+        parts = [('class:profiler-title', ' Render profiler (F3)\n')]
+        for label, value in rows:
+            parts.append(('class:profiler', f' {label:<14}{value:>12}\n'))
+        return FormattedText(parts)
+
+class TokenEstimator:
+    """Pure-Python token estimator used when no tiktoken encoding is available.
+
+    The text is UTF-8 encoded and mapped to one class byte per character with a
+    single bytes.translate() call (continuation bytes are deleted, lead bytes
+    identify the script). Class totals and word/number run counts then come
+    from bytes.count(), so there is no per-character Python work and the cost
+    is a handful of C-level passes over the text.
+
+    The per-class weights are calibrated against cl100k_base and o200k_base;
+    other model families use the cl100k weights times a family scale. Error
+    versus tiktoken on texts of a few hundred characters or more (checked by
+    TestTokenEstimator whenever the BPE files are available locally):
+
+        English prose and source code    within ±20%
+        Chinese, Japanese, Korean        within ±30%
+        Other scripts (Cyrillic, Arabic, Indic, ...)   within ±40%
+
+    Mirrors the parts of the tiktoken Encoding interface FreeChat uses. encode()
+    returns a range of the estimated length, so callers can len() it exactly
+    like real token lists without materializing them.
+    """
+
+    # Character classes by UTF-8 byte: ASCII is classified per character,
+    # non-ASCII by the lead byte of its sequence.
+    _CLASSES = bytearray(b'.' * 256)
+    for _b in range(128):
+        _c = chr(_b)
+        if _c.isalpha() or _c == '_':
+            _CLASSES[_b] = ord('a')      # ASCII letters (and '_', which joins identifiers)
+        elif _c.isdigit():
+            _CLASSES[_b] = ord('0')
+        elif _c == ' ':
+            _CLASSES[_b] = ord(' ')
+        elif _c == '\n':
+            _CLASSES[_b] = ord('\n')
+        elif _c.isspace():
+            _CLASSES[_b] = ord('\t')     # Tabs, carriage returns, ...
+    for _lo, _hi, _cls in ((0xC0, 0xCF, 'x'),   # Latin-1 supplement, Latin extended, Greek
+                           (0xD0, 0xD3, 'c'),   # Cyrillic
+                           (0xD4, 0xDF, 'r'),   # Armenian, Hebrew, Arabic, Syriac, Thaana
+                           (0xE0, 0xE0, 'i'),   # Indic scripts, Thai, Lao, Tibetan
+                           (0xE1, 0xE1, 'o'),   # Myanmar, Georgian, Vietnamese, Greek extended
+                           (0xE2, 0xE2, 's'),   # General punctuation, symbols, arrows, box drawing
+                           (0xE3, 0xE3, 'k'),   # CJK punctuation, hiragana, katakana
+                           (0xE4, 0xE9, 'h'),   # CJK unified ideographs
+                           (0xEA, 0xED, 'g'),   # Hangul syllables
+                           (0xEE, 0xEF, 's'),   # Private use, fullwidth forms
+                           (0xF0, 0xFF, 'e')):  # Emoji and other supplementary planes
+        for _b in range(_lo, _hi + 1):
+            _CLASSES[_b] = ord(_cls)
+    _CLASSES = bytes(_CLASSES)
+    _CONTINUATION = bytes(range(0x80, 0xC0))
+    # Second-pass maps over class bytes: alphabetic words, and digit runs
+    _WORDS = bytes(ord('a') if b in b'axcr' else ord(' ') if b == ord(' ') else ord('.') for b in range(256))
+    _DIGITS = bytes(b if b == ord('0') else ord(' ') for b in range(256))
+    _SCRIPTS = 'xcrioskhge'  # Classes weighted per character
+    del _b, _c, _lo, _hi, _cls
+
+    # Tokens per unit, by encoding. 'word' is per alphabetic word, 'letter' per
+    # ASCII letter; the rest are per character of the class (space, newline and
+    # tab weights apply to whitespace not absorbed into a following word).
+    WEIGHTS = {
+        'cl100k_base': {
+            'word': 0.65, 'letter': 0.107, 'space': 0.15, 'newline': 0.5, 'tab': 0.5,
+            'punct': 0.55, 'x': 0.6, 'c': 0.32, 'r': 0.55, 'i': 1.0, 'o': 0.9,
+            's': 0.9, 'k': 0.85, 'h': 1.1, 'g': 1.0, 'e': 2.0,
+        },
+        'o200k_base': {
+            'word': 0.63, 'letter': 0.1, 'space': 0.15, 'newline': 0.5, 'tab': 0.5,
+            'punct': 0.55, 'x': 0.35, 'c': 0.17, 'r': 0.28, 'i': 0.4, 'o': 0.55,
+            's': 0.8, 'k': 0.6, 'h': 0.75, 'g': 0.55, 'e': 1.5,
+        },
+    }
+
+    def __init__(self, family: str, encoding: str = 'cl100k_base', scale: float = 1.0):
+        self.name = f"estimate:{family}"
+        self.scale = scale
+        self._weights = self.WEIGHTS.get(encoding, self.WEIGHTS['cl100k_base'])
+
+    def count(self, text: str) -> int:
+        """Estimated number of tokens in `text`."""
+        if not text:
+            return 0
+        classes = text.encode('utf-8', 'surrogatepass').translate(self._CLASSES, self._CONTINUATION)
+        words = classes.translate(self._WORDS)
+        digits = classes.translate(self._DIGITS)
+        attached_spaces = words.count(b' a')  # A space before a word is part of its token
+        word_count = attached_spaces + words.count(b'.a') + (words[:1] == b'a')
+        digit_count = classes.count(b'0')
+        # Digits are grouped in runs of up to three
+        number_runs = digits.count(b' 0') + (digits[:1] == b'0')
+        w = self._weights
+        tokens = (
+            w['word'] * word_count
+            + w['letter'] * classes.count(b'a')
+            + (digit_count + 2 * number_runs) / 3
+            + w['space'] * (classes.count(b' ') - attached_spaces)
+            + w['newline'] * classes.count(b'\n')
+            + w['tab'] * classes.count(b'\t')
+            + w['punct'] * classes.count(b'.')
+        )
+        if not text.isascii():
+            scripts = classes.translate(None, b'a0 \n\t.')
+            tokens += sum(w[cls] * scripts.count(cls.encode()) for cls in self._SCRIPTS)
+        return max(1, round(tokens * self.scale))
+
+    def encode(self, text: str) -> range:
+        return range(self.count(text))
+
+    def encode_batch(self, texts: List[str]) -> List[range]:
+        return [self.encode(text) for text in texts]
+
+class TokenizerResolver:
+    """Maps a `provider/model` id to the tokenizer used for budgets and cost.
+
+    OpenAI models get their tiktoken encoding (o200k_base for gpt-4o, gpt-4.1,
+    gpt-5 and the o-series; cl100k_base for gpt-4 and gpt-3.5). Other families
+    get a TokenEstimator scaled for the family, and OpenAI models whose
+    encoding fails to load get an estimator calibrated for that encoding. Encodings are loaded on a background
+    thread on first use (the estimator stands in until they are ready) and
+    cached for the life of the process.
+
+    configure() points tiktoken at pre-downloaded BPE files so loading never
+    has to touch the network.
+    """
+
+    O200K_PREFIXES = ('gpt-4o', 'chatgpt-4o', 'gpt-4.1', 'gpt-4.5', 'gpt-5', 'gpt-oss', 'o1', 'o3', 'o4')
+    CL100K_PREFIXES = ('gpt-4', 'gpt-3.5', 'text-embedding-3', 'text-embedding-ada')
+    # Approximate token counts relative to cl100k_base, by model family
+    FAMILY_SCALES = {
+        'claude': 1.15,
+        'gemini': 1.0,
+        'gemma': 1.0,
+        'llama': 0.95,
+        'mistral': 1.1,
+        'mixtral': 1.1,
+        'qwen': 1.0,
+        'deepseek': 1.0,
+    }
+
+    BPE_URLS = {
+        'cl100k_base': 'https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken',
+        'o200k_base': 'https://openaipublic.blob.core.windows.net/encodings/o200k_base.tiktoken',
+    }
+
+    _encodings: Dict[str, Any] = {}  # Loaded encodings (None = failed), shared per process
+    _loading: Dict[str, threading.Event] = {}  # Encodings being loaded in the background
+    _lock = threading.Lock()
+    offline: bool = False  # Never download BPE files
+
+    def __init__(self):
+        self._resolved: Dict[str, Any] = {}
+        self._fallbacks: Dict[str, TokenEstimator] = {}
+
+    @staticmethod
+    def cache_dir() -> Path:
+        """Directory tiktoken reads cached BPE files from."""
+        import tempfile
+        configured = os.environ.get("TIKTOKEN_CACHE_DIR") or os.environ.get("DATA_GYM_CACHE_DIR")
+        return Path(configured) if configured else Path(tempfile.gettempdir()) / "data-gym-cache"
+
+    @classmethod
+    def cached_bpe_path(cls, name: str) -> Path:
+        """Path tiktoken looks for when loading an encoding (named by the SHA-1 of its URL)."""
+        return cls.cache_dir() / hashlib.sha1(cls.BPE_URLS[name].encode()).hexdigest()
+
+    @classmethod
+    def configure(cls, bpe_dirs: Iterable[Path] = (), cache_dir: Optional[Path] = None,
+                  offline: bool = False) -> None:
+        """Set up local BPE files for tiktoken.
+
+        `<encoding>.tiktoken` files found in `bpe_dirs` are copied into the
+        tiktoken cache under the name tiktoken expects, so they load without a
+        download (tiktoken still verifies their hash). `cache_dir` is used as
+        the cache unless TIKTOKEN_CACHE_DIR is already set. With `offline`, an
+        encoding that is not available locally is never downloaded.
+        """
+        import shutil
+        cls.offline = offline
+        if cache_dir is not None and not os.environ.get("TIKTOKEN_CACHE_DIR"):
+            os.environ["TIKTOKEN_CACHE_DIR"] = str(cache_dir)
+        for directory in bpe_dirs:
+            for name in cls.BPE_URLS:
+                source = Path(directory) / f"{name}.tiktoken"
+                target = cls.cached_bpe_path(name)
+                if source.is_file() and not target.exists():
+                    try:
+                        target.parent.mkdir(parents=True, exist_ok=True)
+                        shutil.copyfile(source, target)
+                    except OSError as e:
+                        logging.getLogger('FreeChat').warning(f"Failed to install BPE file '{source}': {e}")
+
+    @classmethod
+    def encoding_name(cls, model_id: str) -> Optional[str]:
+        """tiktoken encoding for a model id, or None if it is not an OpenAI model."""
+        model = model_id.lower().rsplit('/', 1)[-1].split(':', 1)[0]
+        if model.startswith(cls.O200K_PREFIXES):
+            return 'o200k_base'
+        if model.startswith(cls.CL100K_PREFIXES):
+            return 'cl100k_base'
+        return None
+
+    @classmethod
+    def estimator_for(cls, model_id: str) -> TokenEstimator:
+        name = cls.encoding_name(model_id)
+        if name:
+            return TokenEstimator(name, name)
+        model = model_id.lower()
+        for family, scale in cls.FAMILY_SCALES.items():
+            if family in model:
+                return TokenEstimator(family, scale=scale)
+        return TokenEstimator('default')
+
+    @classmethod
+    def load_encoding(cls, name: str):
+        """Load a tiktoken encoding once per process (blocking); returns None if it cannot be loaded."""
+        with cls._lock:
+            if name in cls._encodings:
+                return cls._encodings[name]
+        if cls.offline and name in cls.BPE_URLS and not cls.cached_bpe_path(name).exists():
+            logging.getLogger('FreeChat').info(f"tiktoken encoding '{name}' is not available offline")
+            encoding = None
+        else:
+            try:
+                encoding = tiktoken.get_encoding(name)
+            except Exception as e:
+                logging.getLogger('FreeChat').warning(f"Failed to load tiktoken encoding '{name}': {e}")
+                encoding = None
+        with cls._lock:
+            return cls._encodings.setdefault(name, encoding)
+
+    @classmethod
+    def preload(cls, name: str) -> None:
+        """Start loading an encoding on a daemon thread unless it is loaded or loading."""
+        with cls._lock:
+            if name in cls._encodings or name in cls._loading:
+                return
+            ready = cls._loading[name] = threading.Event()
+
+        def load():
+            try:
+                cls.load_encoding(name)
+            finally:
+                with cls._lock:
+                    cls._loading.pop(name, None)
+                ready.set()
+
+        threading.Thread(target=load, name=f"tiktoken-{name}", daemon=True).start()
+
+    @classmethod
+    def wait(cls, name: str, timeout: Optional[float] = None) -> bool:
+        """Wait for a background load; True if the encoding finished loading (or failing)."""
+        with cls._lock:
+            ready = cls._loading.get(name)
+        if ready is not None:
+            ready.wait(timeout)
+        return name in cls._encodings
+
+    def preload_for(self, model_id: str) -> None:
+        """Start loading the encoding a model needs, if any."""
+        name = self.encoding_name(model_id)
+        if name:
+            self.preload(name)
+
+    def resolve(self, model_id: str):
+        """Tokenizer for a model id (a tiktoken Encoding or a TokenEstimator).
+
+        Never blocks: while the model's encoding is still loading, its
+        estimator is returned and resolution is retried on the next call.
+        """
+        tokenizer = self._resolved.get(model_id)
+        if tokenizer is not None:
+            return tokenizer
+        name = self.encoding_name(model_id)
+        if name is not None and name not in self._encodings:
+            self.preload(name)
+            if model_id not in self._fallbacks:
+                self._fallbacks[model_id] = self.estimator_for(model_id)
+            return self._fallbacks[model_id]
+        tokenizer = (self._encodings[name] if name else None) or self.estimator_for(model_id)
+        self._resolved[model_id] = tokenizer
+        return tokenizer
+
+class TokenCache:
+    """LRU cache of token counts keyed by a digest of the text and the encoding name.
+
+    Keys are fixed-size BLAKE2b digests, so cached texts are never held in
+    memory and each lookup hashes the text once. Capacity is accounted as a
+    fixed number of bytes per entry.
+    """
+
+    DIGEST_SIZE = 16
+    ENTRY_BYTES = 128  # Digest, key tuple, count and OrderedDict node (approx.)
+
+    def __init__(self, max_bytes: int = 512 * 1024):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[Tuple[bytes, str], int] = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def bytes(self) -> int:
+        return len(self._entries) * self.ENTRY_BYTES
+
+    @classmethod
+    def key(cls, text: str, encoding: str) -> Tuple[bytes, str]:
+        digest = hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=cls.DIGEST_SIZE).digest()
+        return digest, encoding
+
+    def get(self, key: Tuple[bytes, str]) -> Optional[int]:
+        """Return the cached count for a key, or None (counted as a miss)."""
+        count = self._entries.get(key)
+        if count is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return count
+
+    def put(self, key: Tuple[bytes, str], count: int) -> None:
+        self._entries[key] = count
+        self._entries.move_to_end(key)
+        while self.bytes > self.max_bytes:
+            self._entries.popitem(last=False)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+        }
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.hits = self.misses = 0
+
+class ChatMessage(dict):
+    """A chat message dict that also carries its token count.
+
+    The count is an attribute rather than a key, so the message still
+    serializes as a plain {"role", "content"} dict in API payloads and
+    session files.
+    """
+
+    __slots__ = ('tokens',)
+
+    def __init__(self, *args, tokens: int = 0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tokens = tokens
+
+class MessageHistory(list):
+    """Session message list with a running token total.
+
+    Every message is counted once as it enters the list (a loaded session in
+    one batch) and keeps its count as ChatMessage.tokens. `tokens` is the total
+    over the non-system messages, so trimming to a budget only touches the
+    messages it drops.
+    """
+
+    def __init__(self, messages: Iterable[Dict[str, Any]] = (),
+                 count_batch: Optional[Callable[[List[str]], List[int]]] = None,
+                 encoding: Optional[str] = None):
+        self._count_batch = count_batch or (lambda texts: [0] * len(texts))
+        self.encoding = encoding  # Name of the tokenizer the counts came from
+        super().__init__(self._wrap(list(messages)))
+        self.tokens: int = self._sum(self)
+
+    @staticmethod
+    def _text(message: Dict[str, Any]) -> str:
+        content = message.get('content') or ''
+        return content if isinstance(content, str) else str(content)
+
+    @staticmethod
+    def _sum(messages) -> int:
+        return sum(m.tokens for m in messages if m.get('role') != 'system')
+
+    def _wrap(self, messages: list) -> list:
+        """Convert plain dicts to ChatMessages, counting them in one batch."""
+        pending = [i for i, m in enumerate(messages) if not isinstance(m, ChatMessage)]
+        if pending:
+            counts = self._count_batch([self._text(messages[i]) for i in pending])
+            for i, count in zip(pending, counts):
+                messages[i] = ChatMessage(messages[i], tokens=count)
+        return messages
+
+    def append(self, message: Dict[str, Any]) -> None:
+        message = self._wrap([message])[0]
+        super().append(message)
+        self.tokens += self._sum([message])
+
+    def extend(self, messages: Iterable[Dict[str, Any]]) -> None:
+        messages = self._wrap(list(messages))
+        super().extend(messages)
+        self.tokens += self._sum(messages)
+
+    def __iadd__(self, messages):
+        self.extend(messages)
+        return self
+
+    def insert(self, index: int, message: Dict[str, Any]) -> None:
+        message = self._wrap([message])[0]
+        super().insert(index, message)
+        self.tokens += self._sum([message])
+
+    def pop(self, index: int = -1) -> ChatMessage:
+        message = super().pop(index)
+        self.tokens -= self._sum([message])
+        return message
+
+    def remove(self, message: Dict[str, Any]) -> None:
+        removed = self[self.index(message)]
+        super().remove(message)
+        self.tokens -= self._sum([removed])
+
+    def __delitem__(self, index) -> None:
+        removed = self[index] if isinstance(index, slice) else [self[index]]
+        super().__delitem__(index)
+        self.tokens -= self._sum(removed)
+
+    def __setitem__(self, index, value) -> None:
+        removed = self[index] if isinstance(index, slice) else [self[index]]
+        added = self._wrap(list(value) if isinstance(index, slice) else [value])
+        super().__setitem__(index, added if isinstance(index, slice) else added[0])
+        self.tokens += self._sum(added) - self._sum(removed)
+
+    def clear(self) -> None:
+        super().clear()
+        self.tokens = 0
+
+    def recount(self, encoding: Optional[str] = None) -> None:
+        """Recount every message in one batch (e.g. after switching tokenizer)."""
+        counts = self._count_batch([self._text(m) for m in self])
+        for message, count in zip(self, counts):
+            message.tokens = count
+        self.tokens = self._sum(self)
+        self.encoding = encoding
+
+    def trim(self, max_messages: int, max_tokens: int) -> int:
+        """Drop the oldest messages after the leading system messages until both
+        limits hold. Returns the number of messages dropped."""
+        return len(self.evict(max_messages, max_tokens))
+
+    def evict(self, max_messages: int, max_tokens: int) -> List[ChatMessage]:
+        """Like trim(), but return the dropped messages (oldest first)."""
+        start = 0
+        while start < len(self) and self[start].get('role') == 'system':
+            start += 1
+        end = start + max(0, len(self) - max_messages)
+        tokens = self.tokens - self._sum(self[start:end])
+        while end < len(self) and tokens > max_tokens:
+            tokens -= self._sum([self[end]])
+            end += 1
+        evicted = self[start:end]
+        if evicted:
+            super().__delitem__(slice(start, end))
+        self.tokens = tokens
+        return evicted
+
+@dataclass
+class ContextBudget:
+    """How a model's context window is split for one request (in tokens).
+
+    `history` is what the conversation may use after reserving room for the
+    completion, the memory and file context, tool schemas and the system
+    messages.
+    `context_length` is None when the model's window is unknown.
+    """
+    history: int
+    context_length: Optional[int] = None
+    completion: int = 0
+    memory: int = 0
+    tools: int = 0
+    system: int = 0
+    files: int = 0
+    source: str = "default"  # "default", "provider" or "config"
+
+class HistorySummarizer:
+    """Rolling summary of the turns evicted from the session history.
+
+    Evicted turns are queued and folded into one system message kept after the
+    system prompt, within its own token budget. Folding runs in the background:
+    a cheap model rewrites the summary when one is configured, otherwise (or if
+    the call fails) an extractive digest keeps the first sentence of each turn.
+    """
+
+    MARKER = "[Summary of earlier conversation]"
+    PROMPT = ("Update the running summary of a conversation with the new turns below. "
+              "Keep facts, decisions, names and open questions; drop pleasantries. "
+              "Reply with the updated summary only, at most {words} words.")
+    SENTENCE_END = re.compile(r'(?<=[.!?。！？])\s+|(?<=[。！？])')
+
+    def __init__(self, max_tokens: int = 500, model: Optional[str] = None,
+                 count: Optional[Callable[[str], int]] = None):
+        self.max_tokens = max_tokens
+        self.model = model or None  # "provider/model"; None means extractive only
+        self._count = count or (lambda text: len(text) // 4)
+        self.summary: str = ""
+        self.pending: List[Dict[str, Any]] = []
+        self.task: Optional[asyncio.Task] = None
+        self._generation = 0  # Bumped by load(); folds of an older session are discarded
+
+    @classmethod
+    def is_summary(cls, message: Dict[str, Any]) -> bool:
+        content = message.get('content')
+        return message.get('role') == 'system' and isinstance(content, str) and content.startswith(cls.MARKER)
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def load(self, messages: Iterable[Dict[str, Any]]) -> None:
+        """Reset to the summary carried by a (new or loaded) session, if any.
+
+        A fold still running for the previous session is cancelled, and its
+        result discarded if it completes anyway, so it cannot write its summary
+        over the new one.
+        """
+        if self.running:
+            self.task.cancel()
+        self.task = None
+        self._generation += 1
+        self.summary = next((m['content'][len(self.MARKER):].strip() for m in messages
+                             if self.is_summary(m)), "")
+        self.pending = []
+
+    def add(self, messages: Iterable[Dict[str, Any]]) -> None:
+        self.pending.extend(m for m in messages if m.get('role') in ('user', 'assistant'))
+
+    def message(self) -> Dict[str, str]:
+        return {"role": "system", "content": f"{self.MARKER}\n{self.summary}"}
+
+    def _first_sentence(self, text: str, limit: int = 200) -> str:
+        text = " ".join(text.split())
+        sentence = self.SENTENCE_END.split(text, maxsplit=1)[0]
+        return sentence if len(sentence) <= limit else sentence[:limit - 3].rstrip() + "..."
+
+    def fit(self, text: str) -> str:
+        """Drop the oldest lines, then truncate, until text fits the budget."""
+        lines = text.strip().splitlines()
+        while len(lines) > 1 and self._count("\n".join(lines)) > self.max_tokens:
+            lines.pop(0)
+        text = "\n".join(lines)
+        while text and self._count(text) > self.max_tokens:
+            text = text[:len(text) * 3 // 4]
+        return text
+
+    def fold_extractive(self, messages: List[Dict[str, Any]]) -> str:
+        """Append a one-line digest per turn to the summary."""
+        lines = [self.summary] if self.summary else []
+        for message in messages:
+            if sentence := self._first_sentence(MessageHistory._text(message)):
+                lines.append(f"- {message['role']}: {sentence}")
+        self.summary = self.fit("\n".join(lines))
+        return self.summary
+
+    async def _fold_with_model(self, provider, model_name: str, messages: List[Dict[str, Any]]) -> str:
+        transcript = "\n\n".join(f"{m['role']}: {MessageHistory._text(m)}" for m in messages)
+        request = [
+            {"role": "system", "content": self.PROMPT.format(words=self.max_tokens * 3 // 4)},
+            {"role": "user", "content": f"Current summary:\n{self.summary or '(none)'}\n\nNew turns:\n{transcript}"},
+        ]
+        return "".join([chunk async for chunk in provider.stream_chat(request, model_name)]).strip()
+
+    async def fold(self, provider=None, model_name: Optional[str] = None, timeout: float = 60.0) -> str:
+        """Fold every pending turn into the summary (turns evicted meanwhile included)."""
+        generation = self._generation
+        while self.pending:
+            batch, self.pending = self.pending, []
+            text = ""
+            if provider is not None:
+                try:
+                    text = await asyncio.wait_for(self._fold_with_model(provider, model_name, batch), timeout)
+                except Exception as e:
+                    logging.getLogger('FreeChat').warning(f"History summary model failed, using extractive summary: {e}")
+                if generation != self._generation:
+                    break  # The session was replaced while the model was summarizing
+            if text:
+                self.summary = self.fit(text)
+            else:
+                self.fold_extractive(batch)
+        return self.summary
+
+@dataclass
+class DocumentChunk:
+    """A piece of an attached file, the unit of retrieval."""
+    document: str
+    index: int
+    text: str
+    tokens: int = 0
+
+class DocumentIndex:
+    """In-memory BM25 index over chunks of the files attached with /file upload.
+
+    Files are split on line boundaries into chunks of about CHUNK_CHARS and
+    each chunk's terms go into an inverted index (term -> {chunk id: tf}), so a
+    query only scores the chunks sharing a term with it. CJK text is indexed
+    per character, everything else per word.
+    """
+
+    CHUNK_CHARS = 1200
+    K1, B = 1.2, 0.75
+    TERM = re.compile(r'[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]|[^\W\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]+')
+
+    def __init__(self):
+        self.documents: Dict[str, List[int]] = {}        # name -> chunk ids, in file order
+        self._chunks: Dict[int, DocumentChunk] = {}
+        self._terms: Dict[int, Counter] = {}             # chunk id -> term frequencies
+        self._lengths: Dict[int, int] = {}               # chunk id -> number of terms
+        self._postings: Dict[str, Dict[int, int]] = {}   # term -> {chunk id: tf}
+        self._total_length = 0
+        self._next_id = 0
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    @classmethod
+    def terms(cls, text: str) -> List[str]:
+        return cls.TERM.findall(text.lower())
+
+    @classmethod
+    def split(cls, text: str) -> List[str]:
+        """Split text into chunks of about CHUNK_CHARS, preferring line breaks."""
+        chunks, current, size = [], [], 0
+        for line in text.splitlines(keepends=True):
+            while len(line) > cls.CHUNK_CHARS:  # Very long lines are cut hard
+                if current:
+                    chunks.append(''.join(current))
+                    current, size = [], 0
+                chunks.append(line[:cls.CHUNK_CHARS])
+                line = line[cls.CHUNK_CHARS:]
+            if size + len(line) > cls.CHUNK_CHARS and current:
+                chunks.append(''.join(current))
+                current, size = [], 0
+            current.append(line)
+            size += len(line)
+        if current:
+            chunks.append(''.join(current))
+        return [chunk for chunk in chunks if chunk.strip()]
+
+    def add(self, name: str, text: str, count_batch: Optional[Callable[[List[str]], List[int]]] = None) -> int:
+        """Index a document (replacing one with the same name); returns its chunk count."""
+        self.drop(name)
+        texts = self.split(text)
+        counts = count_batch(texts) if count_batch else [len(t) // 4 for t in texts]
+        ids = []
+        for index, (chunk_text, tokens) in enumerate(zip(texts, counts)):
+            chunk_id, self._next_id = self._next_id, self._next_id + 1
+            terms = Counter(self.terms(chunk_text))
+            self._chunks[chunk_id] = DocumentChunk(name, index, chunk_text, tokens)
+            self._terms[chunk_id] = terms
+            self._lengths[chunk_id] = sum(terms.values())
+            self._total_length += self._lengths[chunk_id]
+            for term, tf in terms.items():
+                self._postings.setdefault(term, {})[chunk_id] = tf
+            ids.append(chunk_id)
+        self.documents[name] = ids
+        return len(ids)
+
+    def drop(self, name: str) -> bool:
+        ids = self.documents.pop(name, None)
+        if ids is None:
+            return False
+        for chunk_id in ids:
+            del self._chunks[chunk_id]
+            terms = self._terms.pop(chunk_id)
+            self._total_length -= self._lengths.pop(chunk_id)
+            for term in terms:
+                postings = self._postings[term]
+                del postings[chunk_id]
+                if not postings:
+                    del self._postings[term]
+        return True
+
+    def clear(self) -> None:
+        self.__init__()
+
+    def chunks(self, name: str) -> List[DocumentChunk]:
+        return [self._chunks[i] for i in self.documents.get(name, [])]
+
+    def search(self, query: str, limit: int = 5) -> List[Tuple[float, DocumentChunk]]:
+        """Return up to `limit` (score, chunk) pairs ranked by BM25."""
+        if not self._chunks:
+            return []
+        n = len(self._chunks)
+        avg_length = self._total_length / n or 1
+        scores: Dict[int, float] = {}
+        for term in set(self.terms(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for chunk_id, tf in postings.items():
+                norm = tf + self.K1 * (1 - self.B + self.B * self._lengths[chunk_id] / avg_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (self.K1 + 1) / norm
+        best = heapq.nlargest(limit, scores.items(), key=operator.itemgetter(1))
+        return [(score, self._chunks[chunk_id]) for chunk_id, score in best]
+
+class SpeculativeRecall:
+    """Debounced memory recall for the draft being typed, reused on submit.
+
+    Every edit restarts a short timer; once typing pauses, the draft is
+    recalled in the background. On submit, take() hands back that result when
+    the draft's terms are close enough to the prompt's (Jaccard similarity),
+    waiting for a recall already in flight rather than starting another.
+    """
+
+    def __init__(self, recall: Callable[[str], Any], delay: float = 0.3, min_chars: int = 8,
+                 threshold: float = 0.8, max_age: float = 30.0):
+        self._recall = recall  # async: draft text -> memories
+        self.delay = delay
+        self.min_chars = min_chars
+        self.threshold = threshold
+        self.max_age = max_age
+        self.query: str = ""
+        self._task: Optional[asyncio.Task] = None
+        self._recall_started = False
+        self.hits = self.misses = 0
+        self.saved: float = 0.0  # Total seconds of recall latency taken off submits
+
+    @staticmethod
+    def similarity(a: str, b: str) -> float:
+        terms_a, terms_b = set(DocumentIndex.terms(a)), set(DocumentIndex.terms(b))
+        if not terms_a or not terms_b:
+            return float(a.strip() == b.strip())
+        return len(terms_a & terms_b) / len(terms_a | terms_b)
+
+    def schedule(self, text: str) -> None:
+        """Restart the debounce timer for the current draft.
+
+        An empty draft is ignored: submitting clears the input before the
+        prompt is handled, and the recall made for it must survive until take().
+        """
+        text = text.strip()
+        if not text or (text == self.query and self._task is not None):
+            return
+        self.cancel()
+        if len(text) < self.min_chars or text.startswith('/'):
+            return
+        self.query = text
+        self._task = asyncio.get_running_loop().create_task(self._run(text))
+
+    def cancel(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        self._task, self.query, self._recall_started = None, "", False
+
+    async def _run(self, text: str) -> Tuple[Any, float, float]:
+        await asyncio.sleep(self.delay)
+        self._recall_started = True
+        start = time.perf_counter()
+        result = await self._recall(text)
+        return result, time.perf_counter() - start, time.monotonic()
+
+    async def take(self, prompt: str) -> Tuple[Optional[Any], float]:
+        """Return (memories, seconds saved) for a matching speculative recall, else (None, 0)."""
+        task, query, started = self._task, self.query, self._recall_started
+        self._task, self.query, self._recall_started = None, "", False
+        if task is None:
+            return None, 0.0
+        if (task.cancelled() or (not task.done() and not started)
+                or self.similarity(query, prompt) < self.threshold):
+            task.cancel()  # Still debouncing, or the draft drifted from what was sent
+            self.misses += 1
+            return None, 0.0
+        wait_start = time.perf_counter()
+        try:
+            result, elapsed, finished = await task
+        except Exception as e:
+            logging.getLogger('FreeChat').debug(f"Speculative recall unusable: {e}")
+            self.misses += 1
+            return None, 0.0
+        waited = time.perf_counter() - wait_start
+        if time.monotonic() - finished > self.max_age:
+            self.misses += 1
+            return None, 0.0
+        saved = max(0.0, elapsed - waited)
+        self.hits += 1
+        self.saved += saved
+        return result, saved
 
 class FreeChatApp:
     # Log level mapping as class constant
@@ -183,7 +1624,7 @@ class FreeChatApp:
         self.console = Console()
         self._tui_active: bool = False
         self._sidebar_visible: bool = False
-        self._tui_buffer = TUIOutputBuffer()
+        self._tui_buffer: Optional[TUIOutputBuffer] = None
         self._tui_app: Optional[Application] = None
         self.debug: bool = DEBUG_MODE
         self._loading: bool = False
@@ -202,6 +1643,10 @@ class FreeChatApp:
         self.prompts_path = self.config_dir / "prompts.toml"
         self.history_path = self.config_dir / "history.txt"
         self.sessions_dir = self.config_dir / "sessions"
+        # Chat output evicted from memory is spilled here (one file per process)
+        self._tui_buffer = TUIOutputBuffer(
+            scrollback=ScrollbackStore(self.config_dir / "scrollback" / f"scrollback-{os.getpid()}.jsonl")
+        )
 
         self._setup_config()
         self.config = self._load_config(self.config_path)
@@ -210,20 +1655,60 @@ class FreeChatApp:
         if not self.debug:
             self.debug = self.config.get("general", {}).get("debug", False)
 
+        # Low-bandwidth mode for slow SSH links: reduced palette, no scrollbar,
+        # redraws batched to a terminal bytes-per-second budget.
+        self.low_bandwidth: bool = LOW_BANDWIDTH_MODE or self.config.get("general", {}).get("low_bandwidth", False)
+        self.low_bandwidth_palette: str = self.config.get("general", {}).get("low_bandwidth_palette", "16")
+        self._bandwidth = BandwidthBudget(self.config.get("general", {}).get("low_bandwidth_bytes_per_second", 4096))
+        if self.low_bandwidth:
+            self._tui_buffer.set_color_system(None if self.low_bandwidth_palette == "mono" else "standard")
+
         self.default_prompt_name = self.config.get("general", {}).get("default_prompt", "default")
         self.active_prompt_name: str = ""
         self.active_prompt_content: str = ""
         
         # [V2.2.1] Default model set to the API-compatible ID.
         self.current_model: str = self.config.get("general", {}).get("default_model", "openrouter/free")
+        # Tokenizers: locally shipped BPE files and a persistent cache keep startup off the network
+        bpe_dirs = [Path(__file__).resolve().parent / "tiktoken", self.config_dir / "tiktoken"]
+        if self.config.get("general", {}).get("tiktoken_bpe_dir"):
+            bpe_dirs.append(Path(self.config["general"]["tiktoken_bpe_dir"]).expanduser())
+        TokenizerResolver.configure(bpe_dirs, self.config_dir / "tiktoken_cache",
+                                    offline=self.config.get("general", {}).get("tiktoken_offline", False))
+        self._tokenizer_resolver = TokenizerResolver()
+        self._tokenizer_resolver.preload_for(self.current_model)
+        # Optional compaction: turns evicted from the history are folded into a rolling summary
+        self.history_summary: bool = self.config.get("general", {}).get("history_summary", False)
+        self._history_summarizer = HistorySummarizer(
+            self.config.get("general", {}).get("history_summary_tokens", 500),
+            self.config.get("general", {}).get("history_summary_model"),
+            count=self._count_tokens)
         self.session_messages: List[Dict[str, Any]] = []
         self.MAX_HISTORY_MESSAGES: int = 100  # Hard limit on message count
-        self.MAX_HISTORY_TOKENS: int = 4000  # Token budget for history
+        self.MAX_HISTORY_TOKENS: int = 4000  # History budget when the model's context length is unknown
+        self.MIN_HISTORY_TOKENS: int = 512  # Floor for small context windows
+        self.MAX_COMPLETION_RESERVE: int = 4096  # Reply reserve, at most a quarter of the window
+        self._memory_reserve: int = 256  # Grows to the largest memory context injected so far
+        # Attached files are chunked and indexed; each prompt gets its most relevant chunks
+        self.documents = DocumentIndex()
+        # Memory recall runs while the prompt is typed; submit reuses it when the text still matches
+        self.speculative_recall: bool = self.config.get("general", {}).get("speculative_recall", True)
+        self._speculative_recall = SpeculativeRecall(
+            lambda text: self.memory_manager.run(self._recall_memories, text),
+            delay=self.config.get("general", {}).get("speculative_recall_delay", 0.3))
+        self.file_context_tokens: int = self.config.get("general", {}).get("file_context_tokens", 1500)
+        self.file_context_chunks: int = self.config.get("general", {}).get("file_context_chunks", 5)
         self.MAX_TOKEN_CACHE_BYTES: int = 512 * 1024  # 512 KB max cache memory
         self._stream_buffer: List[str] = []
-        self._STREAM_BUFFER_THRESHOLD: int = 128
-        self._last_stream_invalidate: float = 0.0
-        self._STREAM_INVALIDATE_INTERVAL: float = 0.05  # 50ms minimum between TUI redraws during streaming
+        self._STREAM_BUFFER_THRESHOLD: int = 128  # Initial flush threshold, adapted by the frame pacer
+        self._STREAM_INVALIDATE_INTERVAL: float = 0.05  # Initial 50ms between TUI redraws, adapted by the frame pacer
+        self._frame_pacer = FramePacer(self._STREAM_INVALIDATE_INTERVAL, self._STREAM_BUFFER_THRESHOLD)
+        self._render_profiler = RenderProfiler()
+        self._lag_probe_task: Optional[asyncio.Task] = None  # RenderProfiler.monitor_loop_lag while shown
+        self._find_query: str = ""
+        self._find_matches: List[int] = []  # Transcript lines matching the query, oldest first
+        self._find_pos: int = -1
+        self._keep_chat_view: bool = False  # Set when a command positioned the chat view itself (/find)
         self.session_cost: float = 0.0
         self.session_name: Optional[str] = None
         self.available_models: Dict[str, List[str]] = {}
@@ -232,13 +1717,8 @@ class FreeChatApp:
         self.provider_factory = ProviderFactory(self.config)
         self.recent_models: List[str] = self.config.get("general", {}).get("recent_models", [])
         self.favorite_models: List[str] = self.config.get("general", {}).get("favorite_models", [])
-        try: 
-            self.tokenizer = tiktoken.get_encoding("cl100k_base")
-        except Exception as e:
-            self.tokenizer = None
-            self.output.print(f"[yellow]Warning:[/] `tiktoken` not found or failed to load: {e}. Token counts will be approximate.")
-        self._token_cache: OrderedDict[str, int] = OrderedDict()  # LRU cache
-        self._token_cache_bytes: int = 0
+        # Shared by every token-counting call site
+        self._token_cache = TokenCache(self.MAX_TOKEN_CACHE_BYTES)
         self.commands: Dict[str, Callable] = {
             "/help": self._display_help, "/model": self._handle_model_command,
             "/prompt": self._handle_prompt_command,
@@ -247,6 +1727,7 @@ class FreeChatApp:
             "/language": self._handle_language_command,
             "/skill": self._handle_skill_command,
             "/debug": self._toggle_debug,
+            "/find": self._handle_find_command,
             "/memory": self._handle_memory_command,
             "/clear": lambda args: self.output.clear(), "/exit": self._exit_app,
         }
@@ -321,11 +1802,31 @@ class FreeChatApp:
 
         # Initialize memory manager with detected branch
         memory_db_path = self.memory_dir / "memories.db"
-        self.memory_manager = MemoryManager(memory_db_path, current_branch)
+        self.memory_manager = MemoryManager(
+            memory_db_path, current_branch,
+            semantic=self.config.get("general", {}).get("semantic_recall", False),
+            dedupe=self.config.get("general", {}).get("dedupe_memories", False))
         self.branch_memory_manager = BranchMemoryManager(self.memory_manager)
 
         self._apply_prompt(self.default_prompt_name, is_startup=True)
 
+    @property
+    def session_messages(self) -> MessageHistory:
+        """Current conversation; plain lists assigned here are counted in one batch."""
+        return self._session_messages
+
+    @session_messages.setter
+    def session_messages(self, messages: List[Dict[str, Any]]):
+        if not isinstance(messages, MessageHistory):
+            messages = MessageHistory(messages, self._count_tokens_batch, self.tokenizer.name)
+        self._session_messages = messages
+        self._history_summarizer.load(messages)
+
+    @property
+    def tokenizer(self):
+        """Tokenizer for the current model, resolved (and loaded) on first use."""
+        return self._tokenizer_resolver.resolve(self.current_model)
+
     @property
     def output(self):
         """Return the active output sink (TUI buffer or raw Console)."""
@@ -637,41 +2138,47 @@ prompt = """You are a multilingual translator. Your task is to translate the use
         return FormattedText([("class:bottom-toolbar", text)])
 
     def _count_tokens(self, text: str) -> int:
-        """Count tokens with caching to avoid repeated calculations."""
-        if not self.tokenizer:
-            return 0
-        cached = self._token_cache.get(text)
-        if cached is not None:
-            self._token_cache.move_to_end(text)
-            return cached[0]
-        count = len(self.tokenizer.encode(text))
-        text_size = len(text.encode('utf-8'))
-        # Skip caching for oversized texts to prevent memory spikes
-        if text_size <= self.MAX_TOKEN_CACHE_BYTES:
-            self._token_cache[text] = (count, text_size)
-            self._token_cache_bytes += text_size
-            # Evict by both entry count and total byte size
-            while (len(self._token_cache) > 1000 or
-                   self._token_cache_bytes > self.MAX_TOKEN_CACHE_BYTES):
-                _, (_, removed_size) = self._token_cache.popitem(last=False)
-                self._token_cache_bytes -= removed_size
+        """Count tokens for the current model, with caching to avoid repeated calculations."""
+        tokenizer = self.tokenizer
+        key = TokenCache.key(text, tokenizer.name)
+        count = self._token_cache.get(key)
+        if count is None:
+            count = len(tokenizer.encode(text))
+            self._token_cache.put(key, count)
         return count
+
+    def _count_tokens_batch(self, texts: List[str]) -> List[int]:
+        """Count tokens for many texts at once (e.g. a loaded session)."""
+        tokenizer = self.tokenizer
+        keys = [TokenCache.key(text, tokenizer.name) for text in texts]
+        counts = [self._token_cache.get(key) for key in keys]
+        missing = [i for i, count in enumerate(counts) if count is None]
+        if missing:
+            encoded = tokenizer.encode_batch([texts[i] for i in missing])
+            for i, tokens in zip(missing, encoded):
+                counts[i] = len(tokens)
+                self._token_cache.put(keys[i], counts[i])
+        return counts
     
     def _flush_stream_buffer(self, force_invalidate: bool = False):
         """Flush accumulated stream buffer to TUI chat display.
 
-        Throttles TUI invalidation to STREAM_INVALIDATE_INTERVAL during streaming
-        to reduce render thrashing. Pass force_invalidate=True for final flushes.
+        Throttles TUI invalidation to the frame pacer's adaptive interval during
+        streaming to reduce render thrashing (and, in low-bandwidth mode, to the
+        terminal byte budget). Pass force_invalidate=True for final flushes.
         """
         if self._stream_buffer:
             chunk = "".join(self._stream_buffer)
             if self._tui_active:
+                self._render_profiler.record_stream_chunks(len(self._stream_buffer))
                 self._tui_buffer.append_raw(chunk)
                 if self._tui_app:
-                    now = time.monotonic()
-                    if force_invalidate or (now - self._last_stream_invalidate) >= self._STREAM_INVALIDATE_INTERVAL:
+                    if force_invalidate:
+                        self._frame_pacer.mark_invalidated()
+                        self._tui_app.invalidate()
+                    elif ((not self.low_bandwidth or self._bandwidth.should_invalidate())
+                          and self._frame_pacer.should_invalidate()):
                         self._tui_app.invalidate()
-                        self._last_stream_invalidate = now
             else:
                 sys.stdout.write(chunk)
                 sys.stdout.flush()
@@ -682,29 +2189,98 @@ prompt = """You are a multilingual translator. Your task is to translate the use
         self._flush_stream_buffer(force_invalidate=force_invalidate)
 
     def _manage_message_history(self):
-        """Manage message history using token budget with message count fallback."""
-        # Extract system prompt if present (always preserved)
-        system_prompt = next((msg for msg in self.session_messages if msg['role'] == 'system'), None)
-
-        # Get all non-system messages
-        non_system_messages = [msg for msg in self.session_messages if msg['role'] != 'system']
-
-        # Hard cap on message count
-        max_non_system = self.MAX_HISTORY_MESSAGES - (1 if system_prompt else 0)
-        if len(non_system_messages) > max_non_system:
-            non_system_messages = non_system_messages[-max_non_system:]
-
-        # Token budget trimming: remove oldest messages until under budget
-        total_tokens = sum(self._count_tokens(msg.get('content', '')) for msg in non_system_messages)
-        while non_system_messages and total_tokens > self.MAX_HISTORY_TOKENS:
-            removed = non_system_messages.pop(0)
-            total_tokens -= self._count_tokens(removed.get('content', ''))
-
-        # Reconstruct the history with system prompt first
-        self.session_messages = []
-        if system_prompt:
-            self.session_messages.append(system_prompt)
-        self.session_messages.extend(non_system_messages)
+        """Manage message history using token budget with message count fallback.
+
+        Messages carry their token counts and the history keeps a running
+        total, so trimming only costs the messages it drops. The budget comes
+        from the model's context window (see _plan_context_budget). The system prompt
+        is always preserved. With history_summary enabled, dropped turns are
+        folded into a summary message in the background instead of being lost.
+        """
+        encoding = self.tokenizer.name
+        if self.session_messages.encoding != encoding:
+            # The model changed to one with a different tokenizer
+            self.session_messages.recount(encoding)
+        budget = self._plan_context_budget()
+        evicted = self.session_messages.evict(self.MAX_HISTORY_MESSAGES, budget.history)
+        if evicted and self.history_summary:
+            self._history_summarizer.add(evicted)
+            self._schedule_history_summary()
+
+    def _plan_context_budget(self, model: Optional[str] = None) -> ContextBudget:
+        """Split the model's context window between history and fixed reserves.
+
+        The context length comes from config ([context.models."<id>"]) or the
+        provider's model list; without either the fixed MAX_HISTORY_TOKENS
+        applies. A per-model history_tokens setting bypasses the planner.
+        """
+        model = model or self.current_model
+        context_cfg = self.config.get("context", {})
+        override = context_cfg.get("models", {}).get(model, {})
+        system = sum(m.tokens for m in self.session_messages if m.get('role') == 'system')
+        if "history_tokens" in override:
+            return ContextBudget(int(override["history_tokens"]), override.get("context_length"),
+                                 system=system, source="config")
+
+        provider = self.provider_factory.get_provider(model)
+        context_length, source = override.get("context_length"), "config"
+        if not context_length and provider:
+            reported = provider.context_length(model.split('/', 1)[1])
+            if isinstance(reported, int):
+                context_length, source = reported, "provider"
+        if not context_length:
+            return ContextBudget(self.MAX_HISTORY_TOKENS, system=system)
+
+        completion = int(override.get("completion_tokens", context_cfg.get(
+            "completion_tokens", min(self.MAX_COMPLETION_RESERVE, context_length // 4))))
+        tools = 0
+        if provider and provider.supports_tools():
+            schemas = self.tool_registry.get_schemas_for_provider(provider.name)
+            tools = self._count_tokens(json.dumps(schemas)) if schemas else 0
+        files = self.file_context_tokens if self.documents else 0
+        history = context_length - completion - self._memory_reserve - tools - system - files
+        if max_history := context_cfg.get("max_history_tokens"):
+            history = min(history, int(max_history))
+        return ContextBudget(max(self.MIN_HISTORY_TOKENS, history), context_length, completion=completion,
+                             memory=self._memory_reserve, tools=tools, system=system, files=files, source=source)
+
+    def _schedule_history_summary(self):
+        """Fold pending evicted turns into the summary, off the response path."""
+        summarizer = self._history_summarizer
+        if summarizer.running:
+            return  # The running task picks up the new turns
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (scripts, tests): the extractive digest is cheap enough inline
+            pending, summarizer.pending = summarizer.pending, []
+            summarizer.fold_extractive(pending)
+            self._apply_history_summary(self.session_messages)
+            return
+        summarizer.task = loop.create_task(self._summarize_history())
+
+    async def _summarize_history(self):
+        history = self.session_messages
+        summarizer = self._history_summarizer
+        provider, model_name = None, None
+        if summarizer.model and '/' in summarizer.model:
+            provider = self.provider_factory.get_provider(summarizer.model)
+            model_name = summarizer.model.split('/', 1)[1]
+        start = time.time()
+        await summarizer.fold(provider, model_name)
+        if self.session_messages is history:  # Skip if the session was replaced meanwhile
+            self._apply_history_summary(history)
+        self._log("debug", f"History summary updated in {time.time() - start:.2f}s "
+                           f"({self._count_tokens(summarizer.summary)} tokens)")
+
+    def _apply_history_summary(self, history: MessageHistory):
+        """Insert or replace the summary message right after the system prompt."""
+        message = self._history_summarizer.message()
+        index = 1 if history and history[0].get('role') == 'system' and not HistorySummarizer.is_summary(history[0]) else 0
+        if index < len(history) and HistorySummarizer.is_summary(history[index]):
+            history[index] = message
+        else:
+            history.insert(index, message)
     
     def _create_completer(self) -> FuzzyCompleter:
         current_time = time.time()
@@ -743,14 +2319,19 @@ prompt = """You are a multilingual translator. Your task is to translate the use
   [cyan]/session save <name>[/cyan]      Save the current session with a name.
   [cyan]/session load <name>[/cyan]      Load a previously saved session.
   [cyan]/session list[/cyan]          List all saved sessions.
-  [cyan]/file upload <path>[/cyan]     Upload and process a file. Supported formats: txt, md, json, csv, py, js, html, css, pdf.
+  [cyan]/file upload <path>[/cyan]     Attach a file; relevant parts are added to each prompt. Supported formats: txt, md, json, csv, py, js, html, css, pdf.
+  [cyan]/file list[/cyan]              List attached files.
+  [cyan]/file drop <name|all>[/cyan]   Detach a file (or all files).
   [cyan]/tool <action>[/cyan]         Manage tools: [dim]list, enable <name>, disable <name>, call <name> [args][/dim].
   [cyan]/language <code>[/cyan]       Switch interface language. Use without arguments to list available languages.
   [cyan]/export <format>[/cyan]       Export session: [dim]md, json, html, md-rendered[/dim].
   [cyan]/skill <action>[/cyan]        Manage skills: [dim]list, install <path>, uninstall <name>, info <name>[/dim].
   [cyan]/memory <action>[/cyan]       Manage memories: [dim]remember, recall, list, forget, compress, stats[/dim].
+  [cyan]/find <text>[/cyan]           Search the chat history (F4/F5 = previous/next match, /find to clear).
   [cyan]/clear[/cyan]                 Clear the terminal screen.
   [cyan]/debug[/cyan]                Toggle debug mode (show tracebacks, verbose logging).
+  [cyan]/debug render[/cyan]         Toggle the render profiler overlay (also F3).
+  [cyan]/debug tokens[/cyan]         Show token cache statistics (entries, memory, hit rate).
   [cyan]/exit[/cyan]                  Exit the application.
 [bold]Usage:[/bold]
 - Type a message and press [bold]Enter[/bold] to send.
@@ -766,7 +2347,17 @@ prompt = """You are a multilingual translator. Your task is to translate the use
             raise EOFError
 
     def _toggle_debug(self, args: List[str]):
-        """Toggle debug mode on/off at runtime."""
+        """Toggle debug mode on/off at runtime.
+
+        `/debug render` toggles the render profiler and `/debug tokens` shows
+        token cache statistics instead.
+        """
+        if args and args[0] == "render":
+            self._toggle_render_profiler()
+            return
+        if args and args[0] == "tokens":
+            self._show_token_cache_stats()
+            return
         self.debug = not self.debug
         # Update logger level
         logger = logging.getLogger('FreeChat')
@@ -786,6 +2377,54 @@ prompt = """You are a multilingual translator. Your task is to translate the use
         status = "[bold green]ON[/bold green]" if self.debug else "[dim]OFF[/dim]"
         self.output.print(f"[bold cyan]Debug mode:[/bold cyan] {status}")
 
+    def _show_token_cache_stats(self):
+        """Print token cache statistics."""
+        stats = self._token_cache.stats()
+        table = Table("Metric", "Value", title="Token Cache")
+        table.add_row("Entries", str(stats["entries"]))
+        table.add_row("Memory", f'{stats["bytes"] / 1024:.1f} / {stats["max_bytes"] / 1024:.0f} KB')
+        table.add_row("Hits", str(stats["hits"]))
+        table.add_row("Misses", str(stats["misses"]))
+        table.add_row("Hit rate", f'{stats["hit_rate"]:.1%}')
+        self.output.print(table)
+
+    def _toggle_render_profiler(self):
+        """Show or hide the render profiler overlay."""
+        profiler = self._render_profiler
+        profiler.enabled = not profiler.enabled
+        if self._lag_probe_task is not None and not self._lag_probe_task.done():
+            self._lag_probe_task.cancel()  # A quick off/on would otherwise leave two probes running
+        self._lag_probe_task = None
+        if profiler.enabled and self._tui_app:
+            self._lag_probe_task = self._tui_app.create_background_task(profiler.monitor_loop_lag())
+        status = "[bold green]ON[/bold green]" if profiler.enabled else "[dim]OFF[/dim]"
+        self.output.print(f"[bold cyan]Render profiler:[/bold cyan] {status}")
+
+    def _handle_find_command(self, args: List[str]):
+        """Handle /find <text>: highlight matches and jump to the most recent one."""
+        self._find(" ".join(args))
+
+    def _find(self, query: str):
+        """Search the chat transcript. An empty query clears the search."""
+        self._find_query = query
+        self._find_matches = self._tui_buffer.find(query)
+        self._find_pos = len(self._find_matches) - 1
+        if self._find_matches:
+            self._jump_to_find_match()
+        if self._tui_app:
+            self._tui_app.invalidate()
+
+    def _find_step(self, direction: int):
+        """Jump to the previous (-1, older) or next (1, newer) match."""
+        if not self._find_matches:
+            return
+        self._find_pos = (self._find_pos + direction) % len(self._find_matches)
+        self._jump_to_find_match()
+
+    def _jump_to_find_match(self):
+        self._tui_buffer.jump_to_line(self._find_matches[self._find_pos], self._chat_window_height())
+        self._keep_chat_view = True
+
     def _build_tui_layout(self) -> Application:
         """Build the prompt_toolkit Application with split layout."""
         sidebar_filter = Condition(lambda: self._sidebar_visible)
@@ -801,6 +2440,7 @@ prompt = """You are a multilingual translator. Your task is to translate the use
                 parts.append(('class:header-loading', '  |  Loading...'))
             if self.debug:
                 parts.append(('class:header-debug', '  |  DEBUG'))
+                parts.append(('class:header-debug', f'  |  {self._frame_pacer.fps:.0f} fps'))
             return FormattedText(parts)
 
         header = Window(
@@ -811,12 +2451,18 @@ prompt = """You are a multilingual translator. Your task is to translate the use
 
         # --- Chat Area ---
         def get_chat_content():
-            return self._tui_buffer.get_formatted_text()
+            start = time.perf_counter()
+            fragments = self._tui_buffer.get_formatted_text()
+            self._render_profiler.record_formatted(len(fragments), time.perf_counter() - start)
+            return fragments
 
+        # The buffer's cursor position decides scrolling: the huge bottom
+        # offset pins the cursor line to the top of the view.
         chat_window = Window(
-            FormattedTextControl(get_chat_content),
+            FormattedTextControl(get_chat_content, get_cursor_position=self._tui_buffer.get_cursor_position),
             wrap_lines=True,
-            right_margins=[ScrollbarMargin()],
+            right_margins=[] if self.low_bandwidth else [ScrollbarMargin()],
+            scroll_offsets=ScrollOffsets(bottom=sys.maxsize),
             style='class:chat-area'
         )
         self._chat_window = chat_window
@@ -831,7 +2477,7 @@ prompt = """You are a multilingual translator. Your task is to translate the use
                 ('class:sidebar', ' /session   Sessions\n'),
                 ('class:sidebar', ' /memory    Memory system\n'),
                 ('class:sidebar', ' /skill     Skills\n'),
-                ('class:sidebar', ' /file      Upload file\n'),
+                ('class:sidebar', ' /file      Attach files\n'),
                 ('class:sidebar', ' /export    Export chat\n'),
                 ('class:sidebar', ' /clear     Clear screen\n'),
                 ('class:sidebar', ' /debug     Toggle debug\n'),
@@ -840,7 +2486,10 @@ prompt = """You are a multilingual translator. Your task is to translate the use
                 ('class:sidebar-title', ' Shortcuts\n'),
                 ('class:sidebar', ' Enter      Send\n'),
                 ('class:sidebar', ' F2/Ctrl+B  Sidebar\n'),
+                ('class:sidebar', ' PgUp/PgDn  Scroll chat\n'),
                 ('class:sidebar', ' F1         Help\n'),
+                ('class:sidebar', ' F3         Render stats\n'),
+                ('class:sidebar', ' F4/F5      Prev/next match\n'),
                 ('class:sidebar', ' Ctrl+D     Exit\n'),
                 ('', '\n'),
                 ('class:sidebar-title', ' Status\n'),
@@ -876,8 +2525,18 @@ prompt = """You are a multilingual translator. Your task is to translate the use
             if text:
                 self._tui_app.create_background_task(self._tui_dispatch(text))
 
+        def on_input_changed(buf):
+            # Incremental search while typing a /find command
+            if buf.text.startswith('/find '):
+                query = buf.text[len('/find '):].strip()
+                if query != self._find_query:
+                    self._find(query)
+            elif self.speculative_recall:
+                self._speculative_recall.schedule(buf.text)
+
         input_buffer = Buffer(
             accept_handler=on_input_accept,
+            on_text_changed=on_input_changed,
             history=FileHistory(str(self.history_path)),
             auto_suggest=AutoSuggestFromHistory(),
             completer=self._create_completer(),
@@ -907,6 +2566,13 @@ prompt = """You are a multilingual translator. Your task is to translate the use
         # --- Footer ---
         def get_footer_text():
             debug_tag = ' [DEBUG]' if self.debug else ''
+            if self._find_query:
+                found = (f'{self._find_pos + 1}/{len(self._find_matches)}'
+                         if self._find_matches else 'no matches')
+                return FormattedText([
+                    ('class:footer-find', f' Find "{self._find_query}": {found}'),
+                    ('class:footer', '  F4=Previous  F5=Next  /find=Clear')
+                ])
             return FormattedText([
                 ('class:footer', f'{debug_tag} F1=Help  F2=Sidebar  Enter=Send  Ctrl+C=Clear  Ctrl+D=Exit')
             ])
@@ -925,7 +2591,22 @@ prompt = """You are a multilingual translator. Your task is to translate the use
             footer,
         ])
 
-        layout = Layout(root_container, focused_element=input_area)
+        # --- Render profiler overlay ---
+        profiler_overlay = Float(
+            ConditionalContainer(
+                Window(
+                    FormattedTextControl(self._render_profiler.get_overlay_text),
+                    width=28,
+                    height=7,
+                    style='class:profiler'
+                ),
+                filter=Condition(lambda: self._render_profiler.enabled)
+            ),
+            top=1,
+            right=1
+        )
+
+        layout = Layout(FloatContainer(root_container, floats=[profiler_overlay]), focused_element=input_area)
 
         # --- Style ---
         style = Style.from_dict({
@@ -946,7 +2627,11 @@ prompt = """You are a multilingual translator. Your task is to translate the use
             'input-area': '#c9d1d9 bg:#0d1117',
             'input-area-focused': 'bg:#0d1117 #ffffff',
             'footer': '#8b949e bg:#0d1117',
+            'footer-find': 'bold #ffd700 bg:#0d1117',
+            'search-match': 'reverse' if self._low_bandwidth_color_depth() == ColorDepth.DEPTH_1_BIT else 'bg:#9e6a03 #ffffff',
             'bottom-toolbar': '#ffffff bg:#333333',
+            'profiler': '#c9d1d9 bg:#161b22',
+            'profiler-title': 'bold #ffd700 bg:#161b22',
         })
 
         # --- Key Bindings ---
@@ -961,6 +2646,26 @@ prompt = """You are a multilingual translator. Your task is to translate the use
         def _(event):
             self._sidebar_visible = not self._sidebar_visible
 
+        @kb.add('f3')
+        def _(event):
+            self._toggle_render_profiler()
+
+        @kb.add('f4')
+        def _(event):
+            self._find_step(-1)
+
+        @kb.add('f5')
+        def _(event):
+            self._find_step(1)
+
+        @kb.add('pageup')
+        def _(event):
+            self._scroll_chat(-1)
+
+        @kb.add('pagedown')
+        def _(event):
+            self._scroll_chat(1)
+
         @kb.add('c-d')
         def _(event):
             event.app.exit()
@@ -976,23 +2681,37 @@ prompt = """You are a multilingual translator. Your task is to translate the use
             style=style,
             full_screen=True,
             mouse_support=True,
+            color_depth=self._low_bandwidth_color_depth(),
         )
+        self._frame_pacer.attach(app)
+        self._bandwidth.attach(app)
+        self._render_profiler.attach(app)
         self._tui_app = app
         return app
 
+    def _low_bandwidth_color_depth(self) -> Optional[ColorDepth]:
+        """Color depth for the TUI; None lets prompt_toolkit detect it."""
+        if not self.low_bandwidth:
+            return None
+        return ColorDepth.DEPTH_1_BIT if self.low_bandwidth_palette == "mono" else ColorDepth.DEPTH_4_BIT
+
     def _scroll_chat_to_bottom(self):
-        """Scroll chat window to bottom if available."""
-        if hasattr(self, '_chat_window') and self._chat_window:
-            try:
-                # Force scroll to bottom by setting a large scroll offset
-                info = self._chat_window.render_info
-                if info and info.content_height > info.window_height:
-                    self._chat_window.vertical_scroll = max(0, info.content_height - info.window_height)
-            except Exception:
-                pass
+        """Scroll chat window back to the newest output."""
+        self._tui_buffer.scroll_to_bottom()
+
+    def _chat_window_height(self) -> int:
+        """Height of the chat window as last rendered."""
+        info = self._chat_window.render_info if getattr(self, '_chat_window', None) else None
+        return info.window_height if info else 20
+
+    def _scroll_chat(self, direction: int):
+        """Scroll the chat window by one page (direction -1 = up, 1 = down)."""
+        height = self._chat_window_height()
+        self._tui_buffer.scroll(direction * max(1, height - 1), height)
 
     async def _tui_dispatch(self, text: str):
         """Dispatch user input from the TUI input area."""
+        self._keep_chat_view = False
         try:
             await (self._handle_command if text.startswith('/') else self._handle_prompt)(text)
         except (EOFError, KeyboardInterrupt):
@@ -1005,7 +2724,8 @@ prompt = """You are a multilingual translator. Your task is to translate the use
         finally:
             if self._tui_app:
                 self._tui_app.invalidate()
-            self._scroll_chat_to_bottom()
+            if not self._keep_chat_view:
+                self._scroll_chat_to_bottom()
 
     async def _handle_command(self, user_input: str):
         parts = user_input.strip().split(maxsplit=1)
@@ -1206,6 +2926,13 @@ prompt = """You are a multilingual translator. Your task is to translate the use
                 self.output.print(f"  Input price: ${pricing.get('input', 0):.6f}/token")
                 self.output.print(f"  Output price: ${pricing.get('output', 0):.6f}/token")
 
+            budget = self._plan_context_budget(model_name)
+            if budget.context_length:
+                self.output.print(f"  Context length: {budget.context_length:,} tokens ({budget.source})")
+            self.output.print(f"  History budget: {budget.history:,} tokens"
+                              + (f" (reserved: reply {budget.completion:,}, memory {budget.memory:,}, files {budget.files:,}, "
+                                 f"tools {budget.tools:,}, system {budget.system:,})" if budget.context_length else ""))
+
         except Exception as e:
             self.output.print(f"[red]Error getting model info: {e}[/red]")
 
@@ -1338,10 +3065,11 @@ prompt = """You are a multilingual translator. Your task is to translate the use
                     raise ValueError("Session 'messages' field must be a list")
                 if not isinstance(cost, (int, float)):
                     raise ValueError("Session 'cost' field must be numeric")
+                # Set the model first so the session is counted with its tokenizer
+                self.current_model = session_data.get("model", self.current_model)
                 self.session_messages = messages
                 self.session_cost = float(cost)
                 self.active_prompt_name = session_data.get("prompt", self.default_prompt_name)
-                self.current_model = session_data.get("model", self.current_model)
                 self.output.print(f"[bold green]✓ Session '{session_name}' loaded successfully.[/bold green]")
                 self._log("info", f"Loaded session '{session_name}'")
             except FileNotFoundError:
@@ -1370,9 +3098,10 @@ prompt = """You are a multilingual translator. Your task is to translate the use
             self.output.print("[yellow]Usage: /session new|save|load|list[/yellow]")
         
     async def _handle_file_command(self, args: List[str]):
+        usage = "[yellow]Usage: /file upload <path> | list | drop <name|all>[/yellow]"
         if not args:
-            self.output.print("[yellow]Usage: /file upload <path>[/yellow]"); return
-        
+            self.output.print(usage); return
+
         if args[0] == 'upload':
             if len(args) < 2:
                 self.output.print("[yellow]Usage: /file upload <path>[/yellow]"); return
@@ -1395,35 +3124,87 @@ prompt = """You are a multilingual translator. Your task is to translate the use
                 if extension in ['.txt', '.md', '.json', '.csv', '.py', '.js', '.html', '.css']:
                     with open(file, 'r', encoding='utf-8', errors='replace') as f:
                         content = f.read()
-                    # Add file content to chat context
-                    file_info = f"[File: {file.name}]\n\n{content}"
-                    self.session_messages.append({"role": "user", "content": file_info})
-                    self.output.print(f"[bold green]✓ File '{file.name}' uploaded and added to chat context.[/bold green]")
-                    self._log("info", f"Uploaded file '{file.name}' ({file_size} bytes)")
                 elif extension in ['.pdf']:
                     try:
                         import PyPDF2
                         with open(file, 'rb') as f:
                             reader = PyPDF2.PdfReader(f)
                             content = "\n".join([page.extract_text() for page in reader.pages])
-                        file_info = f"[PDF File: {file.name}]\n\n{content}"
-                        self.session_messages.append({"role": "user", "content": file_info})
-                        self.output.print(f"[bold green]✓ PDF file '{file.name}' uploaded and added to chat context.[/bold green]")
-                        self._log("info", f"Uploaded PDF file '{file.name}' ({file_size} bytes)")
                     except ImportError:
                         self.output.print("[bold red]Error: PyPDF2 is not installed. Please install it with 'pip install PyPDF2'.[/bold red]")
                         self._log("error", "PDF file upload failed: PyPDF2 is not installed")
+                        return
                     except Exception as e:
                         self.output.print(f"[bold red]Error reading PDF file: {e}[/bold red]")
                         self._log("error", f"PDF file upload failed: {e}")
+                        return
                 else:
                     self.output.print(f"[bold red]Error: Unsupported file format '{extension}'.[/bold red]")
                     self._log("error", f"File upload failed: Unsupported file format '{extension}'")
+                    return
+                # Index instead of injecting the whole file; prompts pull in the relevant chunks
+                chunks = await asyncio.to_thread(self.documents.add, file.name, content, self._count_tokens_batch)
+                self.output.print(f"[bold green]✓ File '{file.name}' indexed ({chunks} chunks). "
+                                  f"Relevant parts are added to each prompt.[/bold green]")
+                self._log("info", f"Uploaded file '{file.name}' ({file_size} bytes, {chunks} chunks)")
             except Exception as e:
                 self.output.print(f"[bold red]Error uploading file: {e}[/bold red]")
                 self._log("error", f"File upload failed: {e}")
+        elif args[0] == 'list':
+            if not self.documents:
+                self.output.print("[yellow]No files attached. Use /file upload <path>.[/yellow]"); return
+            table = Table(title="Attached Files")
+            table.add_column("File", style="green")
+            table.add_column("Chunks", justify="right")
+            table.add_column("Tokens", justify="right", style="dim")
+            for name in self.documents.documents:
+                chunks = self.documents.chunks(name)
+                table.add_row(name, str(len(chunks)), f"{sum(c.tokens for c in chunks):,}")
+            self.output.print(table)
+            self.output.print(f"[dim]Up to {self.file_context_chunks} chunks / {self.file_context_tokens:,} tokens per prompt.[/dim]")
+        elif args[0] == 'drop':
+            if len(args) < 2:
+                self.output.print("[yellow]Usage: /file drop <name|all>[/yellow]"); return
+            name = " ".join(args[1:])
+            if name == 'all':
+                count = len(self.documents)
+                self.documents.clear()
+                self.output.print(f"[bold green]✓ Dropped {count} file(s).[/bold green]")
+            elif self.documents.drop(name):
+                self.output.print(f"[bold green]✓ File '{name}' dropped.[/bold green]")
+            else:
+                self.output.print(f"[bold red]Error: No attached file named '{name}'.[/bold red]")
         else:
-            self.output.print("[yellow]Usage: /file upload <path>[/yellow]")
+            self.output.print(usage)
+
+    def _file_context(self, prompt: str) -> str:
+        """Format the attached-file chunks most relevant to the prompt, within the token budget.
+
+        Without any term overlap (e.g. "summarize the file") the opening chunks
+        of each file are used instead.
+        """
+        if not self.documents:
+            return ""
+        hits = [chunk for _, chunk in self.documents.search(prompt, self.file_context_chunks)]
+        if not hits:
+            hits = [chunk for name in self.documents.documents for chunk in self.documents.chunks(name)[:2]]
+        selected, used = [], 0
+        for chunk in hits:
+            if used + chunk.tokens > self.file_context_tokens:
+                continue
+            selected.append(chunk)
+            used += chunk.tokens
+            if len(selected) >= self.file_context_chunks:
+                break
+        if not selected:
+            return ""
+        # Present chunks in file order so neighbouring parts read naturally
+        selected.sort(key=lambda c: (c.document, c.index))
+        lines = ["[Relevant excerpts from attached files:]"]
+        for chunk in selected:
+            lines.append(f"--- {chunk.document} (part {chunk.index + 1}/{len(self.documents.documents[chunk.document])}) ---")
+            lines.append(chunk.text.rstrip())
+        return "\n".join(lines)
 
     async def _handle_language_command(self, args: List[str]):
         """Handle language commands: view current language, list available languages, or switch language."""
@@ -1612,8 +3393,8 @@ prompt = """You are a multilingual translator. Your task is to translate the use
             self.output.print("  /memory stats                  - Show statistics")
             self.output.print("  /memory branch                 - List branches with memories")
             self.output.print("  /memory merge <from> <to>      - Merge branch memories")
-            self.output.print("  /memory export <file.json>     - Export memories to JSON")
-            self.output.print("  /memory import <file.json>     - Import memories from JSON")
+            self.output.print("  /memory export <file.ndjson>   - Export memories of all branches to NDJSON")
+            self.output.print("  /memory import <file.ndjson>   - Import memories (NDJSON or older JSON exports)")
             return
 
         cmd = args[0]
@@ -1646,7 +3427,7 @@ prompt = """You are a multilingual translator. Your task is to translate the use
                 return
 
             # Check for duplicates
-            similar = self.memory_manager.find_similar(text)
+            similar = await self.memory_manager.run(self.memory_manager.find_similar, text)
             if similar:
                 self.output.print(f"[yellow]⚠ Similar memories found ({len(similar)}):[/yellow]")
                 for mem in similar[:3]:
@@ -1654,7 +3435,10 @@ prompt = """You are a multilingual translator. Your task is to translate the use
                     self.output.print(f"  [dim]{mem.id[:8]}: {content}[/dim]")
                 self.output.print("[dim]Consider updating existing memory with /memory edit[/dim]")
 
-            memory_id = self.memory_manager.remember(text, category=category, tags=tags)
+            memory_id = await self.memory_manager.run(self.memory_manager.remember, text, category=category, tags=tags)
+            if any(mem.id == memory_id for mem in similar):
+                self.output.print(f"[bold green]✓ Already remembered as {memory_id}[/bold green]")
+                return
             self.output.print(f"[bold green]✓ Memory recorded ({memory_id})[/bold green]")
             if category != "context":
                 self.output.print(f"[dim]  Category: {category}[/dim]")
@@ -1663,26 +3447,26 @@ prompt = """You are a multilingual translator. Your task is to translate the use
 
         elif cmd == "recall" and len(args) > 1:
             query = " ".join(args[1:])
-            memories = self.memory_manager.recall(query)
+            memories = await self.memory_manager.run(self.memory_manager.recall, query)
             if memories:
                 table = Table("ID", "Category", "Content", "Score", "Access")
                 for mem in memories:
                     content = mem.content[:40] + "..." if len(mem.content) > 40 else mem.content
-                    table.add_row(mem.id[:8], mem.category, content, f"{mem.value_score:.2f}", str(mem.access_count))
+                    table.add_row(mem.id[:8], mem.category, content, f"{mem.decayed_value():.2f}", str(mem.access_count))
                 self.output.print(table)
             else:
                 self.output.print("[yellow]No memories found.[/yellow]")
 
         elif cmd == "list":
             category_filter = args[1] if len(args) > 1 else None
-            memories = self.memory_manager.recall(query="", category=category_filter, limit=10000)
+            memories = await self.memory_manager.run(self.memory_manager.recall, query="", category=category_filter, limit=10000)
             if memories:
                 title = f"Memories ({category_filter})" if category_filter else "Memories"
                 table = Table("ID", "Category", "Content", "Score", "Access", title=title)
                 for mem in memories[:30]:
                     content = mem.content[:40] + "..." if len(mem.content) > 40 else mem.content
                     archived = "[dim]A[/dim]" if getattr(mem, 'compressed', False) else ""
-                    table.add_row(mem.id[:8], mem.category, content, f"{mem.value_score:.2f}", str(mem.access_count), archived)
+                    table.add_row(mem.id[:8], mem.category, content, f"{mem.decayed_value():.2f}", str(mem.access_count), archived)
                 self.output.print(table)
                 if len(memories) > 30:
                     self.output.print(f"[dim]... and {len(memories) - 30} more memories[/dim]")
@@ -1749,7 +3533,7 @@ prompt = """You are a multilingual translator. Your task is to translate the use
                 except (ValueError, IndexError):
                     pass
 
-            memories = self.memory_manager.advanced_search(
+            memories = await self.memory_manager.run(self.memory_manager.advanced_search,
                 query=query, category=category, tags=tags if tags else None,
                 min_score=min_score, min_importance=min_importance, limit=50
             )
@@ -1757,7 +3541,7 @@ prompt = """You are a multilingual translator. Your task is to translate the use
                 table = Table("ID", "Category", "Content", "Score", "Imp")
                 for mem in memories:
                     content = mem.content[:40] + "..." if len(mem.content) > 40 else mem.content
-                    table.add_row(mem.id[:8], mem.category, content, f"{mem.value_score:.2f}", str(mem.importance))
+                    table.add_row(mem.id[:8], mem.category, content, f"{mem.decayed_value():.2f}", str(mem.importance))
                 self.output.print(table)
                 self.output.print(f"[dim]Found {len(memories)} result(s)[/dim]")
             else:
@@ -1768,12 +3552,12 @@ prompt = """You are a multilingual translator. Your task is to translate the use
                 limit = int(args[1]) if len(args) > 1 else 10
             except ValueError:
                 limit = 10
-            memories = self.memory_manager.get_top_memories(limit)
+            memories = await self.memory_manager.run(self.memory_manager.get_top_memories, limit)
             if memories:
                 table = Table("#", "ID", "Category", "Content", "Score", title=f"Top {limit} Memories")
                 for i, mem in enumerate(memories, 1):
                     content = mem.content[:40] + "..." if len(mem.content) > 40 else mem.content
-                    table.add_row(str(i), mem.id[:8], mem.category, content, f"{mem.value_score:.2f}")
+                    table.add_row(str(i), mem.id[:8], mem.category, content, f"{mem.decayed_value():.2f}")
                 self.output.print(table)
             else:
                 self.output.print("[yellow]No memories stored.[/yellow]")
@@ -1783,7 +3567,7 @@ prompt = """You are a multilingual translator. Your task is to translate the use
                 limit = int(args[1]) if len(args) > 1 else 10
             except ValueError:
                 limit = 10
-            memories = self.memory_manager.get_recent_memories(limit)
+            memories = await self.memory_manager.run(self.memory_manager.get_recent_memories, limit)
             if memories:
                 table = Table("#", "ID", "Category", "Content", "Accessed", title=f"Recently Accessed Memories")
                 for i, mem in enumerate(memories, 1):
@@ -1795,7 +3579,7 @@ prompt = """You are a multilingual translator. Your task is to translate the use
                 self.output.print("[yellow]No recently accessed memories.[/yellow]")
 
         elif cmd == "categories":
-            categories = self.memory_manager.get_categories()
+            categories = await self.memory_manager.run(self.memory_manager.get_categories)
             if categories:
                 table = Table("Category", "Count", title="Memory Categories")
                 for cat, count in categories:
@@ -1806,16 +3590,16 @@ prompt = """You are a multilingual translator. Your task is to translate the use
 
         elif cmd == "related" and len(args) > 1:
             memory_id = args[1]
-            source = self.memory_manager._store.get_memory(memory_id)
+            source = await self.memory_manager.run(self.memory_manager._store.get_memory, memory_id)
             if not source:
                 self.output.print(f"[bold red]Memory '{memory_id}' not found.[/bold red]")
             else:
-                related = self.memory_manager.get_related(memory_id)
+                related = await self.memory_manager.run(self.memory_manager.get_related, memory_id)
                 if related:
                     table = Table("ID", "Category", "Content", "Score")
                     for mem in related:
                         content = mem.content[:50] + "..." if len(mem.content) > 50 else mem.content
-                        table.add_row(mem.id[:8], mem.category, content, f"{mem.value_score:.2f}")
+                        table.add_row(mem.id[:8], mem.category, content, f"{mem.decayed_value():.2f}")
                     self.output.print(f"[bold cyan]Memories related to {memory_id}:[/bold cyan]")
                     self.output.print(table)
                 else:
@@ -1823,12 +3607,12 @@ prompt = """You are a multilingual translator. Your task is to translate the use
 
         elif cmd == "view" and len(args) > 1:
             memory_id = args[1]
-            mem = self.memory_manager._store.get_memory(memory_id)
+            mem = await self.memory_manager.run(self.memory_manager._store.get_memory, memory_id)
             if mem:
                 self.output.print(f"\n[bold cyan]Memory: {mem.id}[/bold cyan]")
                 self.output.print(f"  Category: {mem.category}")
                 self.output.print(f"  Importance: {mem.importance}/10")
-                self.output.print(f"  Score: {mem.value_score:.2f}")
+                self.output.print(f"  Score: {mem.decayed_value():.2f}")
                 self.output.print(f"  Access count: {mem.access_count}")
                 self.output.print(f"  Tags: {', '.join(mem.tags) if mem.tags else '(none)'}")
                 self.output.print(f"  Branch: {mem.branch or '(global)'}")
@@ -1842,7 +3626,10 @@ prompt = """You are a multilingual translator. Your task is to translate the use
         elif cmd == "edit" and len(args) > 2:
             memory_id = args[1]
             new_content = " ".join(args[2:])
-            if self.memory_manager.update_memory(memory_id, content=new_content):
+            duplicate = await self.memory_manager.run(self.memory_manager.duplicate_of, memory_id, new_content)
+            if duplicate:
+                self.output.print(f"[yellow]Memory '{memory_id}' not updated: duplicate of {duplicate}.[/yellow]")
+            elif await self.memory_manager.run(self.memory_manager.update_memory, memory_id, content=new_content):
                 self.output.print(f"[bold green]✓ Memory updated[/bold green]")
             else:
                 self.output.print(f"[bold red]Memory '{memory_id}' not found.[/bold red]")
@@ -1850,7 +3637,7 @@ prompt = """You are a multilingual translator. Your task is to translate the use
         elif cmd == "tag" and len(args) > 2:
             memory_id = args[1]
             new_tags = args[2:]
-            if self.memory_manager.update_memory(memory_id, tags=list(new_tags)):
+            if await self.memory_manager.run(self.memory_manager.update_memory, memory_id, tags=list(new_tags)):
                 self.output.print(f"[bold green]✓ Tags updated: {', '.join(new_tags)}[/bold green]")
             else:
                 self.output.print(f"[bold red]Memory '{memory_id}' not found.[/bold red]")
@@ -1858,7 +3645,7 @@ prompt = """You are a multilingual translator. Your task is to translate the use
         elif cmd == "category" and len(args) > 2:
             memory_id = args[1]
             new_category = args[2]
-            if self.memory_manager.update_memory(memory_id, category=new_category):
+            if await self.memory_manager.run(self.memory_manager.update_memory, memory_id, category=new_category):
                 self.output.print(f"[bold green]✓ Category updated to '{new_category}'[/bold green]")
             else:
                 self.output.print(f"[bold red]Memory '{memory_id}' not found.[/bold red]")
@@ -1868,7 +3655,7 @@ prompt = """You are a multilingual translator. Your task is to translate the use
             try:
                 importance = int(args[2])
                 if 1 <= importance <= 10:
-                    if self.memory_manager.update_memory(memory_id, importance=importance):
+                    if await self.memory_manager.run(self.memory_manager.update_memory, memory_id, importance=importance):
                         self.output.print(f"[bold green]✓ Importance set to {importance}/10[/bold green]")
                     else:
                         self.output.print(f"[bold red]Memory '{memory_id}' not found.[/bold red]")
@@ -1879,20 +3666,20 @@ prompt = """You are a multilingual translator. Your task is to translate the use
 
         elif cmd == "forget" and len(args) > 1:
             memory_id = args[1]
-            if self.memory_manager.forget(memory_id):
+            if await self.memory_manager.run(self.memory_manager.forget, memory_id):
                 self.output.print(f"[bold green]✓ Memory deleted[/bold green]")
             else:
                 self.output.print(f"[bold red]Memory not found[/bold red]")
 
         elif cmd == "restore" and len(args) > 1:
             memory_id = args[1]
-            if self.memory_manager.restore(memory_id):
+            if await self.memory_manager.run(self.memory_manager.restore, memory_id):
                 self.output.print(f"[bold green]✓ Memory restored[/bold green]")
             else:
                 self.output.print(f"[bold red]Memory '{memory_id}' not found or not archived.[/bold red]")
 
         elif cmd == "compress":
-            archived = self.memory_manager.compress_memories()
+            archived = await self.memory_manager.run(self.memory_manager.compress_memories)
             self.output.print(f"[bold green]✓ Compressed {archived} memories (archived low-value memories)[/bold green]")
 
         elif cmd == "clear":
@@ -1902,13 +3689,13 @@ prompt = """You are a multilingual translator. Your task is to translate the use
             # Since we can't easily do interactive confirmation in async context,
             # we'll use a simpler approach - require "--force" flag
             if len(args) > 1 and args[1] == "--force":
-                count = self.memory_manager.clear_all()
+                count = await self.memory_manager.run(self.memory_manager.clear_all)
                 self.output.print(f"[bold green]✓ Cleared {count} memories[/bold green]")
             else:
                 self.output.print("[dim]Run '/memory clear --force' to confirm deletion.[/dim]")
 
         elif cmd == "stats":
-            stats = self.memory_manager.get_stats()
+            stats = await self.memory_manager.run(self.memory_manager.get_stats)
             self.output.print(Panel(
                 f"Total memories: {stats.get('total_memories', 0)}\n"
                 f"Active: {stats.get('active_memories', 0)} | Archived: {stats.get('archived_memories', 0)}\n"
@@ -1918,8 +3705,8 @@ prompt = """You are a multilingual translator. Your task is to translate the use
             ))
 
         elif cmd == "branch":
-            branches = self.branch_memory_manager.list_branches_with_memories()
-            current = self.branch_memory_manager.get_current_branch() or "(none)"
+            branches = await self.memory_manager.run(self.branch_memory_manager.list_branches_with_memories)
+            current = await self.memory_manager.run(self.branch_memory_manager.get_current_branch) or "(none)"
             if branches:
                 self.output.print(f"[bold cyan]Current branch:[/bold cyan] {current}")
                 table = Table("Branch", "Status")
@@ -1933,14 +3720,14 @@ prompt = """You are a multilingual translator. Your task is to translate the use
         elif cmd == "merge" and len(args) >= 3:
             from_branch = args[1]
             to_branch = args[2]
-            count = self.branch_memory_manager.merge_branch_memories(from_branch, to_branch)
+            count = await self.memory_manager.run(self.branch_memory_manager.merge_branch_memories, from_branch, to_branch)
             self.output.print(f"[bold green]✓ Merged {count} memories from '{from_branch}' to '{to_branch}'[/bold green]")
 
         elif cmd == "export" and len(args) > 1:
             file_path = Path(args[1])
             if not file_path.suffix:
-                file_path = file_path.with_suffix(".json")
-            count = self.memory_manager.export_memories(file_path)
+                file_path = file_path.with_suffix(".ndjson")
+            count = await self.memory_manager.run(self.memory_manager.export_memories, file_path)
             if count > 0:
                 self.output.print(f"[bold green]✓ Exported {count} memories to {file_path}[/bold green]")
             else:
@@ -1951,7 +3738,13 @@ prompt = """You are a multilingual translator. Your task is to translate the use
             if not file_path.exists():
                 self.output.print(f"[bold red]File not found: {file_path}[/bold red]")
             else:
-                count = self.memory_manager.import_memories(file_path)
+                loop = asyncio.get_running_loop()
+
+                def progress(read: int):  # Called on the database thread after each batch
+                    if read % 100_000 < SQLiteMemoryStore.IMPORT_BATCH_SIZE:
+                        loop.call_soon_threadsafe(self.output.print, f"[dim]  {read:,} memories read...[/dim]")
+
+                count = await self.memory_manager.run(self.memory_manager.import_memories, file_path, progress)
                 if count > 0:
                     self.output.print(f"[bold green]✓ Imported {count} memories from {file_path}[/bold green]")
                 else:
@@ -2042,19 +3835,27 @@ prompt = """You are a multilingual translator. Your task is to translate the use
             return
         provider_name, model_name = self.current_model.split('/', 1)
 
-        user_msg = {"role": "user", "content": prompt}
-        self.session_messages.append(user_msg)
         prompt_tokens = await asyncio.to_thread(self._count_tokens, prompt)
+        user_msg = ChatMessage(role="user", content=prompt, tokens=prompt_tokens)
+        self.session_messages.append(user_msg)
 
         # [Memory Injection] Recall relevant memories and inject into context
         memory_context = await self._inject_memory_context(prompt)
         temp_memory_msg = None
         if memory_context:
+            self._memory_reserve = max(self._memory_reserve, await asyncio.to_thread(self._count_tokens, memory_context))
             temp_memory_msg = {"role": "system", "content": memory_context}
             self.session_messages.insert(-1, temp_memory_msg)
 
+        # [File Context] Top-ranked chunks of attached files, for this request only
+        temp_file_msg = None
+        if file_context := await asyncio.to_thread(self._file_context, prompt):
+            temp_file_msg = {"role": "system", "content": file_context}
+            self.session_messages.insert(-1, temp_file_msg)
+
         full_response_parts: List[str] = []
         start_time = time.time()
+        self._bandwidth.start_response()
         self._tui_buffer.show_typing()
         if self._tui_app:
             self._tui_app.invalidate()
@@ -2068,7 +3869,7 @@ prompt = """You are a multilingual translator. Your task is to translate the use
                 full_response_parts.append(chunk)
                 self._stream_buffer.append(chunk)
                 buffer_len += len(chunk)
-                if buffer_len >= self._STREAM_BUFFER_THRESHOLD:
+                if buffer_len >= self._frame_pacer.threshold:
                     await self._flush_stream_buffer_async()
                     buffer_len = 0
             self._tui_buffer.append_raw('\n')
@@ -2097,36 +3898,69 @@ prompt = """You are a multilingual translator. Your task is to translate the use
             self._tui_buffer.hide_typing()
             if self._stream_buffer:
                 await self._flush_stream_buffer_async(force_invalidate=True)
-            if temp_memory_msg is not None:
-                try:
-                    self.session_messages.remove(temp_memory_msg)
-                except ValueError:
-                    pass
+            for temp_msg in (temp_memory_msg, temp_file_msg):
+                if temp_msg is not None:
+                    try:
+                        self.session_messages.remove(temp_msg)
+                    except ValueError:
+                        pass
             if self._tui_app:
                 self._tui_app.invalidate()
         full_response = "".join(full_response_parts)
-        self.session_messages.append({"role": "assistant", "content": full_response})
-        self._manage_message_history()
         response_tokens = await asyncio.to_thread(self._count_tokens, full_response)
+        self.session_messages.append(ChatMessage(role="assistant", content=full_response, tokens=response_tokens))
+        self._manage_message_history()
         cost = provider.calculate_cost(prompt_tokens, response_tokens, model_name)
         if cost is not None: self.session_cost += cost
+        if self.low_bandwidth or self.debug:
+            response_bytes = self._bandwidth.response_bytes
+            logging.getLogger('FreeChat').debug(f"Terminal output for response: {response_bytes} bytes")
+            self.output.print(f"[dim]Terminal output: {response_bytes:,} bytes[/dim]")
         if self._tui_app:
             self._tui_app.invalidate()
 
+    def _recall_memories(self, prompt: str) -> List['MemoryEntry']:
+        """Recall memories for a prompt on the current branch (runs on the DB thread)."""
+        return self.memory_manager.recall(
+            query=prompt,
+            branch=BranchMemoryManager.get_current_branch(),
+            limit=5
+        )
+
+    def _recall_for_prompt(self, prompt: str) -> List['MemoryEntry']:
+        """Recall memories for a prompt and bump their access stats (runs on the DB thread)."""
+        related_memories = self._recall_memories(prompt)
+        if related_memories:
+            # Update access stats for recalled memories (batch query)
+            self.memory_manager.touch_memories([mem.id for mem in related_memories])
+        return related_memories
+
     async def _inject_memory_context(self, prompt: str) -> str:
-        """Recall relevant memories and format them for injection into chat context."""
+        """Recall relevant memories and format them for injection into chat context.
+
+        The branch lookup, FTS query and access-stat commit run as one job on
+        the memory store's database thread, so the event loop never waits on disk.
+        A recall already made while the prompt was being typed is reused.
+        """
         try:
-            related_memories = self.memory_manager.recall(
-                query=prompt,
-                branch=BranchMemoryManager.get_current_branch(),
-                limit=5
-            )
+            start = time.perf_counter()
+            related_memories, saved = await self._speculative_recall.take(prompt)
+            if related_memories is not None:
+                if related_memories:
+                    await self.memory_manager.run(self.memory_manager.touch_memories,
+                                                  [mem.id for mem in related_memories])
+                if self.debug:
+                    spec = self._speculative_recall
+                    self.output.print(f"[dim]Memory recall: reused speculative result, saved {saved * 1000:.1f} ms "
+                                      f"({spec.hits}/{spec.hits + spec.misses} prompts, "
+                                      f"{spec.saved * 1000:.0f} ms total)[/dim]")
+            else:
+                related_memories = await self.memory_manager.run(self._recall_for_prompt, prompt)
+                if self.debug:
+                    self.output.print(f"[dim]Memory recall: {(time.perf_counter() - start) * 1000:.1f} ms[/dim]")
             if not related_memories:
                 return ""
 
-            # Update access stats for recalled memories (batch query)
-            self.memory_manager.touch_memories([mem.id for mem in related_memories])
-
             lines = ["[Relevant context from memory:]"]
             for mem in related_memories:
                 content = mem.content[:150] + "..." if len(mem.content) > 150 else mem.content
@@ -2155,8 +3989,12 @@ prompt = """You are a multilingual translator. Your task is to translate the use
         app.create_background_task(self._fetch_models())
 
         # Run the TUI (blocks until app.exit() is called)
-        await app.run_async()
-        await self.close_providers()
+        try:
+            await app.run_async()
+        finally:
+            await self.close_providers()
+            self.memory_manager.close()  # Commits pending memory writes
+        self._tui_buffer.close()
 
 # --- Tool System ---
 @dataclass
@@ -2510,19 +4348,42 @@ class MemoryEntry:
     compressed: bool = False
     content_compressed: str = ""
     original_length: int = 0
-    value_score: float = 0.0
+    value_score: float = 0.0  # Value at created_at; it halves every VALUE_HALF_LIFE after
+
+    VALUE_HALF_LIFE = 30 * 86400  # Seconds
+    MIN_VALUE = 1e-6  # Floor keeping value_key finite for unscored memories
+
+    @property
+    def value_key(self) -> float:
+        """Log2 of the value decayed to time 0: log2(value_score) + created_at / VALUE_HALF_LIFE.
+
+        The value now is 2 ** (value_key - now / VALUE_HALF_LIFE). The now term
+        is the same for every memory, so ordering by value_key is ordering by
+        current value, and the stored key never needs rescoring.
+        """
+        return math.log2(max(self.value_score, self.MIN_VALUE)) + self.created_at / self.VALUE_HALF_LIFE
+
+    @classmethod
+    def value_at(cls, value_key: Optional[float], now: Optional[float] = None) -> float:
+        """Decayed value of a memory with this value_key at `now` (default: current time)."""
+        if value_key is None:
+            return 0.0
+        return 2.0 ** (value_key - (time.time() if now is None else now) / cls.VALUE_HALF_LIFE)
+
+    def decayed_value(self, now: Optional[float] = None) -> float:
+        """Value score decayed to `now`."""
+        return self.value_at(self.value_key, now)
 
     def compute_value_score(self, weights: Optional[Dict[str, float]] = None) -> float:
-        """Compute auction value score using weighted factors."""
+        """Compute auction value score using weighted factors, as of created_at."""
         if weights is None:
             weights = {'importance': 0.4, 'relevance': 0.3, 'recency': 0.2, 'frequency': 0.1}
 
         # Importance: 1-10 scale
         importance_score = self.importance / 10.0
 
-        # Recency: exponential decay (30-day half-life)
-        days_old = (time.time() - self.created_at) / 86400
-        recency_score = math.exp(-days_old / 30)
+        # Recency: full at creation; age is applied as decay of the whole score (decayed_value)
+        recency_score = 1.0
 
         # Frequency: normalized access count
         freq_score = min(self.access_count / 10.0, 1.0)
@@ -2540,11 +4401,201 @@ class MemoryEntry:
         return score
 
 
+class VectorIndex:
+    """In-memory cosine index over hashed text vectors, for semantic memory recall.
+
+    Texts are embedded offline by feature hashing: words (minus stop words)
+    and their character trigrams are hashed with a random sign into DIM
+    dimensions -- a sparse random projection of the sublinear TF vector --
+    then L2-normalized. Trigrams let "deploying" meet "deployment" or a typo
+    that FTS5 cannot match. No corpus statistics (IDF) are involved, so a
+    stored vector stays valid however the corpus grows.
+
+    Search is brute force: one matrix product with NumPy when it is
+    installed, a pure-Python loop otherwise.
+    """
+
+    DIM = 384              # 1.5 KB per memory; fewer dimensions drown trigram matches in collisions
+    TRIGRAM_WEIGHT = 1.0   # Per trigram, relative to the whole word
+    MIN_SIMILARITY = 0.2   # Cosine below which a hit is hash-collision noise
+
+    def __init__(self):
+        self._slots: Dict[str, int] = {}
+        self._keys: List[Optional[str]] = []
+        self._free: List[int] = []
+        self._rows = np.zeros((0, self.DIM), dtype=np.float32) if np is not None else []
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    @classmethod
+    def features(cls, text: str) -> Counter:
+        """Weighted word and trigram features of `text`."""
+        words = DocumentIndex.terms(text)
+        kept = [w for w in words if w not in SQLiteMemoryStore.STOP_WORDS] or words
+        features = Counter()
+        for word, tf in Counter(kept).items():
+            weight = 1.0 + math.log(tf)
+            features['w:' + word] += weight
+            if len(word) >= 3:
+                padded = f' {word} '
+                for i in range(len(padded) - 2):
+                    features['t:' + padded[i:i + 3]] += weight * cls.TRIGRAM_WEIGHT
+        return features
+
+    @classmethod
+    def embed(cls, text: str) -> array:
+        """Unit float32 vector for `text` (all zeros when it has no terms)."""
+        vector = [0.0] * cls.DIM
+        for feature, weight in cls.features(text).items():
+            # blake2b rather than hash(): vectors are stored, and hash() is salted per process
+            h = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), 'little')
+            vector[h % cls.DIM] += weight if h >> 63 else -weight
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return array('f', [x / norm for x in vector])
+
+    @staticmethod
+    def to_blob(vector: array) -> bytes:
+        return vector.tobytes()
+
+    @staticmethod
+    def from_blob(blob: bytes) -> array:
+        return array('f', blob)
+
+    def add(self, key: str, vector: array) -> None:
+        """Insert or replace the vector stored under `key`."""
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._free.pop() if self._free else len(self._keys)
+            if slot == len(self._keys):
+                self._keys.append(key)
+                if np is None:
+                    self._rows.append(None)
+                elif slot == len(self._rows):  # Grow the matrix by doubling
+                    grown = np.zeros((max(64, 2 * slot), self.DIM), dtype=np.float32)
+                    grown[:slot] = self._rows
+                    self._rows = grown
+            self._keys[slot] = key
+            self._slots[key] = slot
+        self._rows[slot] = np.frombuffer(vector, dtype=np.float32) if np is not None else vector
+
+    def remove(self, key: str) -> None:
+        slot = self._slots.pop(key, None)
+        if slot is not None:
+            self._keys[slot] = None
+            self._rows[slot] = 0 if np is not None else None
+            self._free.append(slot)
+
+    def search(self, vector: array, limit: int) -> List[Tuple[str, float]]:
+        """Up to `limit` (key, cosine) pairs nearest to `vector`, best first."""
+        if not self._slots:
+            return []
+        if np is not None:
+            size = len(self._keys)
+            scores = self._rows[:size] @ np.frombuffer(vector, dtype=np.float32)
+            top = np.argpartition(scores, -limit)[-limit:] if limit < size else range(size)
+            hits = [(self._keys[i], float(scores[i])) for i in top]
+        else:
+            hits = [(key, sum(map(operator.mul, row, vector)))
+                    for key, row in zip(self._keys, self._rows) if row is not None]
+        hits = [(key, score) for key, score in hits if key is not None and score >= self.MIN_SIMILARITY]
+        return heapq.nlargest(limit, hits, key=lambda hit: hit[1])
+
+
+class MinHash:
+    """MinHash signatures and LSH band keys for near-duplicate memory detection.
+
+    A text's shingles are its words (as sets: reordering does not matter).
+    NUM_PERM independent hashes over them give a signature whose agreement
+    estimates Jaccard similarity; cut into BANDS bands of ROWS values, two
+    texts share a band key with high probability once their similarity is
+    above about (1 / BANDS) ** (1 / ROWS) = 0.5. Band keys are stored in
+    SQLite, so candidate lookup is an index probe instead of a scan.
+    """
+
+    NUM_PERM = 64
+    BANDS = 16
+    ROWS = NUM_PERM // BANDS
+
+    @staticmethod
+    def shingles(text: str) -> set:
+        return set(DocumentIndex.terms(text))
+
+    @classmethod
+    def signature(cls, shingles: set) -> List[int]:
+        """Per-slot minimum of NUM_PERM 32-bit hashes of each shingle ([] when there are none).
+
+        One shake_128 digest per shingle supplies all NUM_PERM independent
+        hashes, so the work stays in C; being keyless, stored band keys stay
+        valid across runs.
+        """
+        if not shingles:
+            return []
+        rows = []
+        for shingle in shingles:
+            row = array('I', hashlib.shake_128(shingle.encode()).digest(4 * cls.NUM_PERM))
+            if sys.byteorder == 'big':
+                row.byteswap()
+            rows.append(row)
+        return list(map(min, zip(*rows)))
+
+    @classmethod
+    def band_keys(cls, signature: List[int]) -> List[int]:
+        """One signed 64-bit key per band (the band index is hashed in)."""
+        packed = array('I', signature)
+        if sys.byteorder == 'big':
+            packed.byteswap()
+        packed = packed.tobytes()
+        width = 4 * cls.ROWS
+        return [int.from_bytes(hashlib.blake2b(packed[band * width:(band + 1) * width], digest_size=8,
+                                               person=band.to_bytes(2, 'little')).digest(), 'little', signed=True)
+                for band in range(cls.BANDS if signature else 0)]
+
+    @staticmethod
+    def jaccard(a: set, b: set) -> float:
+        return len(a & b) / len(a | b) if a or b else 0.0
+
+
+def _on_db_thread(method):
+    """Run a memory-store method on the store's database thread.
+
+    Callers on other threads block on the result; calls made from the
+    database thread itself (nested calls, SQLiteMemoryStore.run jobs) run
+    inline. Works for SQLiteMemoryStore and objects holding one as `_store`.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        store = getattr(self, '_store', self)
+        if store._in_db_thread():
+            return method(self, *args, **kwargs)
+        return store._get_executor().submit(method, self, *args, **kwargs).result()
+    return wrapper
+
 class SQLiteMemoryStore:
-    """SQLite-based storage for memories with FTS5 full-text search."""
+    """SQLite-based storage for memories with FTS5 full-text search.
+
+    All database work runs on one dedicated thread with its own connection.
+    Synchronous methods hand their work to it and wait; `run()` is the
+    awaitable entry point for the event loop.
+
+    Writes are write-behind: each runs in its own savepoint inside a shared
+    transaction that is committed as a group after GROUP_COMMIT_INTERVAL
+    seconds or GROUP_COMMIT_SIZE writes, on flush() and on close(). Reads use
+    the same connection, so they always see the store's own pending writes.
+
+    With `semantic`, every memory also gets a VectorIndex embedding in
+    memory_vectors, and queries fuse nearest-vector matches into the FTS5
+    ranking (see _fuse_semantic).
+    """
+
+    GROUP_COMMIT_INTERVAL = 0.1  # Seconds a write may wait for its commit
+    GROUP_COMMIT_SIZE = 256      # Pending writes that force an immediate commit
+    TAG_SEPARATOR = '\x1f'       # Joins tags in memories.tags (ASCII unit separator)
+    ANY_BRANCH = object()        # find_similar default: search every branch
 
     SCHEMA = '''
-    -- Main memories table
+    -- Main memories table; value_key is MemoryEntry.value_key, so ordering by it is
+    -- ordering by decayed value
     CREATE TABLE IF NOT EXISTS memories (
         id TEXT PRIMARY KEY,
         content TEXT NOT NULL,
@@ -2560,10 +4611,13 @@ class SQLiteMemoryStore:
         value_score REAL,
         is_compressed BOOLEAN DEFAULT 0,
         is_archived BOOLEAN DEFAULT 0,
-        original_length INTEGER DEFAULT 0
+        original_length INTEGER DEFAULT 0,
+        content_hash TEXT,  -- See content_hash(); unique per branch (idx_memories_branch_hash)
+        tags TEXT NOT NULL DEFAULT '',  -- Copy of memory_tags joined by TAG_SEPARATOR for reads
+        value_key REAL
     );
 
-    -- Tags many-to-many
+    -- Tags many-to-many, for filtering by tag
     CREATE TABLE IF NOT EXISTS memory_tags (
         memory_id TEXT NOT NULL,
         tag TEXT NOT NULL,
@@ -2588,27 +4642,104 @@ class SQLiteMemoryStore:
         VALUES ('delete', old.rowid, old.content);
     END;
 
-    CREATE TRIGGER IF NOT EXISTS memories_au AFTER UPDATE ON memories BEGIN
+    -- Reindex only when the content changes (memories_au used to fire on any UPDATE)
+    DROP TRIGGER IF EXISTS memories_au;
+    CREATE TRIGGER IF NOT EXISTS memories_content_au AFTER UPDATE OF content ON memories
+    WHEN old.content IS NOT new.content BEGIN
         INSERT INTO memories_fts(memories_fts, rowid, content)
         VALUES ('delete', old.rowid, old.content);
         INSERT INTO memories_fts(rowid, content) VALUES (new.rowid, new.content);
     END;
 
-    -- Indexes for performance
+    -- Accesses since insert, kept out of the wide memories rows (see _record_access).
+    -- A memory's access count is memories.access_count + hits; its last access is
+    -- touched_at if set, else memories.accessed_at.
+    CREATE TABLE IF NOT EXISTS memory_access (
+        memory_id TEXT PRIMARY KEY,
+        hits INTEGER NOT NULL DEFAULT 0,
+        touched_at REAL,
+        FOREIGN KEY (memory_id) REFERENCES memories(id) ON DELETE CASCADE
+    ) WITHOUT ROWID;
+
+    -- Embeddings for semantic recall (see VectorIndex); missing ones are rebuilt on load
+    CREATE TABLE IF NOT EXISTS memory_vectors (
+        memory_id TEXT PRIMARY KEY,
+        vector BLOB NOT NULL,
+        FOREIGN KEY (memory_id) REFERENCES memories(id) ON DELETE CASCADE
+    );
+
+    CREATE TRIGGER IF NOT EXISTS memories_vector_au AFTER UPDATE OF content ON memories BEGIN
+        DELETE FROM memory_vectors WHERE memory_id = old.id;
+    END;
+
+    -- LSH band keys of MinHash signatures, for near-duplicate lookup (see MinHash)
+    CREATE TABLE IF NOT EXISTS memory_lsh (
+        bucket INTEGER NOT NULL,
+        memory_id TEXT NOT NULL,
+        PRIMARY KEY (bucket, memory_id),
+        FOREIGN KEY (memory_id) REFERENCES memories(id) ON DELETE CASCADE
+    ) WITHOUT ROWID;
+
+    CREATE TRIGGER IF NOT EXISTS memories_lsh_au AFTER UPDATE OF content ON memories BEGIN
+        DELETE FROM memory_lsh WHERE memory_id = old.id;
+    END;
+
+    -- Indexes for performance. The partial idx_memories_active_* ones match the hot reads
+    -- (all filter on is_archived = 0), so listings walk an index in ORDER BY order and stop
+    -- at LIMIT instead of sorting the branch; see TestMemoryQueryPlans. The two on value_key
+    -- are created by _migrate_value_key, once the column exists.
+    DROP INDEX IF EXISTS idx_memories_category;
+    DROP INDEX IF EXISTS idx_memories_value;
+    DROP INDEX IF EXISTS idx_memories_accessed;
+    DROP INDEX IF EXISTS idx_memories_archived;
     CREATE INDEX IF NOT EXISTS idx_memories_branch ON memories(branch);
-    CREATE INDEX IF NOT EXISTS idx_memories_category ON memories(category);
-    CREATE INDEX IF NOT EXISTS idx_memories_value ON memories(value_score DESC);
-    CREATE INDEX IF NOT EXISTS idx_memories_accessed ON memories(accessed_at DESC);
-    CREATE INDEX IF NOT EXISTS idx_memories_archived ON memories(is_archived) WHERE is_archived = 0;
+    -- is_archived is redundant in a partial index, but without it SQLite won't treat the index as covering
+    CREATE INDEX IF NOT EXISTS idx_memories_active_category
+        ON memories(category, is_archived) WHERE is_archived = 0;
+    CREATE INDEX IF NOT EXISTS idx_memories_active_accessed
+        ON memories(accessed_at DESC) WHERE is_archived = 0;
+    CREATE INDEX IF NOT EXISTS idx_memory_access_touched ON memory_access(touched_at DESC);
     CREATE INDEX IF NOT EXISTS idx_memory_tags_tag ON memory_tags(tag);
     CREATE INDEX IF NOT EXISTS idx_memory_tags_memory_id_tag ON memory_tags(memory_id, tag);
+    CREATE INDEX IF NOT EXISTS idx_memory_lsh_memory_id ON memory_lsh(memory_id);
     '''
 
-    def __init__(self, db_path: Union[str, Path]):
+    def __init__(self, db_path: Union[str, Path], semantic: bool = False):
         self._db_path = Path(db_path)
+        self.semantic = semantic
+        self._vectors: Optional[VectorIndex] = None  # Loaded on the first semantic query
+        self._lsh_complete = False  # Whether memories stored without LSH keys were indexed
         self._local = threading.local()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+        self._closed = False  # Set by close(); the group-commit timer must not restart the thread
+        self._thread_name = f"freechat-db-{id(self):x}"
+        self._db_thread_id: Optional[int] = None  # threading.get_ident() of the database thread
+        self._pending_writes = 0
+        self._flush_timer: Optional[threading.Timer] = None
         self._init_database()
 
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """The single-thread executor owning the connection (restarted after close())."""
+        with self._executor_lock:
+            self._closed = False
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=self._thread_name,
+                                                    initializer=self._bind_db_thread)
+            return self._executor
+
+    def _bind_db_thread(self) -> None:
+        """Executor initializer: remember which thread is the database thread."""
+        self._db_thread_id = threading.get_ident()
+
+    def _in_db_thread(self) -> bool:
+        return threading.get_ident() == self._db_thread_id
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """Await `func(*args, **kwargs)` on the database thread without blocking the loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), functools.partial(func, *args, **kwargs))
+
     def _get_connection(self) -> sqlite3.Connection:
         """Get thread-local database connection."""
         if not hasattr(self._local, 'connection') or self._local.connection is None:
@@ -2617,82 +4748,380 @@ class SQLiteMemoryStore:
             conn.execute("PRAGMA foreign_keys = ON")
             conn.execute("PRAGMA journal_mode = WAL")
             conn.execute("PRAGMA synchronous = NORMAL")
+            conn.create_function("decayed_value", 1, MemoryEntry.value_at)  # Value of a value_key now
+            conn.create_function("decayed_value", 2, MemoryEntry.value_at)  # ... at a given time
             self._local.connection = conn
         return self._local.connection
 
+    @contextmanager
+    def _read(self):
+        """Connection for queries; never commits, so pending writes stay grouped."""
+        yield self._get_connection()
+
+    @contextmanager
+    def _write(self):
+        """Run one write in a savepoint of the group transaction; commit later.
+
+        A failing write is rolled back alone and the error propagates to the
+        caller as before; the writes already queued are unaffected.
+        """
+        conn = self._get_connection()
+        if not conn.in_transaction:
+            # IMMEDIATE takes the write lock up front (waiting out another writer).
+            # A deferred transaction would read first, e.g. FTS5 reading its config,
+            # and WAL refuses to upgrade a read snapshot without waiting.
+            conn.execute("BEGIN IMMEDIATE")
+        conn.execute("SAVEPOINT write")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK TO write")
+            conn.execute("RELEASE write")
+            raise
+        conn.execute("RELEASE write")
+        self._pending_writes += 1
+        if self._pending_writes >= self.GROUP_COMMIT_SIZE:
+            self.flush()
+        elif self._flush_timer is None:
+            self._flush_timer = threading.Timer(self.GROUP_COMMIT_INTERVAL, self._timer_flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def _timer_flush(self) -> None:
+        # Submit under the lock so close() cannot shut the executor down in
+        # between; never go through _get_executor(), which would restart it.
+        try:
+            with self._executor_lock:
+                if self._closed or self._executor is None:
+                    return
+                future = self._executor.submit(self.flush)
+            future.result()
+        except Exception as e:
+            logging.error(f"Failed to commit memory writes: {e}")
+
+    @_on_db_thread
+    def flush(self) -> int:
+        """Commit pending writes now. Returns how many were committed."""
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        pending, self._pending_writes = self._pending_writes, 0
+        conn = self._get_connection()
+        if conn.in_transaction:
+            conn.commit()
+        return pending
+
+    @_on_db_thread
     def _init_database(self) -> None:
         """Initialize database schema."""
         # Ensure directory exists
         self._db_path.parent.mkdir(parents=True, exist_ok=True)
         with self._get_connection() as conn:
             conn.executescript(self.SCHEMA)
+            self._migrate_tags_column(conn)
+            self._migrate_content_hash(conn)
+            self._migrate_value_key(conn)
             conn.commit()
 
+    def _migrate_tags_column(self, conn: sqlite3.Connection) -> None:
+        """One-time upgrade: add memories.tags and fill it from memory_tags."""
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(memories)")}
+        if 'tags' in columns:
+            return
+        conn.execute("ALTER TABLE memories ADD COLUMN tags TEXT NOT NULL DEFAULT ''")
+        conn.execute('''
+            UPDATE memories SET tags = (
+                SELECT GROUP_CONCAT(tag, ?) FROM memory_tags WHERE memory_id = memories.id
+            )
+            WHERE id IN (SELECT memory_id FROM memory_tags)
+        ''', (self.TAG_SEPARATOR,))
+
+    def _migrate_value_key(self, conn: sqlite3.Connection) -> None:
+        """Add memories.value_key (filled from value_score) and the value indexes over it.
+
+        Stored scores were computed at insert time, so they are taken as the
+        value at created_at. Indexes from before the column, on value_score,
+        are replaced.
+        """
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(memories)")}
+        if 'value_key' not in columns:
+            conn.execute("ALTER TABLE memories ADD COLUMN value_key REAL")
+            conn.execute("DROP INDEX IF EXISTS idx_memories_active_value")
+            conn.execute("DROP INDEX IF EXISTS idx_memories_active_category_value")
+            rows = conn.execute("SELECT id, created_at, value_score FROM memories").fetchall()
+            conn.executemany("UPDATE memories SET value_key = ? WHERE id = ?", [
+                (MemoryEntry(created_at=row['created_at'], value_score=row['value_score'] or 0.0).value_key, row['id'])
+                for row in rows
+            ])
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_memories_active_value
+            ON memories(branch, value_key DESC, accessed_at DESC) WHERE is_archived = 0
+        ''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_memories_active_category_value
+            ON memories(branch, category, value_key DESC, accessed_at DESC) WHERE is_archived = 0
+        ''')
+
+    def _refresh_tags_column(self, conn: sqlite3.Connection, memory_id: str) -> None:
+        """Rebuild memories.tags of one memory from memory_tags."""
+        conn.execute('''
+            UPDATE memories SET tags = COALESCE(
+                (SELECT GROUP_CONCAT(tag, ?) FROM memory_tags WHERE memory_id = ?), '')
+            WHERE id = ?
+        ''', (self.TAG_SEPARATOR, memory_id, memory_id))
+
+    @staticmethod
+    def _record_access(conn: sqlite3.Connection, memory_ids: List[str], when: Optional[float] = None) -> None:
+        """Count an access to each memory in memory_access (inside the caller's write).
+
+        Touches happen on every prompt; the narrow table keeps them from
+        rewriting wide memories rows. Unknown IDs are skipped.
+        """
+        placeholders = ','.join('?' * len(memory_ids))
+        conn.execute(f'''
+            INSERT INTO memory_access (memory_id, hits, touched_at)
+            SELECT id, 1, ? FROM memories WHERE id IN ({placeholders})
+            ON CONFLICT (memory_id) DO UPDATE SET hits = hits + 1, touched_at = excluded.touched_at
+        ''', [when if when is not None else time.time(), *memory_ids])
+
+    @staticmethod
+    def content_hash(content: str) -> str:
+        """Duplicate-detection key: hash of the content with case and whitespace normalized."""
+        normalized = ' '.join(content.casefold().split())
+        return hashlib.blake2b(normalized.encode(), digest_size=16).hexdigest()
+
+    def _migrate_content_hash(self, conn: sqlite3.Connection) -> None:
+        """One-time upgrade: hash existing content, fold duplicates, add the unique index.
+
+        Of each group of identical memories on a branch the oldest is kept;
+        it takes the group's summed access count, latest access, highest
+        importance and all tags.
+        """
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'idx_memories_branch_hash'").fetchone():
+            return
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(memories)")}
+        if 'content_hash' not in columns:
+            conn.execute("ALTER TABLE memories ADD COLUMN content_hash TEXT")
+        rows = conn.execute("SELECT id, content FROM memories WHERE content_hash IS NULL").fetchall()
+        conn.executemany("UPDATE memories SET content_hash = ? WHERE id = ?",
+                         [(self.content_hash(row['content']), row['id']) for row in rows])
+
+        groups: Dict[Tuple[str, str], List[sqlite3.Row]] = {}
+        for row in conn.execute('''
+            SELECT id, branch, content_hash, access_count, accessed_at, importance, is_archived
+            FROM memories
+            WHERE (COALESCE(branch, ''), content_hash) IN (
+                SELECT COALESCE(branch, ''), content_hash FROM memories
+                GROUP BY COALESCE(branch, ''), content_hash HAVING COUNT(*) > 1)
+            ORDER BY created_at, rowid
+        '''):
+            groups.setdefault((row['branch'] or '', row['content_hash']), []).append(row)
+        for keep, *duplicates in groups.values():
+            group = [keep] + duplicates
+            ids = [row['id'] for row in duplicates]
+            placeholders = ','.join('?' * len(ids))
+            conn.execute('''
+                UPDATE memories SET access_count = ?, accessed_at = ?, importance = ?, is_archived = ?
+                WHERE id = ?
+            ''', (sum(row['access_count'] or 0 for row in group),
+                  max((row['accessed_at'] for row in group if row['accessed_at']), default=None),
+                  max(row['importance'] for row in group),
+                  min(row['is_archived'] for row in group),
+                  keep['id']))
+            conn.execute(f'UPDATE OR IGNORE memory_tags SET memory_id = ? WHERE memory_id IN ({placeholders})',
+                         [keep['id']] + ids)
+            conn.execute(f'DELETE FROM memories WHERE id IN ({placeholders})', ids)
+            self._refresh_tags_column(conn, keep['id'])
+        if groups:
+            logging.info(f"Merged {sum(len(g) - 1 for g in groups.values())} duplicate memories")
+        conn.execute("CREATE UNIQUE INDEX idx_memories_branch_hash ON memories(COALESCE(branch, ''), content_hash)")
+
+    _INSERT_MEMORY = '''
+        INSERT INTO memories
+        (id, content, content_compressed, category, source, branch,
+         created_at, updated_at, accessed_at, access_count,
+         importance, value_score, is_compressed, is_archived, original_length,
+         content_hash, tags, value_key)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+
+    def _insert_params(self, entry: MemoryEntry, content_hash: str) -> tuple:
+        """Parameters of _INSERT_MEMORY for `entry`."""
+        return (
+            entry.id, entry.content, entry.content_compressed or None, entry.category, entry.source,
+            entry.branch, entry.created_at, entry.updated_at,
+            entry.last_accessed if entry.last_accessed else None,
+            entry.access_count, entry.importance, entry.value_score,
+            entry.compressed, False, entry.original_length,
+            content_hash, self.TAG_SEPARATOR.join(dict.fromkeys(entry.tags)),
+            entry.value_key
+        )
+
+    @_on_db_thread
     def insert_memory(self, entry: MemoryEntry) -> bool:
-        """Insert a memory entry."""
+        """Insert a memory entry.
+
+        If the branch already holds the same content (see content_hash), that
+        memory is accessed instead: its access count goes up, its importance
+        and current value rise to the entry's if higher, it is restored if
+        archived and it gains the entry's tags. `entry.id` is then set to its ID.
+        """
         try:
-            with self._get_connection() as conn:
-                conn.execute('''
-                    INSERT INTO memories
-                    (id, content, content_compressed, category, source, branch,
-                     created_at, updated_at, accessed_at, access_count,
-                     importance, value_score, is_compressed, is_archived, original_length)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    entry.id, entry.content, None, entry.category, entry.source,
-                    entry.branch, entry.created_at, entry.updated_at,
-                    entry.last_accessed if entry.last_accessed else None,
-                    entry.access_count, entry.importance, entry.value_score,
-                    entry.compressed, False, entry.original_length
-                ))
+            content_hash = self.content_hash(entry.content)
+            with self._write() as conn:
+                conn.execute(self._INSERT_MEMORY + '''
+                    ON CONFLICT (COALESCE(branch, ''), content_hash) DO UPDATE SET
+                        importance = MAX(importance, excluded.importance),
+                        value_key = MAX(value_key, excluded.value_key),
+                        value_score = decayed_value(MAX(value_key, excluded.value_key), created_at),
+                        is_archived = 0
+                ''', self._insert_params(entry, content_hash))
+                memory_id = conn.execute(
+                    "SELECT id FROM memories WHERE COALESCE(branch, '') = ? AND content_hash = ?",
+                    (entry.branch or '', content_hash)
+                ).fetchone()['id']
 
                 # Insert tags
                 if entry.tags:
                     conn.executemany(
                         'INSERT OR IGNORE INTO memory_tags (memory_id, tag) VALUES (?, ?)',
-                        [(entry.id, tag) for tag in entry.tags]
+                        [(memory_id, tag) for tag in entry.tags]
                     )
-
-                conn.commit()
-                return True
+                    if memory_id != entry.id:
+                        self._refresh_tags_column(conn, memory_id)
+                if memory_id != entry.id:
+                    self._record_access(conn, [memory_id])
+                else:
+                    self._save_lsh(conn, entry.id, entry.content)
+                    if self.semantic:
+                        self._save_vector(conn, entry.id, entry.content)
+            entry.id = memory_id
+            return True
         except sqlite3.Error as e:
             logging.error(f"Failed to insert memory: {e}")
             return False
 
-    def get_memory(self, memory_id: str) -> Optional[MemoryEntry]:
-        """Get a memory by ID."""
+    IMPORT_BATCH_SIZE = 5000  # Rows per executemany in insert_memories
+
+    @_on_db_thread
+    def insert_memories(self, entries: Iterable[MemoryEntry],
+                        progress: Optional[Callable[[int], None]] = None) -> int:
+        """Insert many memories in one transaction, IMPORT_BATCH_SIZE rows per executemany.
+
+        `entries` is consumed lazily, so it can stream from a file. Duplicates
+        are handled as by insert_memory, except that `entry.id` is left as is.
+        Each batch is added to the FTS index by one INSERT ... SELECT, with the
+        per-row memories_ai trigger suspended for the transaction (several
+        times faster). LSH keys and embeddings of the new memories are built
+        on first use (see _index_missing_lsh and _vector_index). `progress`,
+        if given, is called with the number of entries read after each batch.
+        Returns the number of new memories; on error nothing is stored.
+        """
+        inserted = read = 0
         try:
-            with self._get_connection() as conn:
-                row = conn.execute(
-                    'SELECT * FROM memories WHERE id = ?', (memory_id,)
-                ).fetchone()
+            with self._write() as conn:
+                fts_trigger = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'memories_ai'").fetchone()[0]
+                conn.execute("DROP TRIGGER memories_ai")
+                pending = iter(entries)
+                while True:
+                    batch = list(itertools.islice(pending, self.IMPORT_BATCH_SIZE))
+                    if not batch:
+                        break
+                    hashes = [self.content_hash(e.content) for e in batch]
+                    last_rowid = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM memories").fetchone()[0]
+                    conn.executemany(self._INSERT_MEMORY + ' ON CONFLICT DO NOTHING',
+                                     [self._insert_params(e, h) for e, h in zip(batch, hashes)])
+                    conn.execute('INSERT INTO memories_fts (rowid, content) '
+                                 'SELECT rowid, content FROM memories WHERE rowid > ?', (last_rowid,))
+                    owners = [conn.execute(
+                        "SELECT id FROM memories WHERE COALESCE(branch, '') = ? AND content_hash = ?",
+                        (e.branch or '', h)).fetchone()['id'] for e, h in zip(batch, hashes)]
+                    conn.executemany('INSERT OR IGNORE INTO memory_tags (memory_id, tag) VALUES (?, ?)',
+                                     [(owner, tag) for e, owner in zip(batch, owners) for tag in e.tags])
+                    existing = [(e, owner) for e, owner in zip(batch, owners) if owner != e.id]
+                    if existing:  # Accessed instead, as in insert_memory
+                        conn.executemany('UPDATE memories SET importance = MAX(importance, ?), is_archived = 0 '
+                                         'WHERE id = ?', [(e.importance, owner) for e, owner in existing])
+                        self._record_access(conn, list({owner for _, owner in existing}))
+                        for owner in {owner for e, owner in existing if e.tags}:
+                            self._refresh_tags_column(conn, owner)
+                    inserted += len(batch) - len(existing)
+                    read += len(batch)
+                    if progress:
+                        progress(read)
+                conn.execute(fts_trigger)
+            if inserted:
+                self._lsh_complete = False
+                self._vectors = None
+            return inserted
+        except sqlite3.Error as e:
+            logging.error(f"Failed to insert memories: {e}")
+            return 0
 
-                if not row:
-                    return None
+    def iter_memories(self) -> Iterator[MemoryEntry]:
+        """Yield every memory of every branch, archived ones included, oldest row first.
 
-                # Get tags
-                tags = [r['tag'] for r in conn.execute(
-                    'SELECT tag FROM memory_tags WHERE memory_id = ?', (memory_id,)
-                )]
+        Rows stream from one cursor, so memory use stays constant. `content` is
+        the original text even for compressed memories. Iterate on the
+        database thread (e.g. from a function passed to run()).
+        """
+        with self._read() as conn:
+            for row in conn.execute('''
+                SELECT m.*, a.hits AS touch_count, a.touched_at
+                FROM memories m
+                LEFT JOIN memory_access a ON a.memory_id = m.id
+                ORDER BY m.rowid
+            '''):
+                entry = self._row_to_entry(row)
+                entry.content = row['content']
+                yield entry
+
+    @_on_db_thread
+    def get_memory(self, memory_id: str) -> Optional[MemoryEntry]:
+        """Get a memory by ID."""
+        try:
+            with self._read() as conn:
+                row = conn.execute('''
+                    SELECT m.*, a.hits AS touch_count, a.touched_at
+                    FROM memories m
+                    LEFT JOIN memory_access a ON a.memory_id = m.id
+                    WHERE m.id = ?
+                ''', (memory_id,)).fetchone()
 
-                return self._row_to_entry(row, tags)
+                return self._row_to_entry(row) if row else None
         except sqlite3.Error as e:
             logging.error(f"Failed to get memory: {e}")
             return None
 
+    @_on_db_thread
+    def find_by_content(self, content: str, branch: Optional[str]) -> Optional[str]:
+        """ID of the memory on `branch` holding the same content (see content_hash), if any."""
+        try:
+            with self._read() as conn:
+                row = conn.execute(
+                    "SELECT id FROM memories WHERE COALESCE(branch, '') = ? AND content_hash = ?",
+                    (branch or '', self.content_hash(content))
+                ).fetchone()
+                return row['id'] if row else None
+        except sqlite3.Error as e:
+            logging.error(f"Failed to look up memory content: {e}")
+            return None
+
+    @_on_db_thread
     def search_memories(self, query: str = "", branch: Optional[str] = None,
                        category: Optional[str] = None, tags: List[str] = None,
                        limit: int = 10, include_archived: bool = False) -> List[MemoryEntry]:
-        """Search memories with various filters."""
+        """Search memories with various filters.
+
+        With a query, matches are ranked by relevance blended with value score
+        (see plan_fts_query / _fts_ranked_select); otherwise by value score.
+        """
         try:
             conditions = []
             params = []
-
-            # Full-text search
-            if query:
-                # Use FTS5 for content search
-                conditions.append("m.rowid IN (SELECT rowid FROM memories_fts WHERE content MATCH ?)")
-                params.append(query)
+            fts_query = self.plan_fts_query(query) if query else ""
+            if query and not fts_query:
+                return []  # Nothing searchable (punctuation only)
 
             if branch is not None:
                 conditions.append("m.branch = ?")
@@ -2709,16 +5138,22 @@ class SQLiteMemoryStore:
 
             where_clause = " AND ".join(conditions) if conditions else "1=1"
 
-            with self._get_connection() as conn:
-                rows = conn.execute(f'''
-                    SELECT m.*, GROUP_CONCAT(mt.tag) as tags_str
-                    FROM memories m
-                    LEFT JOIN memory_tags mt ON m.id = mt.memory_id
-                    WHERE {where_clause}
-                    GROUP BY m.id
-                    ORDER BY m.value_score DESC, m.accessed_at DESC
-                    LIMIT ?
-                ''', params + [limit]).fetchall()
+            with self._read() as conn:
+                if fts_query:
+                    depth = limit * 2 if self.semantic else limit  # Fusion reranks a deeper list
+                    rows = conn.execute(self._fts_ranked_select(where_clause),
+                                        [fts_query] + params + [self.plan_fts_query(query, prefix=False), depth]).fetchall()
+                    if self.semantic:
+                        rows = self._fuse_semantic(conn, rows, query, where_clause, params, limit)
+                else:
+                    rows = conn.execute(f'''
+                        SELECT m.*, a.hits AS touch_count, a.touched_at
+                        FROM memories m
+                        LEFT JOIN memory_access a ON a.memory_id = m.id
+                        WHERE {where_clause}
+                        ORDER BY m.value_key DESC, m.accessed_at DESC
+                        LIMIT ?
+                    ''', params + [limit]).fetchall()
 
                 results = []
                 for row in rows:
@@ -2729,10 +5164,11 @@ class SQLiteMemoryStore:
             logging.error(f"Failed to search memories: {e}")
             return []
 
+    @_on_db_thread
     def update_memory(self, entry: MemoryEntry) -> bool:
-        """Update an existing memory."""
+        """Update an existing memory (access counts are kept; see _record_access)."""
         try:
-            with self._get_connection() as conn:
+            with self._write() as conn:
                 conn.execute('''
                     UPDATE memories SET
                         content = ?,
@@ -2741,20 +5177,23 @@ class SQLiteMemoryStore:
                         source = ?,
                         branch = ?,
                         updated_at = ?,
-                        accessed_at = ?,
-                        access_count = ?,
                         importance = ?,
                         value_score = ?,
                         is_compressed = ?,
                         is_archived = ?,
-                        original_length = ?
+                        original_length = ?,
+                        content_hash = ?,
+                        tags = ?,
+                        value_key = ?
                     WHERE id = ?
                 ''', (
                     entry.content, entry.content_compressed, entry.category, entry.source,
                     entry.branch, entry.updated_at,
-                    entry.last_accessed if entry.last_accessed else None,
-                    entry.access_count, entry.importance, entry.value_score,
+                    entry.importance, entry.value_score,
                     entry.compressed, False, entry.original_length,
+                    self.content_hash(entry.content),
+                    self.TAG_SEPARATOR.join(dict.fromkeys(entry.tags)),
+                    entry.value_key,
                     entry.id
                 ))
 
@@ -2765,19 +5204,22 @@ class SQLiteMemoryStore:
                         'INSERT OR IGNORE INTO memory_tags (memory_id, tag) VALUES (?, ?)',
                         [(entry.id, tag) for tag in entry.tags]
                     )
-
-                conn.commit()
-                return True
+                # The content triggers dropped the old LSH keys and vector
+                self._save_lsh(conn, entry.id, entry.content)
+                if self.semantic:
+                    self._save_vector(conn, entry.id, entry.content)
+            return True
         except sqlite3.Error as e:
             logging.error(f"Failed to update memory: {e}")
             return False
 
+    @_on_db_thread
     def batch_update_compression(self, entries: List[MemoryEntry]) -> int:
         """Batch update compression fields for multiple memories in a single transaction."""
         if not entries:
             return 0
         try:
-            with self._get_connection() as conn:
+            with self._write() as conn:
                 cursor = conn.executemany('''
                     UPDATE memories SET
                         is_compressed = ?,
@@ -2788,71 +5230,80 @@ class SQLiteMemoryStore:
                     (1, entry.content_compressed, entry.updated_at, entry.id)
                     for entry in entries
                 ])
-                conn.commit()
                 return cursor.rowcount
         except sqlite3.Error as e:
             logging.error(f"Failed to batch update compression: {e}")
             return 0
 
+    @_on_db_thread
     def delete_memory(self, memory_id: str) -> bool:
         """Delete a memory by ID."""
         try:
-            with self._get_connection() as conn:
-                # Tags will be deleted by cascade
+            with self._write() as conn:
+                # Tags and vector will be deleted by cascade
                 cursor = conn.execute('DELETE FROM memories WHERE id = ?', (memory_id,))
-                conn.commit()
-                return cursor.rowcount > 0
+            if self._vectors is not None:
+                self._vectors.remove(memory_id)
+            return cursor.rowcount > 0
         except sqlite3.Error as e:
             logging.error(f"Failed to delete memory: {e}")
             return False
 
+    @_on_db_thread
     def restore_memory(self, memory_id: str) -> bool:
         """Restore an archived memory."""
         try:
-            with self._get_connection() as conn:
+            with self._write() as conn:
                 cursor = conn.execute(
                     'UPDATE memories SET is_archived = 0 WHERE id = ?',
                     (memory_id,)
                 )
-                conn.commit()
                 return cursor.rowcount > 0
         except sqlite3.Error as e:
             logging.error(f"Failed to restore memory: {e}")
             return False
 
+    @_on_db_thread
     def clear_all_memories(self) -> int:
         """Delete all memories. Returns count deleted."""
         try:
-            with self._get_connection() as conn:
+            with self._write() as conn:
                 cursor = conn.execute('DELETE FROM memories')
-                conn.commit()
-                return cursor.rowcount
+            self._vectors = None
+            return cursor.rowcount
         except sqlite3.Error as e:
             logging.error(f"Failed to clear memories: {e}")
             return 0
 
+    @staticmethod
+    def _value_key_floor(min_score: float, now: Optional[float] = None) -> float:
+        """value_key at or above which a memory's decayed value is at least min_score now."""
+        return MemoryEntry(created_at=time.time() if now is None else now, value_score=min_score).value_key
+
+    @_on_db_thread
     def archive_old_memories(self, min_score: float, days_old: int) -> int:
-        """Archive memories below score threshold and older than specified days."""
+        """Archive memories whose decayed value is below min_score and older than specified days."""
         try:
-            cutoff_time = time.time() - (days_old * 86400)
-            with self._get_connection() as conn:
+            now = time.time()
+            cutoff_time = now - (days_old * 86400)
+            with self._write() as conn:
                 cursor = conn.execute('''
                     UPDATE memories
                     SET is_archived = 1
-                    WHERE value_score < ?
+                    WHERE value_key < ?
                     AND created_at < ?
                     AND is_archived = 0
-                ''', (min_score, cutoff_time))
-                conn.commit()
+                ''', (self._value_key_floor(min_score, now), cutoff_time))
                 return cursor.rowcount
         except sqlite3.Error as e:
             logging.error(f"Failed to archive memories: {e}")
             return 0
 
+    @_on_db_thread
     def get_all_categories(self) -> List[Tuple[str, int]]:
         """Get all categories with their memory counts."""
         try:
-            with self._get_connection() as conn:
+            with self._read() as conn:
                 rows = conn.execute('''
                     SELECT category, COUNT(*) as count
                     FROM memories
@@ -2865,74 +5316,228 @@ class SQLiteMemoryStore:
             logging.error(f"Failed to get categories: {e}")
             return []
 
+    # Words too common to help recall; dropped from FTS queries unless nothing else is left
+    STOP_WORDS = frozenset('''
+        a about above after again all also am an and any are as at be because been before being
+        below between both but by can could did do does doing down during each few for from further
+        had has have having he her here hers herself him himself his how i if in into is it its itself
+        just let me more most my myself no nor not now of off on once only or other our ours ourselves
+        out over own please same she should so some such than that the their theirs them themselves
+        then there these they this those through to too under until up us very was we were what when
+        where which while who whom why will with would you your yours yourself yourselves
+    '''.split())
+    FTS_MAX_TERMS = 16
+    FTS_PREFIX_MIN_LENGTH = 4   # Longer terms also match as prefixes ("deploy" -> "deployment")
+    RELEVANCE_WEIGHT = 0.7      # Share of bm25 relevance vs decayed value in the search ranking
+    EXACT_MATCH_BOOST = 0.05    # Ranks whole-term matches above prefix-only ones of equal score
+
+    @classmethod
+    def plan_fts_query(cls, text: str, prefix: bool = True) -> str:
+        """Turn free text into a safe FTS5 query: OR of quoted terms, prefixes for long ones.
+
+        Terms are the words FTS5's tokenizer would index; quoting makes
+        operators and punctuation in chat messages plain text. Returns "" when
+        the text has no searchable terms. With prefix=False only whole terms match.
+        """
+        words = list(dict.fromkeys(re.findall(r'\w+', text.lower())))
+        terms = [w for w in words if w not in cls.STOP_WORDS] or words
+        return cls._escape_fts5_query(terms[:cls.FTS_MAX_TERMS], cls.FTS_PREFIX_MIN_LENGTH if prefix else None)
+
+    def _fts_ranked_select(self, where_clause: str) -> str:
+        """SELECT ranking FTS matches by bm25() blended with decayed value, in one statement.
+
+        FTS5's rank column is bm25(), negative and unbounded; -rank / (1 - rank)
+        maps it onto [0, 1) so it can be weighed against decayed_value().
+        Rows matching a whole query term (the plan_fts_query(prefix=False) query)
+        get EXACT_MATCH_BOOST over prefix-only matches; remaining ties go to the
+        most recently accessed, then newest row. Parameters: the FTS query, then
+        those of `where_clause`, then the whole-term query and the limit.
+        """
+        relevance = self.RELEVANCE_WEIGHT
+        return f'''
+            SELECT m.*, a.hits AS touch_count, a.touched_at
+            FROM (SELECT rowid, rank FROM memories_fts WHERE memories_fts MATCH ?) f
+            JOIN memories m ON m.rowid = f.rowid
+            LEFT JOIN memory_access a ON a.memory_id = m.id
+            WHERE {where_clause}
+            ORDER BY {relevance} * (-f.rank / (1.0 - f.rank)) + {1 - relevance:.2f} * decayed_value(m.value_key)
+                     + {self.EXACT_MATCH_BOOST} * (f.rowid IN (SELECT rowid FROM memories_fts WHERE memories_fts MATCH ?)) DESC,
+                     m.accessed_at DESC, m.rowid DESC
+            LIMIT ?
+        '''
+
+    RRF_K = 60  # Reciprocal rank fusion constant; larger values flatten the rank weights
+
+    def _save_vector(self, conn: sqlite3.Connection, memory_id: str, content: str) -> None:
+        """Store the embedding of `content` (inside the caller's write) and index it."""
+        vector = VectorIndex.embed(content)
+        conn.execute('INSERT OR REPLACE INTO memory_vectors (memory_id, vector) VALUES (?, ?)',
+                     (memory_id, VectorIndex.to_blob(vector)))
+        if self._vectors is not None:
+            self._vectors.add(memory_id, vector)
+
+    def _vector_index(self) -> VectorIndex:
+        """The in-memory vector index, loaded on first use; embeds memories stored without one."""
+        if self._vectors is None:
+            index = VectorIndex()
+            with self._read() as conn:
+                for row in conn.execute('SELECT memory_id, vector FROM memory_vectors'):
+                    index.add(row['memory_id'], VectorIndex.from_blob(row['vector']))
+                missing = conn.execute('''
+                    SELECT m.id, m.content FROM memories m
+                    LEFT JOIN memory_vectors v ON v.memory_id = m.id
+                    WHERE v.memory_id IS NULL
+                ''').fetchall()
+            if missing:
+                vectors = [(row['id'], VectorIndex.embed(row['content'])) for row in missing]
+                with self._write() as conn:
+                    conn.executemany('INSERT INTO memory_vectors (memory_id, vector) VALUES (?, ?)',
+                                     [(key, VectorIndex.to_blob(vector)) for key, vector in vectors])
+                for key, vector in vectors:
+                    index.add(key, vector)
+            self._vectors = index
+        return self._vectors
+
+    def _fuse_semantic(self, conn: sqlite3.Connection, fts_rows: List[sqlite3.Row], query: str,
+                       where_clause: str, params: List[Any], limit: int) -> List[sqlite3.Row]:
+        """Merge FTS rows with the nearest vectors to `query` by reciprocal rank fusion.
+
+        Vector hits come from all memories and are then filtered by
+        `where_clause`, so both rankings obey the same filters. Ties keep
+        the FTS order.
+        """
+        hits = self._vector_index().search(VectorIndex.embed(query), max(limit * 4, 20))
+        semantic_rows = []
+        if hits:
+            placeholders = ','.join('?' * len(hits))
+            by_id = {row['id']: row for row in conn.execute(f'''
+                SELECT m.*, a.hits AS touch_count, a.touched_at
+                FROM memories m
+                LEFT JOIN memory_access a ON a.memory_id = m.id
+                WHERE {where_clause} AND m.id IN ({placeholders})
+            ''', params + [key for key, _ in hits])}
+            semantic_rows = [by_id[key] for key, _ in hits if key in by_id]
+
+        scores: Dict[str, float] = {}
+        rows: Dict[str, sqlite3.Row] = {}
+        for ranking in (fts_rows, semantic_rows):
+            for rank, row in enumerate(ranking, 1):
+                scores[row['id']] = scores.get(row['id'], 0.0) + 1.0 / (self.RRF_K + rank)
+                rows.setdefault(row['id'], row)
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        return [rows[memory_id] for memory_id in ranked[:limit]]
+
     @staticmethod
-    def _escape_fts5_query(words: List[str]) -> str:
-        """Escape words for FTS5 MATCH query."""
+    def _escape_fts5_query(words: List[str], prefix_min_length: Optional[int] = None) -> str:
+        """Escape words for FTS5 MATCH query; words of prefix_min_length or more also match as prefixes."""
         escaped = []
         for word in words:
-            word = word.replace('"', '""')
-            escaped.append(f'"{word}"')
+            quoted = '"' + word.replace('"', '""') + '"'
+            if prefix_min_length is not None and len(word) >= prefix_min_length:
+                quoted += '*'
+            escaped.append(quoted)
         return " OR ".join(escaped)
 
-    def find_similar(self, content: str, threshold: float = 0.8) -> List[MemoryEntry]:
-        """Find memories with similar content using simple word overlap.
-
-        Uses FTS5 for candidate pre-filtering before computing Jaccard similarity.
+    @staticmethod
+    def _save_lsh(conn: sqlite3.Connection, memory_id: str, content: str) -> None:
+        """Store the LSH band keys of `content` (inside the caller's write)."""
+        keys = MinHash.band_keys(MinHash.signature(MinHash.shingles(content)))
+        conn.executemany('INSERT OR IGNORE INTO memory_lsh (bucket, memory_id) VALUES (?, ?)',
+                         [(key, memory_id) for key in keys])
+
+    def _index_missing_lsh(self) -> None:
+        """Add LSH keys for memories stored before memory_lsh existed (once per store)."""
+        if self._lsh_complete:
+            return
+        with self._read() as conn:
+            missing = conn.execute('''
+                SELECT m.id, m.content FROM memories m
+                WHERE NOT EXISTS (SELECT 1 FROM memory_lsh l WHERE l.memory_id = m.id)
+            ''').fetchall()
+        if missing:
+            with self._write() as conn:
+                for row in missing:
+                    self._save_lsh(conn, row['id'], row['content'])
+        self._lsh_complete = True
+
+    @_on_db_thread
+    def find_similar(self, content: str, threshold: float = 0.8, limit: int = 5,
+                     branch: Any = ANY_BRANCH) -> List[MemoryEntry]:
+        """Find near-duplicates: memories whose word set has Jaccard similarity >= threshold.
+
+        Candidates are the memories sharing an LSH band key with `content`
+        (see MinHash), so the cost follows the number of near matches rather
+        than the table size; thresholds well below 0.5 may miss some.
+        Candidates are then scored exactly. Ordered by similarity, then id.
+        Given a `branch` (None for memories without one), only that branch is searched.
         """
         try:
-            words = set(content.lower().split())
-            if not words:
+            shingles = MinHash.shingles(content)
+            keys = MinHash.band_keys(MinHash.signature(shingles))
+            if not keys:
                 return []
+            self._index_missing_lsh()
 
-            with self._get_connection() as conn:
-                # Try FTS5 pre-filtering with up to 10 words
-                fts_words = list(words)[:10]
-                fts_query = self._escape_fts5_query(fts_words)
-                candidate_rows = conn.execute('''
-                    SELECT m.*, GROUP_CONCAT(mt.tag) as tags_str
+            placeholders = ','.join('?' * len(keys))
+            params = list(keys)
+            branch_filter = ""
+            if branch is not self.ANY_BRANCH:
+                branch_filter = "AND m.branch IS ?"
+                params.append(branch)
+            with self._read() as conn:
+                candidate_rows = conn.execute(f'''
+                    SELECT m.*, a.hits AS touch_count, a.touched_at
                     FROM memories m
-                    LEFT JOIN memory_tags mt ON m.id = mt.memory_id
-                    JOIN memories_fts fts ON m.rowid = fts.rowid
-                    WHERE memories_fts MATCH ? AND m.is_archived = 0
-                    GROUP BY m.id
-                ''', (fts_query,)).fetchall()
-
-                # If FTS5 returns no candidates, no similar memories exist — skip full table scan
-                if not candidate_rows:
-                    return []
-
-                results = []
-                for row in candidate_rows:
-                    mem_words = set(row['content'].lower().split())
-                    if not mem_words:
-                        continue
-                    overlap = len(words & mem_words) / max(len(words), len(mem_words))
-                    if overlap >= threshold:
-                        results.append((self._row_to_entry(row), overlap))
-
-                results.sort(key=lambda x: x[1], reverse=True)
-                return [entry for entry, _ in results[:5]]
+                    LEFT JOIN memory_access a ON a.memory_id = m.id
+                    WHERE m.id IN (SELECT memory_id FROM memory_lsh WHERE bucket IN ({placeholders}))
+                        AND m.is_archived = 0 {branch_filter}
+                ''', params).fetchall()
+
+            results = []
+            for row in candidate_rows:
+                similarity = MinHash.jaccard(shingles, MinHash.shingles(row['content']))
+                if similarity >= threshold:
+                    results.append((-similarity, row['id'], row))
+            results.sort(key=lambda result: result[:2])
+            return [self._row_to_entry(row) for _, _, row in results[:limit]]
         except sqlite3.Error as e:
             logging.error(f"Failed to find similar memories: {e}")
             return []
 
+    @_on_db_thread
     def get_top_memories(self, limit: int = 10) -> List[MemoryEntry]:
         """Get highest value memories."""
         return self.search_memories(query="", limit=limit)
 
+    @_on_db_thread
     def get_recent_memories(self, limit: int = 10) -> List[MemoryEntry]:
         """Get recently accessed memories."""
         try:
-            with self._get_connection() as conn:
+            with self._read() as conn:
+                # Last access is touched_at for memories with a memory_access row, else
+                # accessed_at: take the newest `limit` of each side from its own index
+                # (idx_memory_access_touched, idx_memories_active_accessed) and merge.
                 rows = conn.execute('''
-                    SELECT m.*, GROUP_CONCAT(mt.tag) as tags_str
-                    FROM memories m
-                    LEFT JOIN memory_tags mt ON m.id = mt.memory_id
-                    WHERE m.is_archived = 0 AND m.accessed_at IS NOT NULL
-                    GROUP BY m.id
-                    ORDER BY m.accessed_at DESC
+                    SELECT * FROM (
+                        SELECT m.*, a.hits AS touch_count, a.touched_at, a.touched_at AS last_access
+                        FROM memory_access a
+                        CROSS JOIN memories m ON m.id = a.memory_id
+                        WHERE m.is_archived = 0 AND a.touched_at IS NOT NULL
+                        ORDER BY a.touched_at DESC
+                        LIMIT ?
+                    )
+                    UNION ALL
+                    SELECT * FROM (
+                        SELECT m.*, NULL AS touch_count, NULL AS touched_at, m.accessed_at AS last_access
+                        FROM memories m
+                        WHERE m.is_archived = 0 AND m.accessed_at IS NOT NULL
+                            AND NOT EXISTS (SELECT 1 FROM memory_access a WHERE a.memory_id = m.id)
+                        ORDER BY m.accessed_at DESC
+                        LIMIT ?
+                    )
+                    ORDER BY last_access DESC
                     LIMIT ?
-                ''', (limit,)).fetchall()
+                ''', (limit, limit, limit)).fetchall()
 
                 results = []
                 for row in rows:
@@ -2942,6 +5547,7 @@ class SQLiteMemoryStore:
             logging.error(f"Failed to get recent memories: {e}")
             return []
 
+    @_on_db_thread
     def get_related_memories(self, memory_id: str, limit: int = 5) -> List[MemoryEntry]:
         """Get memories related by tags or category."""
         try:
@@ -2949,23 +5555,26 @@ class SQLiteMemoryStore:
             if not source:
                 return []
 
-            with self._get_connection() as conn:
+            with self._read() as conn:
                 # Find memories sharing tags or category, excluding self
-                rows = conn.execute('''
-                    SELECT m.*, GROUP_CONCAT(mt.tag) as tags_str,
-                           COUNT(DISTINCT mt2.tag) as tag_matches
+                tags = source.tags or ['']  # Placeholder keeps the IN list valid; matches nothing
+                placeholders = ','.join('?' * len(tags))
+                rows = conn.execute(f'''
+                    SELECT m.*, a.hits AS touch_count, a.touched_at, (
+                        SELECT COUNT(*) FROM memory_tags mt
+                        WHERE mt.memory_id = m.id AND mt.tag IN ({placeholders})
+                    ) as tag_matches
                     FROM memories m
-                    LEFT JOIN memory_tags mt ON m.id = mt.memory_id
-                    LEFT JOIN memory_tags mt2 ON m.id = mt2.memory_id
-                        AND mt2.tag IN (
-                            SELECT tag FROM memory_tags WHERE memory_id = ?
-                        )
+                    LEFT JOIN memory_access a ON a.memory_id = m.id
                     WHERE m.id != ? AND m.is_archived = 0
-                        AND (m.category = ? OR mt2.tag IS NOT NULL)
-                    GROUP BY m.id
-                    ORDER BY tag_matches DESC, m.value_score DESC
+                        AND m.id IN (
+                            SELECT id FROM memories WHERE category = ? AND is_archived = 0
+                            UNION
+                            SELECT memory_id FROM memory_tags WHERE tag IN ({placeholders})
+                        )
+                    ORDER BY tag_matches DESC, m.value_key DESC
                     LIMIT ?
-                ''', (memory_id, memory_id, source.category, limit)).fetchall()
+                ''', tags + [memory_id, source.category] + tags + [limit]).fetchall()
 
                 results = []
                 for row in rows:
@@ -2975,18 +5584,18 @@ class SQLiteMemoryStore:
             logging.error(f"Failed to get related memories: {e}")
             return []
 
+    @_on_db_thread
     def advanced_search(self, query: str, branch: Optional[str] = None,
                         category: Optional[str] = None, tags: List[str] = None,
                         min_score: float = 0.0, min_importance: int = 0,
                         limit: int = 10) -> List[MemoryEntry]:
-        """Advanced search with multiple filters."""
+        """Advanced search with multiple filters, ranked like search_memories."""
         try:
             conditions = []
             params = []
-
-            if query:
-                conditions.append("m.rowid IN (SELECT rowid FROM memories_fts WHERE content MATCH ?)")
-                params.append(query)
+            fts_query = self.plan_fts_query(query) if query else ""
+            if query and not fts_query:
+                return []
 
             if branch is not None:
                 conditions.append("m.branch = ?")
@@ -3007,8 +5616,8 @@ class SQLiteMemoryStore:
             conditions.append("m.is_archived = 0")
 
             if min_score > 0:
-                conditions.append("m.value_score >= ?")
-                params.append(min_score)
+                conditions.append("m.value_key >= ?")
+                params.append(self._value_key_floor(min_score))
 
             if min_importance > 0:
                 conditions.append("m.importance >= ?")
@@ -3016,16 +5625,22 @@ class SQLiteMemoryStore:
 
             where_clause = " AND ".join(conditions) if conditions else "1=1"
 
-            with self._get_connection() as conn:
-                rows = conn.execute(f'''
-                    SELECT m.*, GROUP_CONCAT(mt.tag) as tags_str
-                    FROM memories m
-                    LEFT JOIN memory_tags mt ON m.id = mt.memory_id
-                    WHERE {where_clause}
-                    GROUP BY m.id
-                    ORDER BY m.value_score DESC, m.accessed_at DESC
-                    LIMIT ?
-                ''', params + [limit]).fetchall()
+            with self._read() as conn:
+                if fts_query:
+                    depth = limit * 2 if self.semantic else limit  # Fusion reranks a deeper list
+                    rows = conn.execute(self._fts_ranked_select(where_clause),
+                                        [fts_query] + params + [self.plan_fts_query(query, prefix=False), depth]).fetchall()
+                    if self.semantic:
+                        rows = self._fuse_semantic(conn, rows, query, where_clause, params, limit)
+                else:
+                    rows = conn.execute(f'''
+                        SELECT m.*, a.hits AS touch_count, a.touched_at
+                        FROM memories m
+                        LEFT JOIN memory_access a ON a.memory_id = m.id
+                        WHERE {where_clause}
+                        ORDER BY m.value_key DESC, m.accessed_at DESC
+                        LIMIT ?
+                    ''', params + [limit]).fetchall()
 
                 results = []
                 for row in rows:
@@ -3035,17 +5650,18 @@ class SQLiteMemoryStore:
             logging.error(f"Failed advanced search: {e}")
             return []
 
+    @_on_db_thread
     def get_stats(self) -> Dict[str, Any]:
         """Get database statistics."""
         try:
-            with self._get_connection() as conn:
+            with self._read() as conn:
                 row = conn.execute('''
                     SELECT
                         COUNT(*) AS total,
                         SUM(CASE WHEN is_archived = 1 THEN 1 ELSE 0 END) AS archived,
                         SUM(CASE WHEN branch IS NULL THEN 1 ELSE 0 END) AS global_memories,
                         COUNT(DISTINCT CASE WHEN branch IS NOT NULL THEN branch END) AS branches,
-                        AVG(value_score) AS avg_score
+                        AVG(decayed_value(value_key)) AS avg_score
                     FROM memories
                 ''').fetchone()
                 total = row['total'] or 0
@@ -3066,14 +5682,9 @@ class SQLiteMemoryStore:
             logging.error(f"Failed to get stats: {e}")
             return {}
 
-    def _row_to_entry(self, row: sqlite3.Row, tags: Optional[List[str]] = None) -> MemoryEntry:
-        """Convert a database row to MemoryEntry.
-
-        If tags is None, derive from row['tags_str'] (GROUP_CONCAT result).
-        """
-        if tags is None:
-            tags_str = row['tags_str'] if 'tags_str' in row.keys() else None
-            tags = tags_str.split(',') if tags_str else []
+    def _row_to_entry(self, row: sqlite3.Row) -> MemoryEntry:
+        """Convert a database row to MemoryEntry."""
+        tags = row['tags'].split(self.TAG_SEPARATOR) if row['tags'] else []
         is_compressed = bool(row['is_compressed'])
         content = row['content_compressed'] if is_compressed and row['content_compressed'] else row['content']
         return MemoryEntry(
@@ -3083,8 +5694,8 @@ class SQLiteMemoryStore:
             source=row['source'] or '',
             created_at=row['created_at'],
             updated_at=row['updated_at'],
-            access_count=row['access_count'],
-            last_accessed=row['accessed_at'] or 0,
+            access_count=(row['access_count'] or 0) + (row['touch_count'] or 0),
+            last_accessed=row['touched_at'] or row['accessed_at'] or 0,
             importance=row['importance'],
             tags=tags,
             branch=row['branch'],
@@ -3094,12 +5705,27 @@ class SQLiteMemoryStore:
             value_score=row['value_score'] or 0.0
         )
 
-    def close(self) -> None:
-        """Close all database connections."""
-        if hasattr(self._local, 'connection') and self._local.connection:
+    def _close_connection(self) -> None:
+        if getattr(self._local, 'connection', None):
+            if self._in_db_thread():
+                self.flush()
             self._local.connection.close()
             self._local.connection = None
 
+    def close(self) -> None:
+        """Close the database connections and stop the database thread."""
+        with self._executor_lock:
+            self._closed = True
+            executor, self._executor = self._executor, None
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+        if executor is not None:
+            executor.submit(self._close_connection).result()
+            executor.shutdown(wait=True)
+            self._db_thread_id = None  # Thread idents are reused once a thread exits
+        self._close_connection()  # A connection opened directly on this thread, if any
+
 
 class AuctionEngine:
     """Auction-based memory compression engine."""
@@ -3115,15 +5741,14 @@ class AuctionEngine:
         self.weights = weights or self.DEFAULT_WEIGHTS.copy()
 
     def calculate_value_score(self, entry: MemoryEntry) -> float:
-        """Calculate value score for auction bidding."""
+        """Calculate value score for auction bidding: the entry's value decayed to now."""
         w = self.weights
 
         # Importance: 1-10 scale
         importance_score = entry.importance / 10.0
 
-        # Recency: exponential decay (30-day half-life)
-        days_old = (time.time() - entry.created_at) / 86400
-        recency_score = math.exp(-days_old / 30)
+        # Recency: full at creation; age is applied as decay below
+        recency_score = 1.0
 
         # Frequency: normalized access count
         freq_score = min(entry.access_count / 10.0, 1.0)
@@ -3138,7 +5763,7 @@ class AuctionEngine:
                 w['frequency'] * freq_score)
 
         entry.value_score = score
-        return score
+        return entry.decayed_value()
 
     def run_auction(self, entries: List[MemoryEntry], max_keep: int) -> Tuple[List[MemoryEntry], List[MemoryEntry]]:
         """Run auction to determine which memories to keep vs compress."""
@@ -3159,9 +5784,13 @@ class AuctionEngine:
 class MemoryManager:
     """High-level memory management interface with auction-based compression."""
 
+    DEDUPE_THRESHOLD = 0.8  # Similarity at which remember() reuses an existing memory
+
     def __init__(self, db_path: Path, current_branch: Optional[str] = None,
-                 max_global: int = 100, max_branch: int = 50):
-        self._store = SQLiteMemoryStore(db_path)
+                 max_global: int = 100, max_branch: int = 50, semantic: bool = False,
+                 dedupe: bool = False):
+        self._store = SQLiteMemoryStore(db_path, semantic=semantic)
+        self._dedupe = dedupe
         self._current_branch = current_branch
         self._max_global = max_global
         self._max_branch = max_branch
@@ -3170,7 +5799,23 @@ class MemoryManager:
     def remember(self, content: str, category: str = "context",
                  importance: int = 5, tags: List[str] = None,
                  branch: Optional[str] = None, source: str = "user") -> str:
-        """Store a new memory. Returns memory ID."""
+        """Store a new memory. Returns memory ID.
+
+        With dedupe enabled, a near-duplicate on the same branch is touched
+        and its ID returned instead of storing a copy.
+        """
+        return self._remember(content, category, importance, tags, branch, source)[0]
+
+    def _remember(self, content: str, category: str = "context",
+                  importance: int = 5, tags: List[str] = None,
+                  branch: Optional[str] = None, source: str = "user") -> Tuple[str, bool]:
+        """remember(), also reporting whether a new memory was stored."""
+        target_branch = branch if branch is not None else self._current_branch
+        if self._dedupe:
+            for match in self._store.find_similar(content, self.DEDUPE_THRESHOLD, limit=1, branch=target_branch):
+                self.touch_memory(match.id)
+                return match.id, False
+
         now = time.time()
         memory_id = f"mem_{int(now * 1000)}_{uuid.uuid4().hex[:8]}"
 
@@ -3183,7 +5828,7 @@ class MemoryManager:
             updated_at=now,
             importance=importance,
             tags=tags or [],
-            branch=branch if branch is not None else self._current_branch,
+            branch=target_branch,
             original_length=len(content)
         )
 
@@ -3191,8 +5836,9 @@ class MemoryManager:
         entry.compute_value_score()
 
         if self._store.insert_memory(entry):
-            return memory_id
-        return ""
+            # An identical memory's ID when it already existed
+            return entry.id, entry.id == memory_id
+        return "", False
 
     def recall(self, query: str = "", branch: Optional[str] = None,
                category: Optional[str] = None, tags: List[str] = None,
@@ -3215,11 +5861,27 @@ class MemoryManager:
 
     ALLOWED_UPDATE_FIELDS = {'content', 'category', 'importance', 'tags'}
 
+    def duplicate_of(self, memory_id: str, content: str) -> Optional[str]:
+        """ID of another memory on `memory_id`'s branch that already holds `content`, if any."""
+        entry = self._store.get_memory(memory_id)
+        if not entry:
+            return None
+        existing = self._store.find_by_content(content, entry.branch)
+        return existing if existing != memory_id else None
+
     def update_memory(self, memory_id: str, **kwargs) -> bool:
-        """Update a memory's fields."""
+        """Update a memory's fields.
+
+        Fails (returns False) if new content would duplicate another memory on
+        the branch; see duplicate_of().
+        """
         entry = self._store.get_memory(memory_id)
         if not entry:
             return False
+        if 'content' in kwargs:
+            existing = self._store.find_by_content(kwargs['content'], entry.branch)
+            if existing not in (None, memory_id):
+                return False
 
         for key, value in kwargs.items():
             if key in self.ALLOWED_UPDATE_FIELDS and hasattr(entry, key):
@@ -3228,37 +5890,20 @@ class MemoryManager:
         entry.updated_at = time.time()
         return self._store.update_memory(entry)
 
+    @_on_db_thread
     def touch_memory(self, memory_id: str) -> bool:
         """Update access count and last accessed time."""
-        try:
-            with self._store._get_connection() as conn:
-                conn.execute('''
-                    UPDATE memories
-                    SET access_count = access_count + 1,
-                        accessed_at = ?
-                    WHERE id = ?
-                ''', (time.time(), memory_id))
-                conn.commit()
-                return True
-        except sqlite3.Error:
-            return False
+        return self.touch_memories([memory_id])
 
+    @_on_db_thread
     def touch_memories(self, memory_ids: List[str]) -> bool:
         """Batch update access count and last accessed time for multiple memories."""
         if not memory_ids:
             return True
         try:
-            placeholders = ",".join("?" * len(memory_ids))
-            with self._store._get_connection() as conn:
-                conn.execute(
-                    f'''UPDATE memories
-                        SET access_count = access_count + 1,
-                            accessed_at = ?
-                        WHERE id IN ({placeholders})''',
-                    [time.time(), *memory_ids]
-                )
-                conn.commit()
-                return True
+            with self._store._write() as conn:
+                self._store._record_access(conn, memory_ids)
+            return True
         except sqlite3.Error:
             return False
 
@@ -3270,68 +5915,84 @@ class MemoryManager:
         """Delete all memories."""
         return self._store.clear_all_memories()
 
+    EXPORT_FIELDS = ("id", "content", "category", "source", "created_at", "updated_at",
+                     "access_count", "last_accessed", "importance", "tags", "branch",
+                     "compressed", "content_compressed", "original_length", "value_score")
+
+    @_on_db_thread
     def export_memories(self, file_path: Path) -> int:
-        """Export all memories to a JSON file."""
+        """Export the memories of every branch to an NDJSON file, one JSON object per line.
+
+        Memories are streamed from the database to the file, so memory use
+        does not grow with their number.
+        """
         try:
-            memories = self._store.search_memories(
-                query="", branch=None, include_archived=True, limit=100000
-            )
-            data = []
-            for mem in memories:
-                data.append({
-                    "id": mem.id,
-                    "content": mem.content,
-                    "category": mem.category,
-                    "source": mem.source,
-                    "created_at": mem.created_at,
-                    "updated_at": mem.updated_at,
-                    "access_count": mem.access_count,
-                    "last_accessed": mem.last_accessed,
-                    "importance": mem.importance,
-                    "tags": mem.tags,
-                    "branch": mem.branch,
-                    "compressed": mem.compressed,
-                    "content_compressed": mem.content_compressed,
-                    "original_length": mem.original_length,
-                    "value_score": mem.value_score
-                })
+            count = 0
             with open(file_path, "w", encoding="utf-8") as f:
-                json.dump({"memories": data, "export_time": time.time()}, f, indent=2)
-            return len(data)
+                for mem in self._store.iter_memories():
+                    f.write(json.dumps({key: getattr(mem, key) for key in self.EXPORT_FIELDS}) + "\n")
+                    count += 1
+            return count
         except Exception as e:
             logging.error(f"Failed to export memories: {e}")
             return 0
 
-    def import_memories(self, file_path: Path) -> int:
-        """Import memories from a JSON file."""
+    @staticmethod
+    def _read_export(f) -> Iterator[Dict[str, Any]]:
+        """Yield the memory objects of an NDJSON export, line by line.
+
+        Exports from older versions, a single JSON document holding a
+        "memories" list, are recognised and read whole.
+        """
+        first = f.readline()
+        try:
+            item = json.loads(first)
+        except json.JSONDecodeError:  # An indented single document
+            item = json.loads(first + f.read())
+        if isinstance(item, dict) and isinstance(item.get("memories"), list):
+            yield from item["memories"]
+            return
+        yield item
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+    @staticmethod
+    def _entry_from_export(item: Dict[str, Any]) -> MemoryEntry:
+        """MemoryEntry for an exported memory, under a new unique ID to avoid conflicts."""
+        now = time.time()
+        return MemoryEntry(
+            id=f"mem_{int(now * 1000)}_{uuid.uuid4().hex[:8]}",
+            content=item.get("content", ""),
+            category=item.get("category", "general"),
+            source=item.get("source", "imported"),
+            created_at=item.get("created_at", now),
+            updated_at=item.get("updated_at", now),
+            access_count=item.get("access_count", 0),
+            last_accessed=item.get("last_accessed", 0),
+            importance=item.get("importance", 5),
+            tags=item.get("tags", []),
+            branch=item.get("branch"),
+            compressed=item.get("compressed", False),
+            content_compressed=item.get("content_compressed", ""),
+            original_length=item.get("original_length", 0),
+            value_score=item.get("value_score", 0.0)
+        )
+
+    @_on_db_thread
+    def import_memories(self, file_path: Path, progress: Optional[Callable[[int], None]] = None) -> int:
+        """Import memories from an export file; returns how many new memories were added.
+
+        The file is read incrementally and stored in one transaction (see
+        SQLiteMemoryStore.insert_memories, which also describes `progress`);
+        memories already present are only accessed. A malformed line aborts
+        the whole import.
+        """
         try:
             with open(file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-
-            memories = data.get("memories", [])
-            imported = 0
-            for item in memories:
-                # Generate new unique ID to avoid conflicts
-                new_id = f"mem_{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}"
-                entry = MemoryEntry(
-                    id=new_id,
-                    content=item.get("content", ""),
-                    category=item.get("category", "general"),
-                    source=item.get("source", "imported"),
-                    created_at=item.get("created_at", time.time()),
-                    updated_at=item.get("updated_at", time.time()),
-                    access_count=item.get("access_count", 0),
-                    last_accessed=item.get("last_accessed", 0),
-                    importance=item.get("importance", 5),
-                    tags=item.get("tags", []),
-                    branch=item.get("branch"),
-                    compressed=item.get("compressed", False),
-                    content_compressed=item.get("content_compressed", ""),
-                    original_length=item.get("original_length", 0),
-                    value_score=item.get("value_score", 0.0)
-                )
-                if self._store.insert_memory(entry):
-                    imported += 1
+                entries = (self._entry_from_export(item) for item in self._read_export(f))
+                imported = self._store.insert_memories(entries, progress)
+            self._store.flush()
             return imported
         except Exception as e:
             logging.error(f"Failed to import memories: {e}")
@@ -3341,9 +6002,9 @@ class MemoryManager:
         """Get all categories with memory counts."""
         return self._store.get_all_categories()
 
-    def find_similar(self, content: str) -> List[MemoryEntry]:
-        """Find memories with similar content."""
-        return self._store.find_similar(content)
+    def find_similar(self, content: str, threshold: float = 0.8) -> List[MemoryEntry]:
+        """Find near-duplicate memories (see SQLiteMemoryStore.find_similar)."""
+        return self._store.find_similar(content, threshold)
 
     def get_top_memories(self, limit: int = 10) -> List[MemoryEntry]:
         """Get highest value memories."""
@@ -3379,10 +6040,11 @@ class MemoryManager:
         """Set the current branch."""
         self._current_branch = branch
 
+    @_on_db_thread
     def list_branches(self) -> List[str]:
         """List all branches that have memories."""
         try:
-            with self._store._get_connection() as conn:
+            with self._store._read() as conn:
                 rows = conn.execute(
                     'SELECT DISTINCT branch FROM memories WHERE branch IS NOT NULL'
                 ).fetchall()
@@ -3432,6 +6094,10 @@ class MemoryManager:
         """Get memory statistics."""
         return self._store.get_stats()
 
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """Await a memory operation on the database thread (see SQLiteMemoryStore.run)."""
+        return await self._store.run(func, *args, **kwargs)
+
     def close(self) -> None:
         """Close the memory store."""
         self._store.close()
@@ -3487,7 +6153,7 @@ class BranchMemoryManager:
             logging.info(f"Switched to branch: {current_branch}")
 
     def merge_branch_memories(self, from_branch: str, to_branch: str) -> int:
-        """Merge memories from one branch to another."""
+        """Merge memories from one branch to another. Returns how many were new to the target."""
         try:
             # Get all memories from source branch
             from_memories = self._mm.recall(
@@ -3496,8 +6162,8 @@ class BranchMemoryManager:
 
             merged_count = 0
             for entry in from_memories:
-                # Create new memory in target branch
-                new_id = self._mm.remember(
+                # Create new memory in target branch (memories it already holds are only touched)
+                _, inserted = self._mm._remember(
                     content=entry.content,
                     category=entry.category,
                     importance=entry.importance,
@@ -3505,7 +6171,7 @@ class BranchMemoryManager:
                     branch=to_branch,
                     source=f"merged_from_{from_branch}"
                 )
-                if new_id:
+                if inserted:
                     merged_count += 1
 
             return merged_count
@@ -4329,9 +6995,13 @@ class AIProvider(ABC):
     def supports_tools(self) -> bool:
         return True
 
+    def context_length(self, model: str) -> Optional[int]:
+        """Context window of a model in tokens, if the provider reports one."""
+        return None
+
 
 class OpenAIProvider(AIProvider):
-    def __init__(self, key: str, url: str, name: str="openai"): super().__init__(key); self.base_url, self._name, self.prices = url, name, {}
+    def __init__(self, key: str, url: str, name: str="openai"): super().__init__(key); self.base_url, self._name, self.prices, self.context_lengths = url, name, {}, {}
     @property
     def name(self) -> str: return self._name
     def supports_tools(self) -> bool: return True
@@ -4341,9 +7011,12 @@ class OpenAIProvider(AIProvider):
             r = await self.http.get(f"{self.base_url}/models", headers={"Authorization": f"Bearer {self.api_key}"}); r.raise_for_status()
             data = r.json().get('data', [])
             if "openrouter" in self.base_url: self.prices = {m['id']:{"input":float(m.get('pricing',{}).get('prompt',0)), "output":float(m.get('pricing',{}).get('completion',0))} for m in data}
+            self.context_lengths = {m['id']: int(m['context_length']) for m in data if m.get('context_length')}
             return self.name, sorted([m['id'] for m in data])
         except Exception: return self.name, []
 
+    def context_length(self, model: str) -> Optional[int]: return self.context_lengths.get(model)
+
     async def stream_chat(self, msgs: List[Dict], model: str, tools: Optional[List[Dict]] = None) -> AsyncGenerator[str, None]:
         """Stream chat response with optional tool support."""
         payload: Dict[str, Any] = {"model": model, "messages": msgs, "stream": True}
@@ -4390,9 +7063,11 @@ class OpenAIProvider(AIProvider):
 
 class GeminiProvider(AIProvider):
     URL, MODELS = "https://generativelanguage.googleapis.com/v1beta/models", ["gemini-1.5-pro-latest", "gemini-1.5-flash-latest", "gemini-pro"]
+    CONTEXT_LENGTHS = {"gemini-1.5-pro-latest": 2097152, "gemini-1.5-flash-latest": 1048576, "gemini-pro": 32760}
     @property
     def name(self) -> str: return "gemini"
     def supports_tools(self) -> bool: return True
+    def context_length(self, model: str) -> Optional[int]: return self.CONTEXT_LENGTHS.get(model)
     async def get_models(self) -> Tuple[str, List[str]]: return self.name, self.MODELS if self.api_key else []
     def _to_gemini(self, msgs: List[Dict]) -> List[Dict]:
         gemini_msgs, system_prompt = [], ""
@@ -9,7 +9,9 @@ import time
 import subprocess
 import sys
 import asyncio
+import json
 import os
+import random
 import tempfile
 from pathlib import Path
 
@@ -125,7 +127,7 @@ async def benchmark_streaming_latency():
     async for chunk in mock_stream():
         app._stream_buffer.append(chunk)
         buffer_len += len(chunk)
-        if buffer_len >= app._STREAM_BUFFER_THRESHOLD:
+        if buffer_len >= app._frame_pacer.threshold:
             await app._flush_stream_buffer_async()
             buffer_len = 0
     if app._stream_buffer:
@@ -140,36 +142,54 @@ async def benchmark_streaming_latency():
 
 
 def benchmark_find_similar():
-    """Benchmark find_similar with many memories."""
-    print("\n[Micro-benchmark] find_similar with 2000 memories...")
+    """Benchmark LSH-backed find_similar as the store grows to 100k memories."""
+    print("\n[Micro-benchmark] find_similar at 10k and 100k memories...")
+    rng = random.Random(42)
+    vocabulary = [f"word{i}" for i in range(5000)] + ["python", "code", "async", "await"] * 50
+    results = {}
     with tempfile.TemporaryDirectory() as tmpdir:
-        db_path = Path(tmpdir) / "memories.db"
-        store = freechat.SQLiteMemoryStore(db_path)
-
-        # Insert 2000 synthetic memories
-        start = time.time()
-        for i in range(2000):
-            entry = freechat.MemoryEntry(
-                id=f"mem_{i}",
-                content=f"This is a synthetic memory about topic {i % 50} with some common words like python code async await",
-                category="test",
-                source="benchmark",
-                created_at=time.time(),
-                updated_at=time.time(),
-                importance=5,
-                tags=["benchmark", f"topic{i % 50}"],
-            )
-            store.insert_memory(entry)
-        insert_time = time.time() - start
-
-        start = time.time()
-        results = store.find_similar("python async await code", threshold=0.1)
-        query_time = time.time() - start
+        store = freechat.SQLiteMemoryStore(Path(tmpdir) / "memories.db")
+        inserted, start = 0, time.time()
+        for size in (10_000, 100_000):
+            for i in range(inserted, size):
+                store.insert_memory(freechat.MemoryEntry(
+                    id=f"mem_{i}",
+                    content=" ".join(rng.sample(vocabulary, 12)),
+                    category="test",
+                    tags=["benchmark", f"topic{i % 50}"],
+                ))
+            store.flush()
+            insert_time, inserted = time.time() - start, size
+            # A reordered copy of one stored memory, with one word changed
+            words = store.get_memory(f"mem_{size // 2}").content.split()[::-1]
+            words[0] = "changed"
+            start = time.time()
+            for _ in range(100):
+                similar = store.find_similar(" ".join(words), threshold=0.7)
+            results[size] = (time.time() - start) / 100
+            print(f"  {size:>7} memories: insert {insert_time / size * 1e6:.0f} us/memory, "
+                  f"find_similar {results[size] * 1000:.2f} ms (results: {len(similar)})")
+            start = time.time()
         store.close()
-
-    print(f"  Insert 2000 memories: {insert_time:.4f}s")
-    print(f"  find_similar query: {query_time:.4f}s (results: {len(results)})")
-    return query_time
+    return results
+
+
+def benchmark_group_commit():
+    """Benchmark per-prompt memory writes with group commit vs a commit per write."""
+    print("\n[Micro-benchmark] 1000 remember + touch cycles...")
+    results = {}
+    for label, size in (("commit per write", 1), ("group commit", freechat.SQLiteMemoryStore.GROUP_COMMIT_SIZE)):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            manager = freechat.MemoryManager(Path(tmpdir) / "memories.db")
+            manager._store.GROUP_COMMIT_SIZE = size
+            start = time.time()
+            for i in range(1000):
+                memory_id = manager.remember(f"Fact number {i} about the deployment pipeline", category="benchmark")
+                manager.touch_memories([memory_id])
+            manager.close()
+            results[label] = time.time() - start
+        print(f"  {label}: {results[label]:.4f}s ({results[label] / 2000 * 1e6:.0f} us/write)")
+    return results
 
 
 def benchmark_token_cache_memory():
@@ -189,11 +209,57 @@ def benchmark_token_cache_memory():
     elapsed = time.time() - start
 
     print(f"  1000 inserts time: {elapsed:.4f}s")
-    print(f"  Cache entries: {len(app._token_cache)}")
-    print(f"  Cache bytes: {app._token_cache_bytes} (limit: {app.MAX_TOKEN_CACHE_BYTES})")
-    assert app._token_cache_bytes <= app.MAX_TOKEN_CACHE_BYTES, "Cache exceeded byte limit!"
-    assert len(app._token_cache) <= 1000, "Cache exceeded entry limit!"
-    return elapsed, app._token_cache_bytes
+    stats = app._token_cache.stats()
+    print(f"  Cache entries: {stats['entries']}")
+    print(f"  Cache bytes: {stats['bytes']} (limit: {app.MAX_TOKEN_CACHE_BYTES})")
+
+    # Second pass over the same texts should be served from the cache
+    start = time.time()
+    for i in range(1000):
+        app._count_tokens("x" * ((i % 20 + 1) * 100))
+    cached_elapsed = time.time() - start
+    print(f"  1000 cached lookups time: {cached_elapsed:.4f}s (hit rate: {app._token_cache.hit_rate:.1%})")
+    assert app._token_cache.bytes <= app.MAX_TOKEN_CACHE_BYTES, "Cache exceeded byte limit!"
+    return elapsed, app._token_cache.bytes
+
+
+def benchmark_history_trimming():
+    """Benchmark per-turn history trimming with incremental token accounting."""
+    print("\n[Micro-benchmark] History trimming over 5000 turns...")
+    history = freechat.MessageHistory(
+        [{"role": "system", "content": "You are a test assistant"}],
+        lambda texts: [len(t) // 4 for t in texts]
+    )
+    start = time.time()
+    for i in range(5000):
+        history.append({"role": "user", "content": f"Question {i} " * 20})
+        history.append({"role": "assistant", "content": f"Answer {i} " * 80})
+        history.trim(max_messages=100, max_tokens=4000)
+    elapsed = time.time() - start
+
+    print(f"  5000 turns: {elapsed:.4f}s ({elapsed / 5000 * 1e6:.1f} us/turn)")
+    print(f"  Messages kept: {len(history)}, tokens: {history.tokens}")
+    assert history.tokens <= 4000, "History exceeded token budget!"
+    return elapsed
+
+
+def benchmark_token_estimator():
+    """Benchmark the tokenizer fallback estimator on ASCII and mixed-script text."""
+    print("\n[Micro-benchmark] Token estimator throughput...")
+    estimator = freechat.TokenEstimator("benchmark")
+    samples = {
+        "ascii": "def handler(request):\n    return {'status': 200, 'items': [1, 2, 3]}\n" * 16000,
+        "mixed": "Hello world, 你好世界, Привет мир, こんにちは。 " * 24000,
+    }
+    results = {}
+    for name, text in samples.items():
+        size_mb = len(text.encode("utf-8")) / 1e6
+        start = time.time()
+        tokens = estimator.count(text)
+        elapsed = time.time() - start
+        results[name] = size_mb / elapsed
+        print(f"  {name}: {size_mb:.1f}MB in {elapsed:.4f}s ({results[name]:.0f} MB/s, {tokens} tokens)")
+    return results
 
 
 def benchmark_compression_batch():
@@ -221,6 +287,343 @@ def benchmark_compression_batch():
     return elapsed, compressed
 
 
+def benchmark_semantic_recall():
+    """Benchmark local embedding and brute-force vector search at 10k and 100k memories."""
+    backend = "numpy" if freechat.np is not None else "pure Python"
+    print(f"\n[Micro-benchmark] Semantic recall ({backend})...")
+    VectorIndex = freechat.VectorIndex
+    texts = [f"Fact {i}: the deployment pipeline for service {i % 97} runs on host {i % 13}" for i in range(1000)]
+    start = time.time()
+    vectors = [VectorIndex.embed(text) for text in texts]
+    embed_elapsed = time.time() - start
+    print(f"  Embed: {embed_elapsed / len(texts) * 1e6:.0f} us/memory")
+
+    results = {}
+    index = VectorIndex()
+    query = VectorIndex.embed("deploying service 42")
+    for size in (10_000, 100_000):
+        for i in range(len(index), size):
+            index.add(f"mem_{i}", vectors[i % len(vectors)])
+        runs = 20 if freechat.np is not None else 3
+        start = time.time()
+        for _ in range(runs):
+            index.search(query, 20)
+        results[size] = (time.time() - start) / runs
+        print(f"  {size:>7} memories: {results[size] * 1000:.1f} ms/search")
+    return embed_elapsed, results
+
+
+def _fill_memories(db_path, start, stop, seed=0):
+    """Bulk-insert synthetic memories [start, stop) with raw SQL (schema from SQLiteMemoryStore)."""
+    import sqlite3
+    rng = random.Random(seed + start)
+    words = [f"word{i}" for i in range(5000)] + ["deploy", "pipeline", "python", "review"] * 25
+    branches = [None, None, None, "main", "feature/ui"]
+    now = time.time()
+    rows, tag_rows = [], []
+    for i in range(start, stop):
+        content = " ".join(rng.sample(words, 12)) + f" #{i}"
+        tags = [f"topic{i % 50}", f"team{i % 7}"]
+        value = freechat.MemoryEntry(created_at=now - i * 60, value_score=rng.random())
+        rows.append((f"mem_{i}", content, "test", "benchmark", branches[i % len(branches)],
+                     value.created_at, value.created_at, now - rng.random() * 86400 * 30, i % 17,
+                     rng.randint(1, 10), value.value_score,
+                     freechat.SQLiteMemoryStore.content_hash(content),
+                     freechat.SQLiteMemoryStore.TAG_SEPARATOR.join(tags), value.value_key))
+        tag_rows.extend((f"mem_{i}", tag) for tag in tags)
+    with sqlite3.connect(db_path) as conn:
+        conn.executemany("""
+            INSERT INTO memories (id, content, category, source, branch, created_at, updated_at,
+                                  accessed_at, access_count, importance, value_score, content_hash, tags, value_key)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        conn.executemany("INSERT INTO memory_tags (memory_id, tag) VALUES (?, ?)", tag_rows)
+
+
+def benchmark_tag_reads():
+    """Benchmark memory read queries with GROUP_CONCAT tag joins vs the tags column."""
+    print("\n[Micro-benchmark] Memory reads at 10k and 100k rows (GROUP_CONCAT join -> tags column)...")
+    import sqlite3
+    queries = {
+        "list by value": ("""
+            SELECT m.*, GROUP_CONCAT(mt.tag) as tags_str FROM memories m
+            LEFT JOIN memory_tags mt ON m.id = mt.memory_id
+            WHERE m.branch IS NULL AND m.is_archived = 0
+            GROUP BY m.id ORDER BY m.value_score DESC, m.accessed_at DESC LIMIT 10
+        """, """
+            SELECT m.* FROM memories m
+            WHERE m.branch IS NULL AND m.is_archived = 0
+            ORDER BY m.value_score DESC, m.accessed_at DESC LIMIT 10
+        """, ()),
+        "recent": ("""
+            SELECT m.*, GROUP_CONCAT(mt.tag) as tags_str FROM memories m
+            LEFT JOIN memory_tags mt ON m.id = mt.memory_id
+            WHERE m.is_archived = 0 AND m.accessed_at IS NOT NULL
+            GROUP BY m.id ORDER BY m.accessed_at DESC LIMIT 10
+        """, """
+            SELECT m.* FROM memories m
+            WHERE m.is_archived = 0 AND m.accessed_at IS NOT NULL
+            ORDER BY m.accessed_at DESC LIMIT 10
+        """, ()),
+        "FTS search": ("""
+            SELECT m.*, GROUP_CONCAT(mt.tag) as tags_str
+            FROM (SELECT rowid, rank FROM memories_fts WHERE memories_fts MATCH ?) f
+            JOIN memories m ON m.rowid = f.rowid
+            LEFT JOIN memory_tags mt ON m.id = mt.memory_id
+            WHERE m.branch IS NULL AND m.is_archived = 0
+            GROUP BY m.id ORDER BY -f.rank / (1.0 - f.rank) DESC LIMIT 10
+        """, """
+            SELECT m.*
+            FROM (SELECT rowid, rank FROM memories_fts WHERE memories_fts MATCH ?) f
+            JOIN memories m ON m.rowid = f.rowid
+            WHERE m.branch IS NULL AND m.is_archived = 0
+            ORDER BY -f.rank / (1.0 - f.rank) DESC LIMIT 10
+        """, ('"deploy"* OR "pipeline"*',)),
+    }
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = Path(tmpdir) / "memories.db"
+        freechat.SQLiteMemoryStore(db_path).close()
+        filled = 0
+        for size in (10_000, 100_000):
+            _fill_memories(db_path, filled, size)
+            filled = size
+            conn = sqlite3.connect(db_path)
+            for name, (before, after, params) in queries.items():
+                timings = []
+                for sql in (before, after):
+                    conn.execute(sql, params).fetchall()  # Warm the page cache
+                    start = time.time()
+                    for _ in range(20):
+                        conn.execute(sql, params).fetchall()
+                    timings.append((time.time() - start) / 20)
+                results[(size, name)] = timings
+                print(f"  {size:>7} rows, {name}: {timings[0] * 1000:.2f} ms -> {timings[1] * 1000:.2f} ms")
+            conn.close()
+    return results
+
+
+def benchmark_hot_query_indexes():
+    """Benchmark hot memory reads on the single-column indexes vs the partial idx_memories_active_* ones."""
+    print("\n[Micro-benchmark] Hot memory reads at 10k and 100k rows (single-column -> active_* indexes)...")
+    import sqlite3
+    old_indexes = {
+        "idx_memories_category": "CREATE INDEX idx_memories_category ON memories(category)",
+        "idx_memories_value": "CREATE INDEX idx_memories_value ON memories(value_score DESC)",
+        "idx_memories_accessed": "CREATE INDEX idx_memories_accessed ON memories(accessed_at DESC)",
+        "idx_memories_archived": "CREATE INDEX idx_memories_archived ON memories(is_archived) WHERE is_archived = 0",
+    }
+    access = "SELECT m.*, a.hits AS touch_count, a.touched_at FROM memories m LEFT JOIN memory_access a ON a.memory_id = m.id"
+    queries = {
+        "list by value": (f"""
+            {access} WHERE m.branch = ? AND m.is_archived = 0
+            ORDER BY m.value_score DESC, m.accessed_at DESC LIMIT 10
+        """, f"""
+            {access} WHERE m.branch = ? AND m.is_archived = 0
+            ORDER BY m.value_key DESC, m.accessed_at DESC LIMIT 10
+        """, ("main",)),
+        "list by category": (f"""
+            {access} WHERE m.branch IS NULL AND m.category = ? AND m.is_archived = 0
+            ORDER BY m.value_score DESC, m.accessed_at DESC LIMIT 10
+        """, f"""
+            {access} WHERE m.branch IS NULL AND m.category = ? AND m.is_archived = 0
+            ORDER BY m.value_key DESC, m.accessed_at DESC LIMIT 10
+        """, ("cat3",)),
+        "recent": (f"""
+            {access} WHERE m.is_archived = 0 AND COALESCE(a.touched_at, m.accessed_at) IS NOT NULL
+            ORDER BY COALESCE(a.touched_at, m.accessed_at) DESC LIMIT 10
+        """, """
+            SELECT * FROM (
+                SELECT m.*, a.hits AS touch_count, a.touched_at, a.touched_at AS last_access
+                FROM memory_access a CROSS JOIN memories m ON m.id = a.memory_id
+                WHERE m.is_archived = 0 AND a.touched_at IS NOT NULL ORDER BY a.touched_at DESC LIMIT 10
+            )
+            UNION ALL
+            SELECT * FROM (
+                SELECT m.*, NULL AS touch_count, NULL AS touched_at, m.accessed_at AS last_access
+                FROM memories m
+                WHERE m.is_archived = 0 AND m.accessed_at IS NOT NULL
+                    AND NOT EXISTS (SELECT 1 FROM memory_access a WHERE a.memory_id = m.id)
+                ORDER BY m.accessed_at DESC LIMIT 10
+            )
+            ORDER BY last_access DESC LIMIT 10
+        """, ()),
+        "categories": ("""
+            SELECT category, COUNT(*) AS count FROM memories WHERE is_archived = 0
+            GROUP BY category ORDER BY count DESC
+        """, None, ()),
+    }
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = Path(tmpdir) / "memories.db"
+        freechat.SQLiteMemoryStore(db_path).close()
+        with sqlite3.connect(db_path) as conn:
+            new_indexes = dict(conn.execute(
+                "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%active%'"
+            ).fetchall())
+            new_indexes["idx_memory_access_touched"] = conn.execute(
+                "SELECT sql FROM sqlite_master WHERE name = 'idx_memory_access_touched'").fetchone()[0]
+        filled = 0
+        for size in (10_000, 100_000):
+            _fill_memories(db_path, filled, size)
+            with sqlite3.connect(db_path) as conn:  # 20 categories, 10% touched, 10% archived
+                conn.execute("UPDATE memories SET category = 'cat' || (rowid % 20), is_archived = (rowid % 10 = 0) "
+                             "WHERE rowid > ?", (filled,))
+                conn.execute("INSERT INTO memory_access (memory_id, hits, touched_at) "
+                             "SELECT id, 1, accessed_at + 3600 FROM memories WHERE rowid > ? AND rowid % 10 = 5",
+                             (filled,))
+            filled = size
+            conn = sqlite3.connect(db_path)
+            timings = {}
+            for phase, (drop, create) in enumerate(((new_indexes, old_indexes), (old_indexes, new_indexes))):
+                for name in drop:
+                    conn.execute(f"DROP INDEX IF EXISTS {name}")
+                for sql in create.values():
+                    conn.execute(sql.replace("CREATE INDEX ", "CREATE INDEX IF NOT EXISTS ", 1))
+                for name, (before, after, params) in queries.items():
+                    sql = (after or before) if phase else before
+                    conn.execute(sql, params).fetchall()  # Warm the page cache
+                    start = time.time()
+                    for _ in range(20):
+                        conn.execute(sql, params).fetchall()
+                    timings.setdefault(name, []).append((time.time() - start) / 20)
+            conn.close()
+            for name, pair in timings.items():
+                results[(size, name)] = pair
+                print(f"  {size:>7} rows, {name}: {pair[0] * 1000:.2f} ms -> {pair[1] * 1000:.2f} ms")
+    return results
+
+
+def benchmark_decayed_ranking():
+    """Benchmark ranking by current decayed value: rescoring rows per query vs the value_key index."""
+    print("\n[Micro-benchmark] Top 10 by decayed value at 10k and 100k rows (rescore -> value_key index)...")
+    import sqlite3
+    half_life = freechat.MemoryEntry.VALUE_HALF_LIFE
+    rescored = """
+        SELECT m.* FROM memories m WHERE m.branch IS NULL AND m.is_archived = 0
+        ORDER BY decay(m.value_score, m.created_at) DESC LIMIT 10
+    """
+    indexed = """
+        SELECT m.* FROM memories m WHERE m.branch IS NULL AND m.is_archived = 0
+        ORDER BY m.value_key DESC, m.accessed_at DESC LIMIT 10
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = Path(tmpdir) / "memories.db"
+        freechat.SQLiteMemoryStore(db_path).close()
+        filled = 0
+        for size in (10_000, 100_000):
+            _fill_memories(db_path, filled, size)
+            filled = size
+            conn = sqlite3.connect(db_path)
+            now = time.time()
+            conn.create_function("decay", 2, lambda value, created: value * 0.5 ** ((now - created) / half_life))
+            top = [conn.execute(sql).fetchall() for sql in (rescored, indexed)]
+            assert [row[0] for row in top[0]] == [row[0] for row in top[1]], "rankings differ"
+            timings = []
+            for sql in (rescored, indexed):
+                start = time.time()
+                for _ in range(20):
+                    conn.execute(sql).fetchall()
+                timings.append((time.time() - start) / 20)
+            start = time.time()  # What a periodic rescoring job would pay instead
+            conn.execute("UPDATE memories SET value_score = decay(value_score, created_at)")
+            conn.rollback()
+            rescore_all = time.time() - start
+            conn.close()
+            results[size] = (*timings, rescore_all)
+            print(f"  {size:>7} rows: {timings[0] * 1000:.2f} ms -> {timings[1] * 1000:.2f} ms "
+                  f"(rescoring every row once: {rescore_all * 1000:.0f} ms)")
+    return results
+
+
+def benchmark_touch():
+    """Benchmark per-prompt access touches: wide-row UPDATE + FTS reindex vs memory_access upsert."""
+    print("\n[Micro-benchmark] 2000 prompt touches of 5 memories at 10k rows...")
+    import sqlite3
+    legacy_trigger = """
+        CREATE TRIGGER memories_au AFTER UPDATE ON memories BEGIN
+            INSERT INTO memories_fts(memories_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+            INSERT INTO memories_fts(rowid, content) VALUES (new.rowid, new.content);
+        END
+    """
+    touches = {
+        "UPDATE memories (before)": "UPDATE memories SET access_count = access_count + 1, accessed_at = ? WHERE id IN (?, ?, ?, ?, ?)",
+        "memory_access upsert": """
+            INSERT INTO memory_access (memory_id, hits, touched_at)
+            SELECT id, 1, ? FROM memories WHERE id IN (?, ?, ?, ?, ?)
+            ON CONFLICT (memory_id) DO UPDATE SET hits = hits + 1, touched_at = excluded.touched_at
+        """,
+    }
+    rng = random.Random(7)
+    batches = [[f"mem_{rng.randrange(10_000)}" for _ in range(5)] for _ in range(2000)]
+    results = {}
+    for label, sql in touches.items():
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_path = Path(tmpdir) / "memories.db"
+            freechat.SQLiteMemoryStore(db_path).close()
+            _fill_memories(db_path, 0, 10_000)
+            conn = sqlite3.connect(db_path)
+            if "before" in label:
+                conn.execute(legacy_trigger)
+            start = time.time()
+            for i in range(0, len(batches), 20):  # 20 touches per group commit
+                with conn:
+                    for ids in batches[i:i + 20]:
+                        conn.execute(sql, [time.time(), *ids])
+            results[label] = (time.time() - start) / len(batches)
+            conn.close()
+        print(f"  {label}: {results[label] * 1e6:.0f} us/touch")
+    return results
+
+
+def benchmark_export_import():
+    """Benchmark NDJSON export (streamed) and batched transactional import at 100k and 1M memories."""
+    print("\n[Micro-benchmark] Memory export/import at 100k and 1M rows...")
+    import tracemalloc
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = Path(tmpdir) / "memories.db"
+        export_path = Path(tmpdir) / "memories.ndjson"
+        freechat.SQLiteMemoryStore(db_path).close()
+        filled = 0
+        for size in (100_000, 1_000_000):
+            for start in range(filled, size, 100_000):
+                _fill_memories(db_path, start, start + 100_000)
+            filled = size
+            mm = freechat.MemoryManager(db_path)
+            start = time.time()
+            exported = mm.export_memories(export_path)
+            export_elapsed = time.time() - start
+            tracemalloc.start()  # Second pass for the peak: tracing slows it down
+            mm.export_memories(export_path)
+            export_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            mm.close()
+
+            target = freechat.MemoryManager(Path(tmpdir) / f"import_{size}.db")
+            start = time.time()
+            imported = target.import_memories(export_path)
+            import_elapsed = time.time() - start
+            if size == 100_000:  # Row by row through insert_memory, as imports used to run
+                sample = [freechat.MemoryManager._entry_from_export(json.loads(line))
+                          for line in export_path.open(encoding="utf-8").readlines()[:5000]]
+                rowwise = freechat.MemoryManager(Path(tmpdir) / "rowwise.db")
+                start = time.time()
+                for entry in sample:
+                    rowwise._store.insert_memory(entry)
+                rowwise._store.flush()
+                results["row by row"] = (time.time() - start) / len(sample)
+                rowwise.close()
+                print(f"  row-by-row insert_memory: {results['row by row'] * 1e6:.0f} us/memory")
+            target.close()
+            assert exported == imported == size, (exported, imported)
+            results[size] = (export_elapsed, export_peak, import_elapsed)
+            print(f"  {size:>9} rows: export {export_elapsed:.1f}s (peak {export_peak / 1024:.0f} KB traced), "
+                  f"import {import_elapsed:.1f}s ({import_elapsed / size * 1e6:.0f} us/memory)")
+    return results
+
+
 def main():
     print("FreeChat Performance Test")
     print("=" * 50)
@@ -249,10 +652,55 @@ def main():
         except Exception as e:
             print(f"  Token cache benchmark failed: {e}")
 
+        try:
+            benchmark_history_trimming()
+        except Exception as e:
+            print(f"  History trimming benchmark failed: {e}")
+
+        try:
+            benchmark_group_commit()
+        except Exception as e:
+            print(f"  Group commit benchmark failed: {e}")
+
+        try:
+            benchmark_token_estimator()
+        except Exception as e:
+            print(f"  Token estimator benchmark failed: {e}")
+
         try:
             benchmark_compression_batch()
         except Exception as e:
             print(f"  Compression benchmark failed: {e}")
+
+        try:
+            benchmark_semantic_recall()
+        except Exception as e:
+            print(f"  Semantic recall benchmark failed: {e}")
+
+        try:
+            benchmark_tag_reads()
+        except Exception as e:
+            print(f"  Tag read benchmark failed: {e}")
+
+        try:
+            benchmark_touch()
+        except Exception as e:
+            print(f"  Touch benchmark failed: {e}")
+
+        try:
+            benchmark_hot_query_indexes()
+        except Exception as e:
+            print(f"  Hot query index benchmark failed: {e}")
+
+        try:
+            benchmark_decayed_ranking()
+        except Exception as e:
+            print(f"  Decayed ranking benchmark failed: {e}")
+
+        try:
+            benchmark_export_import()
+        except Exception as e:
+            print(f"  Export/import benchmark failed: {e}")
     else:
         print("\nMicro-benchmarks skipped due to missing dependencies.")
 
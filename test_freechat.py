@@ -8,6 +8,10 @@ Unit tests for FreeChat
 import unittest
 import sys
 import os
+import asyncio
+import json
+import threading
+import sqlite3
 from unittest.mock import patch, MagicMock, AsyncMock
 from pathlib import Path
 
@@ -18,16 +22,56 @@ from freechat import (
     FreeChatApp, ProviderFactory, AIProvider,
     SkillSecurityManager, SkillSandbox, SQLiteMemoryStore,
     ToolRegistry, SkillMetadata, SkillDefinition, ToolParameter,
-    MemoryEntry, TUIOutputBuffer
+    MemoryEntry, TUIOutputBuffer, FramePacer, ScrollbackStore,
+    RenderProfiler, BandwidthBudget, TranscriptIndex,
+    ChatMessage, MessageHistory, TokenCache,
+    TokenizerResolver, TokenEstimator, HistorySummarizer, DocumentIndex,
+    SpeculativeRecall
 )
 
+_module_patches = []
+
+
+def setUpModule():
+    """Run every FreeChatApp against a throwaway portable config directory.
+
+    FreeChatApp uses freechat_config/ next to freechat.py when it exists; the
+    tests point "next to freechat.py" at a temporary directory so no config,
+    log, history or memory database is written into the checkout.
+    """
+    import tempfile
+    import shutil
+    root = Path(tempfile.mkdtemp(prefix="freechat-test-"))
+    (root / "freechat_config").mkdir()
+    patcher = patch('freechat.__file__', str(root / "freechat.py"))
+    patcher.start()
+    _module_patches.append(lambda: (patcher.stop(), shutil.rmtree(root, ignore_errors=True)))
+
+
+def tearDownModule():
+    while _module_patches:
+        _module_patches.pop()()
+
+
+def _portable_config_dir() -> Path:
+    """The temporary freechat_config/ FreeChatApp picks up during the tests (see setUpModule)."""
+    import freechat
+    return Path(freechat.__file__).parent / "freechat_config"
+
+
+def _reset_config_dir(config_dir: Path) -> None:
+    """Empty the test config directory so the next test starts from scratch."""
+    import shutil
+    shutil.rmtree(config_dir, ignore_errors=True)
+    config_dir.mkdir()
+
 class TestFreeChatApp(unittest.TestCase):
     """Test FreeChatApp class"""
     
     def setUp(self):
         """Set up test environment"""
         # Create a temporary config directory for testing
-        self.test_config_dir = Path("test_config")
+        self.test_config_dir = _portable_config_dir()
         self.test_config_dir.mkdir(exist_ok=True)
         
         # Create a minimal config file
@@ -61,16 +105,12 @@ prompt = "You are a test assistant"
                 self.app.current_model = "openrouter/free"
                 self.app.MAX_HISTORY_MESSAGES = 50
                 self.app.session_messages = []
-                from collections import OrderedDict
-                self.app._token_cache = OrderedDict()
+                self.app._token_cache.clear()
     
     def tearDown(self):
         """Clean up test environment"""
-        # Remove temporary config directory
-        if self.test_config_dir.exists():
-            for file in self.test_config_dir.glob('*'):
-                file.unlink()
-            self.test_config_dir.rmdir()
+        # Empty the temporary config directory
+        _reset_config_dir(self.test_config_dir)
     
     def test_init(self):
         """Test initialization"""
@@ -93,6 +133,265 @@ prompt = "You are a test assistant"
         
         self.app._manage_message_history()
         self.assertLessEqual(len(self.app.session_messages), self.app.MAX_HISTORY_MESSAGES)
+
+    def test_history_recounted_after_tokenizer_change(self):
+        """Switching to a model with another tokenizer recounts the history once."""
+        self.app.current_model = "openrouter/anthropic/claude-3.5-sonnet"
+        text = "Switching models should recount this message exactly once. " * 10
+        self.app.session_messages = [{"role": "user", "content": text}]
+        claude_tokens = self.app.session_messages.tokens
+        self.app.current_model = "openrouter/meta-llama/llama-3-70b"
+        self.app._manage_message_history()
+        self.assertEqual(self.app.session_messages.encoding, "estimate:llama")
+        self.assertEqual(self.app.session_messages.tokens, self.app.tokenizer.count(text))
+        self.assertLess(self.app.session_messages.tokens, claude_tokens)
+
+    def test_history_summary_folds_evicted_turns(self):
+        """With history_summary on, evicted turns end up in a summary message."""
+        self.app.history_summary = True
+        self.app.session_messages = [{"role": "system", "content": "sys"}]
+        for i in range(60):
+            self.app.session_messages.append({"role": "user", "content": f"Turn {i} decided something. More."})
+        self.app._manage_message_history()
+        history = self.app.session_messages
+        self.assertLessEqual(len(history), self.app.MAX_HISTORY_MESSAGES + 1)
+        self.assertEqual(history[0]["content"], "sys")
+        self.assertTrue(HistorySummarizer.is_summary(history[1]))
+        self.assertIn("Turn 10 decided something.", history[1]["content"])
+        self.assertEqual(history[2]["content"], "Turn 11 decided something. More.")
+
+        # A second eviction replaces the summary message instead of adding another
+        for i in range(60, 65):
+            self.app.session_messages.append({"role": "user", "content": f"Turn {i} decided something. More."})
+        self.app._manage_message_history()
+        summaries = [m for m in self.app.session_messages if HistorySummarizer.is_summary(m)]
+        self.assertEqual(len(summaries), 1)
+        self.assertIn("Turn 15 decided", summaries[0]["content"])
+
+    def test_history_summary_runs_in_background_with_model(self):
+        """The summary model is called from a background task on the event loop."""
+        provider = MagicMock()
+
+        async def stream_chat(msgs, model):
+            await asyncio.sleep(0)
+            yield "Summary from the cheap model."
+
+        provider.stream_chat = stream_chat
+        self.app.history_summary = True
+        self.app._history_summarizer.model = "openrouter/cheap"
+        self.app.session_messages = [{"role": "system", "content": "sys"}] + [
+            {"role": "user", "content": f"Turn {i}"} for i in range(60)]
+
+        async def run():
+            with patch.object(self.app.provider_factory, 'get_provider', return_value=provider):
+                self.app._manage_message_history()
+                self.assertFalse(HistorySummarizer.is_summary(self.app.session_messages[1]))
+                await self.app._history_summarizer.task
+
+        asyncio.run(run())
+        self.assertEqual(self.app.session_messages[1]["content"],
+                         "[Summary of earlier conversation]\nSummary from the cheap model.")
+
+    def test_history_summary_disabled_by_default(self):
+        self.assertFalse(self.app.history_summary)
+        self.app.session_messages = [{"role": "user", "content": f"Turn {i}"} for i in range(60)]
+        self.app._manage_message_history()
+        self.assertFalse(any(HistorySummarizer.is_summary(m) for m in self.app.session_messages))
+
+    def test_file_upload_indexes_instead_of_injecting(self):
+        """Uploaded files are chunked; prompts get only the relevant parts."""
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "notes.txt"
+            sections = [f"Section {i}: " + ("general filler text " * 50) for i in range(20)]
+            sections[13] = "Section 13: the deployment password rotates every Friday."
+            path.write_text("\n".join(sections), encoding="utf-8")
+            self.app.session_messages = []
+            asyncio.run(self.app._handle_file_command(["upload", str(path)]))
+        self.assertEqual(len(self.app.session_messages), 0)
+        self.assertIn("notes.txt", self.app.documents.documents)
+
+        context = self.app._file_context("When does the deployment password rotate?")
+        self.assertIn("rotates every Friday", context)
+        self.assertLessEqual(self.app._count_tokens(context), self.app.file_context_tokens + 50)
+
+        # No term overlap: fall back to the opening chunks
+        self.assertIn("Section 0", self.app._file_context("qqq"))
+
+        asyncio.run(self.app._handle_file_command(["drop", "notes.txt"]))
+        self.assertEqual(self.app._file_context("password"), "")
+
+    def test_file_context_injected_for_one_request(self):
+        self.app.documents.add("facts.txt", "The launch code is BLUE-42.")
+        sent = []
+
+        class Provider:
+            async def stream_chat(self, msgs, model):
+                sent.append([dict(m) for m in msgs])
+                yield "ok"
+
+            def calculate_cost(self, *args):
+                return None
+
+            def context_length(self, model):
+                return None
+
+        self.app.session_messages = [{"role": "system", "content": "sys"}]
+        with patch.object(self.app.provider_factory, 'get_provider', return_value=Provider()), \
+                patch.object(self.app, '_inject_memory_context', AsyncMock(return_value="")):
+            asyncio.run(self.app._handle_prompt("what is the launch code?"))
+        self.assertTrue(any("BLUE-42" in m["content"] for m in sent[0] if m["role"] == "system"))
+        self.assertFalse(any("BLUE-42" in m["content"] for m in self.app.session_messages))
+
+    def test_memory_context_recalled_off_the_event_loop(self):
+        self.app.memory_manager.remember("The staging server is called hermes", category="fact")
+        threads = []
+        real_recall = self.app.memory_manager.recall
+
+        def recording_recall(*args, **kwargs):
+            threads.append(threading.current_thread().name)
+            return real_recall(*args, **kwargs)
+
+        with patch.object(self.app.memory_manager, 'recall', side_effect=recording_recall):
+            context = asyncio.run(self.app._inject_memory_context("staging server"))
+        self.assertIn("hermes", context)
+        self.assertTrue(threads[0].startswith("freechat-db-"))
+
+    def test_speculative_recall_reused_on_submit(self):
+        self.app.memory_manager.remember("The release train leaves every Thursday", category="fact")
+        self.app.debug = True
+
+        async def main():
+            self.app._speculative_recall.delay = 0.01
+            self.app._speculative_recall.schedule("release train")
+            await asyncio.sleep(0.3)
+            with patch.object(self.app.memory_manager, 'recall', wraps=self.app.memory_manager.recall) as recall:
+                context = await self.app._inject_memory_context("release train")
+            return context, recall.call_count
+
+        with patch.object(self.app._tui_buffer, 'print') as printed:
+            self.app._tui_active = True
+            context, submit_recalls = asyncio.run(main())
+        self.assertIn("Thursday", context)
+        self.assertEqual(submit_recalls, 0)
+        self.assertIn("reused speculative result", printed.call_args_list[0].args[0])
+
+    def test_render_profiler_toggle_keeps_one_lag_probe(self):
+        """Turning F3 off and on within one probe interval does not start a second probe."""
+        probes = []
+
+        def create_background_task(coro):
+            probes.append(asyncio.get_running_loop().create_task(coro))
+            return probes[-1]
+
+        async def main():
+            self.app._tui_app = MagicMock()
+            self.app._tui_app.create_background_task.side_effect = create_background_task
+            with patch('freechat.Console.print'):
+                self.app._toggle_render_profiler()
+                await asyncio.sleep(0.01)
+                self.app._toggle_render_profiler()
+                self.app._toggle_render_profiler()
+                await asyncio.sleep(0.01)
+                self.assertEqual([task.done() for task in probes], [True, False])
+                self.app._toggle_render_profiler()
+                await asyncio.sleep(0)
+                self.assertTrue(probes[1].done())
+
+        asyncio.run(main())
+        self.app._tui_app = None
+
+    def test_speculative_recall_survives_input_submit(self):
+        """Submitting through the input buffer clears it without dropping the pending recall."""
+        from prompt_toolkit.layout.controls import BufferControl
+        self.app.memory_manager.remember("The release train leaves every Thursday", category="fact")
+        self.app.speculative_recall = True
+        self.app._tui_app = self.app._build_tui_layout()
+        input_buffer = next(w.content.buffer for w in self.app._tui_app.layout.find_all_windows()
+                            if isinstance(w.content, BufferControl) and w.content.buffer.accept_handler)
+        dispatched = []
+
+        async def dispatch(text):
+            dispatched.append(await self.app._speculative_recall.take(text))
+
+        async def main():
+            self.app._speculative_recall.delay = 0.01
+            input_buffer.text = "when does the release train leave"
+            await asyncio.sleep(0.3)
+            with patch.object(self.app, '_tui_dispatch', side_effect=dispatch):
+                input_buffer.validate_and_handle()
+                await asyncio.sleep(0.05)
+
+        asyncio.run(main())
+        self.assertEqual(input_buffer.text, "")
+        result, _ = dispatched[0]
+        self.assertIsNotNone(result)
+        self.assertIn("Thursday", result[0].content)
+        self.assertEqual(self.app._speculative_recall.hits, 1)
+
+    def _provider_with_context(self, length):
+        from freechat import OpenAIProvider
+        provider = OpenAIProvider("key", "https://openrouter.ai/api/v1", "openrouter")
+        provider.context_lengths = {"free": length}
+        return provider
+
+    def test_context_budget_unknown_model_uses_fixed_budget(self):
+        with patch.object(self.app.provider_factory, 'get_provider', return_value=None):
+            budget = self.app._plan_context_budget()
+        self.assertIsNone(budget.context_length)
+        self.assertEqual(budget.history, self.app.MAX_HISTORY_TOKENS)
+
+    def test_context_budget_from_provider_context_length(self):
+        """Large windows get a large history; reserves are subtracted."""
+        self.app.session_messages = [{"role": "system", "content": "You are helpful."}]
+        provider = self._provider_with_context(128000)
+        with patch.object(self.app.provider_factory, 'get_provider', return_value=provider):
+            budget = self.app._plan_context_budget()
+        self.assertEqual(budget.source, "provider")
+        self.assertEqual(budget.completion, self.app.MAX_COMPLETION_RESERVE)
+        self.assertEqual(budget.system, self.app.session_messages[0].tokens)
+        self.assertEqual(budget.history, 128000 - budget.completion - budget.memory - budget.tools - budget.system)
+        tools = self.app.tool_registry.get_schemas_for_provider("openrouter")
+        self.assertEqual(budget.tools, self.app._count_tokens(json.dumps(tools)) if tools else 0)
+
+    def test_context_budget_small_window(self):
+        provider = self._provider_with_context(4096)
+        with patch.object(self.app.provider_factory, 'get_provider', return_value=provider):
+            budget = self.app._plan_context_budget()
+        self.assertEqual(budget.completion, 1024)
+        self.assertLess(budget.history, 4096 - 1024)
+        self.assertGreaterEqual(budget.history, self.app.MIN_HISTORY_TOKENS)
+
+    def test_context_budget_config_overrides(self):
+        provider = self._provider_with_context(128000)
+        self.app.config["context"] = {"max_history_tokens": 20000, "models": {
+            "openrouter/free": {"context_length": 8192, "completion_tokens": 2000}}}
+        with patch.object(self.app.provider_factory, 'get_provider', return_value=provider):
+            budget = self.app._plan_context_budget()
+            self.assertEqual((budget.context_length, budget.source, budget.completion), (8192, "config", 2000))
+            self.app.config["context"]["models"]["openrouter/free"] = {"history_tokens": 1500}
+            self.assertEqual(self.app._plan_context_budget().history, 1500)
+            self.app.config["context"]["models"] = {}
+            self.assertEqual(self.app._plan_context_budget().history, 20000)
+
+    def test_history_trimmed_to_model_budget(self):
+        provider = self._provider_with_context(2000)
+        self.app.config["context"] = {"models": {"openrouter/free": {"history_tokens": 300}}}
+        self.app.session_messages = [{"role": "user", "content": "word " * 100} for _ in range(10)]
+        with patch.object(self.app.provider_factory, 'get_provider', return_value=provider):
+            self.app._manage_message_history()
+        self.assertLessEqual(self.app.session_messages.tokens, 300)
+        self.assertGreater(len(self.app.session_messages), 0)
+
+    def test_session_messages_counted_in_one_batch(self):
+        """Assigning a loaded session counts all messages in one batch call."""
+        messages = [{"role": "system", "content": "sys"}] + [
+            {"role": "user", "content": f"Message {i}"} for i in range(20)]
+        with patch.object(self.app, '_count_tokens_batch', return_value=[2] * 21) as batch:
+            self.app.session_messages = messages
+        batch.assert_called_once()
+        self.assertIsInstance(self.app.session_messages, MessageHistory)
+        self.assertEqual(self.app.session_messages.tokens, 40)
     
     def test_handle_model_command(self):
         """Test model command handling"""
@@ -113,6 +412,24 @@ prompt = "You are a test assistant"
             self.assertTrue(any('Error' in str(c) for c in calls))
             self.assertTrue(any('Available providers' in str(c) for c in calls))
     
+    def test_memory_edit_reports_duplicate(self):
+        """Editing a memory into another's content is refused and names the existing memory."""
+        import tempfile
+        from freechat import MemoryManager
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        mm = self.app.memory_manager = MemoryManager(Path(temp_dir.name) / "memories.db")
+        self.addCleanup(mm.close)
+        first = mm.remember("The staging server is called hermes")
+        second = mm.remember("The staging server is called apollo")
+        with patch('freechat.Console.print') as mock_print:
+            asyncio.run(self.app._handle_memory_command(["edit", second, "the", "staging", "server", "is", "called", "HERMES"]))
+        mock_print.assert_called_with(f"[yellow]Memory '{second}' not updated: duplicate of {first}.[/yellow]")
+        self.assertEqual(mm._store.get_memory(second).content, "The staging server is called apollo")
+        self.assertFalse(mm.update_memory(second, content="The staging server is called hermes"))
+        self.assertTrue(mm.update_memory(second, content="The staging server is called zeus"))
+        self.assertIsNone(mm.duplicate_of(second, "The staging server is called zeus"))
+
     def test_handle_session_command(self):
         """Test session command handling"""
         # Test session new command
@@ -129,7 +446,8 @@ prompt = "You are a test assistant"
             self.app._count_tokens(text)
         
         # Check that cache size is limited
-        self.assertLessEqual(len(self.app._token_cache), 1000)
+        self.assertLessEqual(self.app._token_cache.bytes, self.app.MAX_TOKEN_CACHE_BYTES)
+        self.assertLessEqual(len(self.app._token_cache), self.app.MAX_TOKEN_CACHE_BYTES // TokenCache.ENTRY_BYTES)
     
     def test_handle_language_command(self):
         """Test language command handling"""
@@ -373,6 +691,540 @@ openai_api_key = "config_openai_key"
         self.assertEqual(assistant_msgs[0]["content"], "Hello, world!")
 
 
+class TestTokenizerResolver(unittest.TestCase):
+    """Test per-model tokenizer selection."""
+
+    def test_encoding_names(self):
+        cases = {
+            "openai/gpt-4o-mini": "o200k_base",
+            "openrouter/openai/gpt-4o": "o200k_base",
+            "openai/o3-mini": "o200k_base",
+            "openai/gpt-4.1": "o200k_base",
+            "openai/gpt-4-turbo": "cl100k_base",
+            "openrouter/openai/gpt-3.5-turbo:free": "cl100k_base",
+            "openrouter/anthropic/claude-3.5-sonnet": None,
+            "gemini/gemini-1.5-pro": None,
+            "openrouter/free": None,
+        }
+        for model, expected in cases.items():
+            self.assertEqual(TokenizerResolver.encoding_name(model), expected, model)
+
+    def test_non_openai_models_get_family_estimator(self):
+        resolver = TokenizerResolver()
+        tokenizer = resolver.resolve("openrouter/anthropic/claude-3.5-sonnet")
+        self.assertIsInstance(tokenizer, TokenEstimator)
+        self.assertEqual(tokenizer.name, "estimate:claude")
+        default = resolver.resolve("nvidia/some-model")
+        self.assertEqual(default.name, "estimate:default")
+        text = "Family scales adjust the estimate for other tokenizers. " * 5
+        self.assertGreater(len(tokenizer.encode(text)), len(default.encode(text)))
+
+    def test_openai_fallback_uses_encoding_calibration(self):
+        self.assertEqual(TokenizerResolver.estimator_for("openai/gpt-4o").name, "estimate:o200k_base")
+        self.assertEqual(TokenizerResolver.estimator_for("openai/gpt-4").name, "estimate:cl100k_base")
+
+    def test_encodings_loaded_lazily_once_per_process(self):
+        """Encodings load in the background; the estimator stands in until ready."""
+        fake = MagicMock()
+        fake.name = "o200k_base"
+        gate = threading.Event()
+
+        def slow_load(name):
+            gate.wait(5)
+            return fake
+
+        with patch.dict(TokenizerResolver._encodings, clear=True):
+            with patch('freechat.tiktoken.get_encoding', side_effect=slow_load) as get_encoding:
+                resolver = TokenizerResolver()
+                get_encoding.assert_not_called()
+                self.assertIsInstance(resolver.resolve("openai/gpt-4o"), TokenEstimator)
+                gate.set()
+                self.assertTrue(TokenizerResolver.wait("o200k_base", timeout=5))
+                self.assertIs(resolver.resolve("openai/gpt-4o"), fake)
+                self.assertIs(TokenizerResolver().resolve("openai/o1"), fake)
+                get_encoding.assert_called_once_with("o200k_base")
+
+    def test_failed_encoding_falls_back_to_estimator(self):
+        with patch.dict(TokenizerResolver._encodings, clear=True):
+            with patch('freechat.tiktoken.get_encoding', side_effect=OSError("offline")) as get_encoding:
+                TokenizerResolver.preload("cl100k_base")
+                TokenizerResolver.wait("cl100k_base", timeout=5)
+                tokenizer = TokenizerResolver().resolve("openai/gpt-4")
+                TokenizerResolver().resolve("openai/gpt-4-turbo")
+        self.assertIsInstance(tokenizer, TokenEstimator)
+        get_encoding.assert_called_once()
+
+    def test_offline_mode_never_downloads(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp, \
+                patch.dict(os.environ, {"TIKTOKEN_CACHE_DIR": tmp}), \
+                patch.dict(TokenizerResolver._encodings, clear=True), \
+                patch.object(TokenizerResolver, 'offline', True), \
+                patch('freechat.tiktoken.get_encoding') as get_encoding:
+            self.assertIsNone(TokenizerResolver.load_encoding("cl100k_base"))
+        get_encoding.assert_not_called()
+
+    def test_configure_installs_vendored_bpe_files(self):
+        """Vendored <encoding>.tiktoken files are placed where tiktoken looks for them."""
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp, patch.dict(os.environ, {}, clear=False):
+            os.environ.pop("TIKTOKEN_CACHE_DIR", None)
+            vendored = Path(tmp) / "vendored"
+            vendored.mkdir()
+            (vendored / "cl100k_base.tiktoken").write_bytes(b"bpe data")
+            with patch.object(TokenizerResolver, 'offline', False):
+                TokenizerResolver.configure([vendored], Path(tmp) / "cache", offline=True)
+                self.assertTrue(TokenizerResolver.offline)
+            self.assertEqual(os.environ["TIKTOKEN_CACHE_DIR"], str(Path(tmp) / "cache"))
+            cached = TokenizerResolver.cached_bpe_path("cl100k_base")
+            self.assertEqual(cached.read_bytes(), b"bpe data")
+            self.assertFalse(TokenizerResolver.cached_bpe_path("o200k_base").exists())
+
+
+CALIBRATION_SAMPLES = {
+    # name: (text, allowed relative error) -- bounds documented on TokenEstimator
+    "english": ((
+        "The committee met on Tuesday to review the proposal for the new library. After a long "
+        "discussion about funding, location and opening hours, the members agreed to postpone the "
+        "final vote until the next meeting, when updated cost estimates would be available. Several "
+        "residents spoke in favour of the plan, arguing that the town had waited far too long for a "
+        "modern public space where children could study after school."), 0.20),
+    "python": ((
+        "def manage_history(messages, max_tokens=4000):\n"
+        "    \"\"\"Trim the oldest messages until the budget holds.\"\"\"\n"
+        "    total = sum(m['tokens'] for m in messages)\n"
+        "    while messages and total > max_tokens:\n"
+        "        removed = messages.pop(0)\n"
+        "        total -= removed['tokens']\n"
+        "    return [m for m in messages if m.get('role') != 'system'], total\n\n"
+        "for i, line in enumerate(open('data.csv', encoding='utf-8')):\n"
+        "    if i % 100 == 0:\n"
+        "        print(f'{i:>6}: {line.strip()[:40]}')\n"), 0.20),
+    "chinese": ((
+        "人工智能正在深刻地改变我们的工作和生活方式。从自动驾驶汽车到智能语音助手，从医疗影像诊断到金融风险控制，"
+        "机器学习技术已经渗透到社会的各个领域。然而，随着技术的快速发展，数据隐私、算法偏见和就业结构变化等问题"
+        "也日益引起人们的关注。我们需要在推动创新的同时，建立完善的法律法规和伦理框架。"), 0.30),
+    "japanese": ((
+        "東京は日本の首都であり、世界でも有数の大都市です。毎年多くの観光客が訪れ、浅草寺や東京タワー、"
+        "渋谷のスクランブル交差点などの名所を楽しんでいます。また、東京には美味しいレストランがたくさんあり、"
+        "寿司やラーメン、天ぷらなど、さまざまな日本料理を味わうことができます。"), 0.30),
+    "korean": ((
+        "서울은 대한민국의 수도이자 가장 큰 도시입니다. 한강을 중심으로 발전한 이 도시는 오랜 역사와 현대적인 "
+        "문화가 공존하는 곳으로, 경복궁과 같은 전통 궁궐과 높은 빌딩이 함께 어우러져 있습니다. 많은 관광객들이 "
+        "맛있는 음식과 쇼핑을 즐기기 위해 서울을 방문합니다."), 0.30),
+    "russian": ((
+        "Москва является столицей России и одним из крупнейших городов Европы. Здесь находятся Кремль, "
+        "Красная площадь и множество музеев, театров и парков. Каждый год город посещают миллионы туристов, "
+        "которые хотят познакомиться с его богатой историей и культурой, а также попробовать блюда русской кухни."), 0.40),
+    "arabic": ((
+        "القاهرة هي عاصمة مصر وأكبر مدينة في العالم العربي. تقع المدينة على ضفاف نهر النيل، وتضم العديد من "
+        "المعالم التاريخية مثل الأهرامات وأبو الهول والمتحف المصري. يزور المدينة ملايين السياح كل عام للاستمتاع "
+        "بتاريخها العريق وثقافتها الغنية."), 0.40),
+}
+
+# Reference counts from tiktoken 0.14 for CALIBRATION_SAMPLES, so the bounds
+# are checked even where the BPE files cannot be downloaded.
+REFERENCE_TOKEN_COUNTS = {
+    "cl100k_base": {
+        "english": 77, "python": 122, "chinese": 170, "japanese": 140,
+        "korean": 145, "russian": 152, "arabic": 152,
+    },
+}
+
+
+def _load_reference_encoding(name):
+    """Load a tiktoken encoding only if its BPE file is already cached (no download)."""
+    import tiktoken
+    if not TokenizerResolver.cached_bpe_path(name).exists():
+        return None
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception:
+        return None
+
+
+class TestTokenEstimator(unittest.TestCase):
+    """Test the byte-class token estimator."""
+
+    def setUp(self):
+        self.estimator = TokenEstimator("test")
+
+    def test_empty_and_short_texts(self):
+        self.assertEqual(self.estimator.count(""), 0)
+        self.assertEqual(self.estimator.count("a"), 1)
+        self.assertEqual(len(self.estimator.encode("hello world")), self.estimator.count("hello world"))
+
+    def test_english_ratio(self):
+        text, _ = CALIBRATION_SAMPLES["english"]
+        chars_per_token = len(text) / self.estimator.count(text)
+        self.assertTrue(3.5 < chars_per_token < 5.0, chars_per_token)
+
+    def test_cjk_counts_per_character(self):
+        text, _ = CALIBRATION_SAMPLES["chinese"]
+        tokens = self.estimator.count(text)
+        self.assertTrue(0.8 * len(text) < tokens < 1.4 * len(text), tokens)
+        o200k = TokenEstimator("test", "o200k_base").count(text)
+        self.assertLess(o200k, tokens)
+
+    def test_digit_runs_grouped_by_three(self):
+        self.assertIn(self.estimator.count("123456789"), (3, 4))
+        self.assertGreater(self.estimator.count("1 2 3 4 5 6"), self.estimator.count("123456"))
+
+    def test_word_boundaries_matter(self):
+        self.assertGreater(self.estimator.count("a b c d e f g h"), self.estimator.count("abcdefgh"))
+
+    def test_calibrated_against_reference_counts(self):
+        """Estimates stay within the documented bounds of the recorded encoder counts."""
+        for name, counts in REFERENCE_TOKEN_COUNTS.items():
+            estimator = TokenEstimator(name, name)
+            for sample, (text, bound) in CALIBRATION_SAMPLES.items():
+                actual = counts[sample]
+                error = abs(estimator.count(text) - actual) / actual
+                self.assertLessEqual(error, bound, f"{name}/{sample}: {error:.0%} off ({actual} tokens)")
+
+    def test_calibrated_against_tiktoken(self):
+        """Estimates stay within the documented bounds of the real encodings (when cached locally)."""
+        checked = 0
+        for name in ("cl100k_base", "o200k_base"):
+            encoding = _load_reference_encoding(name)
+            if encoding is None:
+                continue
+            estimator = TokenEstimator(name, name)
+            for sample, (text, bound) in CALIBRATION_SAMPLES.items():
+                actual = len(encoding.encode(text))
+                if name in REFERENCE_TOKEN_COUNTS:
+                    self.assertEqual(actual, REFERENCE_TOKEN_COUNTS[name][sample], f"{name}/{sample}")
+                error = abs(estimator.count(text) - actual) / actual
+                self.assertLessEqual(error, bound, f"{name}/{sample}: {error:.0%} off ({actual} tokens)")
+            checked += 1
+        if not checked:
+            self.skipTest("tiktoken BPE files not available locally")
+
+
+class TestDocumentIndex(unittest.TestCase):
+    """Test BM25 retrieval over attached files."""
+
+    def setUp(self):
+        self.index = DocumentIndex()
+        self.index.add("guide.md", "\n".join([
+            "# Installation\nRun pip install freechat and set your API key.",
+            "# Memory\nMemories are stored in SQLite with full-text search.",
+            "# Skills\nSkills add tools that the model can call.",
+        ]))
+
+    def test_split_respects_chunk_size(self):
+        text = "\n".join(f"line {i} " + "x" * 80 for i in range(100))
+        chunks = DocumentIndex.split(text)
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(c) <= DocumentIndex.CHUNK_CHARS for c in chunks))
+        self.assertEqual("".join(chunks), text)
+        self.assertEqual(len(DocumentIndex.split("y" * 3000)), 3)
+
+    def test_search_ranks_relevant_chunk_first(self):
+        index = DocumentIndex()
+        index.add("a.txt", "\n".join(f"filler paragraph {i} about nothing in particular" for i in range(200)))
+        index.add("b.txt", "The SQLite database uses FTS5 for memory search.")
+        results = index.search("how does memory search work in sqlite?")
+        self.assertEqual(results[0][1].document, "b.txt")
+        self.assertEqual(index.search("no overlapping words here zzz"), [])
+
+    def test_cjk_terms_per_character(self):
+        self.assertEqual(DocumentIndex.terms("数据库 SQLite"), ["数", "据", "库", "sqlite"])
+        self.index.add("zh.txt", "我们使用数据库保存记忆。")
+        self.assertEqual(self.index.search("数据库")[0][1].document, "zh.txt")
+
+    def test_drop_removes_postings(self):
+        self.assertTrue(self.index.drop("guide.md"))
+        self.assertFalse(self.index.drop("guide.md"))
+        self.assertEqual(len(self.index), 0)
+        self.assertEqual(self.index._postings, {})
+        self.assertEqual(self.index.search("memory"), [])
+
+    def test_readding_replaces_document(self):
+        self.index.add("guide.md", "Completely new text.")
+        self.assertEqual(len(self.index.chunks("guide.md")), 1)
+        self.assertEqual(self.index.search("sqlite"), [])
+
+
+class TestSpeculativeRecall(unittest.TestCase):
+    """Test debounced recall while typing."""
+
+    def setUp(self):
+        self.queries = []
+
+        async def recall(text):
+            self.queries.append(text)
+            await asyncio.sleep(0.02)
+            return [f"memory for {text}"]
+
+        self.spec = SpeculativeRecall(recall, delay=0.01)
+
+    def test_debounce_recalls_final_draft_only(self):
+        async def main():
+            for draft in ("how do I", "how do I deploy", "how do I deploy the app"):
+                self.spec.schedule(draft)
+                await asyncio.sleep(0.001)
+            await asyncio.sleep(0.1)
+            return await self.spec.take("how do I deploy the app")
+
+        result, saved = asyncio.run(main())
+        self.assertEqual(self.queries, ["how do I deploy the app"])
+        self.assertEqual(result, ["memory for how do I deploy the app"])
+        self.assertGreater(saved, 0.0)
+        self.assertEqual((self.spec.hits, self.spec.misses), (1, 0))
+
+    def test_close_enough_prompt_reuses_result(self):
+        async def main():
+            self.spec.schedule("deploy the staging server today")
+            await asyncio.sleep(0.1)
+            return await self.spec.take("deploy the staging server today?")
+
+        result, _ = asyncio.run(main())
+        self.assertEqual(result, ["memory for deploy the staging server today"])
+
+    def test_different_prompt_misses(self):
+        async def main():
+            self.spec.schedule("deploy the staging server")
+            await asyncio.sleep(0.1)
+            return await self.spec.take("what is the weather like in Paris")
+
+        self.assertEqual(asyncio.run(main()), (None, 0.0))
+        self.assertEqual(self.spec.misses, 1)
+
+    def test_in_flight_recall_is_awaited(self):
+        async def main():
+            self.spec.schedule("explain the memory compression")
+            await asyncio.sleep(0.015)  # Debounce over, recall running
+            return await self.spec.take("explain the memory compression")
+
+        result, _ = asyncio.run(main())
+        self.assertEqual(result, ["memory for explain the memory compression"])
+        self.assertEqual(len(self.queries), 1)
+
+    def test_still_debouncing_is_cancelled(self):
+        async def main():
+            self.spec.delay = 1.0
+            self.spec.schedule("explain the memory compression")
+            return await self.spec.take("explain the memory compression")
+
+        self.assertEqual(asyncio.run(main()), (None, 0.0))
+        self.assertEqual(self.queries, [])
+
+    def test_commands_and_short_drafts_ignored(self):
+        async def main():
+            self.spec.schedule("/memory list")
+            self.spec.schedule("hi")
+            await asyncio.sleep(0.05)
+            return await self.spec.take("hi")
+
+        self.assertEqual(asyncio.run(main()), (None, 0.0))
+        self.assertEqual(self.queries, [])
+
+
+class TestTokenCache(unittest.TestCase):
+    """Test the digest-keyed token cache."""
+
+    def test_keys_are_fixed_size_and_per_encoding(self):
+        short = TokenCache.key("hi", "cl100k_base")
+        long = TokenCache.key("x" * 100000, "cl100k_base")
+        self.assertEqual(len(short[0]), TokenCache.DIGEST_SIZE)
+        self.assertEqual(len(long[0]), TokenCache.DIGEST_SIZE)
+        self.assertNotEqual(short, TokenCache.key("hi", "o200k_base"))
+
+    def test_byte_capacity_evicts_lru(self):
+        cache = TokenCache(max_bytes=TokenCache.ENTRY_BYTES * 3)
+        keys = [TokenCache.key(f"text {i}", "enc") for i in range(4)]
+        for i, key in enumerate(keys[:3]):
+            cache.put(key, i)
+        cache.get(keys[0])  # Refresh the oldest entry
+        cache.put(keys[3], 3)
+        self.assertEqual(len(cache), 3)
+        self.assertIsNone(cache.get(keys[1]))
+        self.assertEqual(cache.get(keys[0]), 0)
+
+    def test_hit_rate(self):
+        cache = TokenCache()
+        key = TokenCache.key("hello", "enc")
+        self.assertIsNone(cache.get(key))
+        cache.put(key, 1)
+        cache.get(key)
+        cache.get(key)
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 1))
+        self.assertAlmostEqual(stats["hit_rate"], 2 / 3)
+
+    def test_app_call_sites_share_cache(self):
+        """Single and batch counting hit the same cache entries."""
+        tokenizer = MagicMock()
+        tokenizer.name = "fake"
+        tokenizer.encode.side_effect = lambda text: text.split()
+        tokenizer.encode_batch.side_effect = lambda texts: [t.split() for t in texts]
+        app = FreeChatApp.__new__(FreeChatApp)
+        app.current_model = "openai/gpt-4o"
+        app._tokenizer_resolver = MagicMock()
+        app._tokenizer_resolver.resolve.return_value = tokenizer
+        app._token_cache = TokenCache()
+        self.assertEqual(app._count_tokens("a b c"), 3)
+        self.assertEqual(app._count_tokens_batch(["a b c", "d e"]), [3, 2])
+        tokenizer.encode_batch.assert_called_once_with(["d e"])
+        self.assertEqual(app._count_tokens("d e"), 2)
+        self.assertEqual(tokenizer.encode.call_count, 1)
+        self.assertEqual(app._token_cache.hits, 2)
+
+
+class TestMessageHistory(unittest.TestCase):
+    """Test incremental token accounting for session history."""
+
+    def setUp(self):
+        self.calls = []
+
+        def count_batch(texts):
+            self.calls.append(len(texts))
+            return [len(t.split()) for t in texts]
+
+        self.history = MessageHistory([{"role": "system", "content": "be brief"}], count_batch)
+
+    def test_running_total_excludes_system(self):
+        self.history.append({"role": "user", "content": "one two three"})
+        self.history.insert(1, {"role": "system", "content": "memory context here"})
+        self.history.append(ChatMessage(role="assistant", content="ignored", tokens=5))
+        self.assertEqual(self.history.tokens, 8)
+        self.history.remove({"role": "system", "content": "memory context here"})
+        self.history.pop()
+        self.assertEqual(self.history.tokens, 3)
+
+    def test_messages_serialize_as_plain_dicts(self):
+        self.history.append({"role": "user", "content": "hello there"})
+        self.assertEqual(self.history[1].tokens, 2)
+        self.assertEqual(json.loads(json.dumps(self.history))[1], {"role": "user", "content": "hello there"})
+
+    def test_each_message_counted_once(self):
+        self.history.extend({"role": "user", "content": f"msg {i}"} for i in range(10))
+        self.calls.clear()
+        self.history.trim(max_messages=5, max_tokens=100)
+        self.history.trim(max_messages=5, max_tokens=100)
+        self.assertEqual(self.calls, [])
+
+    def test_trim_by_count_keeps_system_prompt(self):
+        self.history.extend({"role": "user", "content": f"msg {i}"} for i in range(10))
+        dropped = self.history.trim(max_messages=5, max_tokens=1000)
+        self.assertEqual(dropped, 6)
+        self.assertEqual(len(self.history), 5)
+        self.assertEqual(self.history[0]["role"], "system")
+        self.assertEqual(self.history[1]["content"], "msg 6")
+        self.assertEqual(self.history.tokens, 8)
+
+    def test_trim_by_tokens(self):
+        for i in range(10):
+            self.history.append({"role": "user", "content": "a b c"})
+        self.history.trim(max_messages=100, max_tokens=10)
+        self.assertEqual(self.history.tokens, 9)
+        self.assertEqual(len(self.history), 4)
+
+    def test_slice_delete_and_clear(self):
+        self.history.extend({"role": "user", "content": "x y"} for _ in range(4))
+        del self.history[1:3]
+        self.assertEqual(self.history.tokens, 4)
+        self.history.clear()
+        self.assertEqual(self.history.tokens, 0)
+
+    def test_evict_returns_dropped_and_keeps_leading_system(self):
+        self.history.append({"role": "system", "content": "[Summary of earlier conversation]\nold"})
+        self.history.extend({"role": "user", "content": f"msg {i}"} for i in range(6))
+        evicted = self.history.evict(max_messages=6, max_tokens=1000)
+        self.assertEqual([m["content"] for m in evicted], ["msg 0", "msg 1"])
+        self.assertEqual(self.history[1]["role"], "system")
+        self.assertEqual(self.history[2]["content"], "msg 2")
+        self.assertEqual(self.history.tokens, 8)
+
+
+class TestHistorySummarizer(unittest.TestCase):
+    """Test rolling summaries of evicted history."""
+
+    def setUp(self):
+        self.summarizer = HistorySummarizer(max_tokens=40, count=lambda text: len(text.split()))
+
+    def test_extractive_keeps_first_sentence_per_turn(self):
+        self.summarizer.fold_extractive([
+            {"role": "user", "content": "We will use PostgreSQL. It scales better than the alternatives."},
+            {"role": "assistant", "content": "Agreed.\nI'll draft the schema next."},
+        ])
+        self.assertEqual(self.summarizer.summary,
+                         "- user: We will use PostgreSQL.\n- assistant: Agreed.")
+
+    def test_summary_stays_within_budget(self):
+        for i in range(30):
+            self.summarizer.add([{"role": "user", "content": f"Decision number {i} was made. Details follow."}])
+        asyncio.run(self.summarizer.fold())
+        self.assertLessEqual(len(self.summarizer.summary.split()), 40)
+        self.assertIn("Decision number 29", self.summarizer.summary)
+        self.assertNotIn("Decision number 0 ", self.summarizer.summary)
+        self.assertEqual(self.summarizer.pending, [])
+
+    def test_model_summary_replaces_digest(self):
+        provider = MagicMock()
+        requests = []
+
+        async def stream_chat(msgs, model):
+            requests.append((msgs, model))
+            yield "The user chose PostgreSQL."
+
+        provider.stream_chat = stream_chat
+        self.summarizer.summary = "Earlier: project kickoff."
+        self.summarizer.add([{"role": "user", "content": "Use PostgreSQL"}])
+        asyncio.run(self.summarizer.fold(provider, "cheap-model"))
+        self.assertEqual(self.summarizer.summary, "The user chose PostgreSQL.")
+        msgs, model = requests[0]
+        self.assertEqual(model, "cheap-model")
+        self.assertIn("Earlier: project kickoff.", msgs[1]["content"])
+        self.assertIn("user: Use PostgreSQL", msgs[1]["content"])
+
+    def test_model_failure_falls_back_to_extractive(self):
+        provider = MagicMock()
+
+        async def stream_chat(msgs, model):
+            raise RuntimeError("rate limited")
+            yield
+
+        provider.stream_chat = stream_chat
+        self.summarizer.add([{"role": "user", "content": "Keep the API stable. Really."}])
+        with self.assertLogs('FreeChat', level='WARNING'):
+            asyncio.run(self.summarizer.fold(provider, "cheap-model"))
+        self.assertEqual(self.summarizer.summary, "- user: Keep the API stable.")
+
+    def test_load_restores_summary_from_session(self):
+        self.summarizer.pending = [{"role": "user", "content": "stale"}]
+        self.summarizer.load([{"role": "system", "content": "sys"},
+                              self.summarizer.message() | {"content": "[Summary of earlier conversation]\nkept"}])
+        self.assertEqual(self.summarizer.summary, "kept")
+        self.assertEqual(self.summarizer.pending, [])
+        self.assertEqual(self.summarizer.message()["content"], "[Summary of earlier conversation]\nkept")
+
+    def test_load_cancels_fold_of_previous_session(self):
+        """A fold started before the session was replaced does not overwrite its summary."""
+        provider = MagicMock()
+        release = None
+
+        async def stream_chat(msgs, model):
+            await release.wait()
+            yield "Summary of the old session."
+
+        async def run():
+            nonlocal release
+            release = asyncio.Event()
+            provider.stream_chat = stream_chat
+            self.summarizer.add([{"role": "user", "content": "Old session turn."}])
+            task = self.summarizer.task = asyncio.create_task(self.summarizer.fold(provider, "cheap-model"))
+            await asyncio.sleep(0)
+            self.summarizer.load([{"role": "system", "content": "sys"}])
+            release.set()
+            await asyncio.gather(task, return_exceptions=True)
+
+        asyncio.run(run())
+        self.assertEqual(self.summarizer.summary, "")
+        self.assertIsNone(self.summarizer.task)
+
+
 class TestProviderFactory(unittest.TestCase):
     """Test ProviderFactory class"""
     
@@ -465,6 +1317,20 @@ class TestMemoryEntry(unittest.TestCase):
         self.assertLessEqual(score, 1.0)
         self.assertGreater(entry.value_score, 0.0)
 
+    def test_value_key_orders_like_decayed_value(self):
+        """Test that value_key ranks memories by their decayed value at any time"""
+        from freechat import MemoryEntry
+        half_life = MemoryEntry.VALUE_HALF_LIFE
+        old = MemoryEntry(created_at=1_000_000.0, value_score=0.9)
+        new = MemoryEntry(created_at=1_000_000.0 + half_life, value_score=0.5)
+        self.assertAlmostEqual(old.decayed_value(now=old.created_at + half_life), 0.45)
+        self.assertAlmostEqual(new.decayed_value(now=new.created_at), 0.5)
+        self.assertAlmostEqual(MemoryEntry.value_at(old.value_key, old.created_at + 2 * half_life), 0.225)
+        for now in (new.created_at, new.created_at + 10 * half_life):
+            self.assertEqual(old.value_key > new.value_key, old.decayed_value(now) > new.decayed_value(now))
+        self.assertLess(old.value_key, new.value_key)
+        self.assertLess(MemoryEntry(value_score=0.0).decayed_value(), 1e-5)
+
 
 class TestAuctionEngine(unittest.TestCase):
     """Test AuctionEngine class"""
@@ -1323,6 +2189,314 @@ class TestSQLiteMemoryStore(unittest.TestCase):
             tags=tags or [], branch=branch, original_length=len(content)
         )
 
+    def test_work_runs_on_database_thread(self):
+        """Sync calls from any thread are executed by the store's own thread."""
+        threads = []
+        real_get_connection = self.store._get_connection
+
+        def recording_get_connection():
+            threads.append(threading.current_thread().name)
+            return real_get_connection()
+
+        with patch.object(self.store, '_get_connection', side_effect=recording_get_connection):
+            self.store.insert_memory(self._make_entry())
+            self.store.search_memories("test")
+            worker = threading.Thread(target=self.store.get_stats)
+            worker.start()
+            worker.join()
+        self.assertEqual(len(threads), 3)
+        self.assertEqual(len(set(threads)), 1)
+        self.assertTrue(threads[0].startswith("freechat-db-"))
+
+    def test_constructor_opens_no_connection_on_calling_thread(self):
+        """Schema setup runs on the database thread; the constructing thread holds no connection."""
+        from freechat import SQLiteMemoryStore
+        connecting = []
+        real_connect = sqlite3.connect
+
+        def recording_connect(*args, **kwargs):
+            connecting.append(threading.get_ident())
+            return real_connect(*args, **kwargs)
+
+        with patch('freechat.sqlite3.connect', side_effect=recording_connect):
+            store = SQLiteMemoryStore(Path(self.temp_dir) / "fresh.db")
+        try:
+            self.assertIsNone(getattr(store._local, 'connection', None))
+            self.assertEqual(connecting, [store._db_thread_id])
+        finally:
+            store.close()
+
+    def test_database_thread_recognised_by_identity(self):
+        """Only the executor's own thread counts as the database thread, whatever its name."""
+        self.assertTrue(self.store._get_executor().submit(self.store._in_db_thread).result())
+        results = []
+        impostor = threading.Thread(target=lambda: results.append(self.store._in_db_thread()),
+                                    name=self.store._thread_name + "_0")
+        impostor.start()
+        impostor.join()
+        self.assertEqual(results, [False])
+        self.assertFalse(self.store._in_db_thread())
+        self.store.close()
+        self.assertIsNone(self.store._db_thread_id)
+
+    def test_run_does_not_block_event_loop(self):
+        import time
+
+        def slow_query():
+            time.sleep(0.2)
+            return self.store.get_stats()
+
+        async def main():
+            ticks = 0
+
+            async def ticker():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+
+            task = asyncio.create_task(ticker())
+            stats = await self.store.run(slow_query)
+            task.cancel()
+            return ticks, stats
+
+        ticks, stats = asyncio.run(main())
+        self.assertGreater(ticks, 5)
+        self.assertEqual(stats["total_memories"], 0)
+
+    def _trace_commits(self):
+        commits = []
+        conn = self.store._get_executor().submit(self.store._get_connection).result()
+        conn.set_trace_callback(lambda sql: commits.append(sql) if sql.upper().startswith("COMMIT") else None)
+        return commits
+
+    def test_writes_grouped_into_one_commit(self):
+        commits = self._trace_commits()
+        for i in range(20):
+            self.store.insert_memory(self._make_entry(id=f"mem_{i}"))
+        self.store.delete_memory("mem_3")
+        self.assertEqual(commits, [])
+        self.assertEqual(self.store.flush(), 21)
+        self.assertEqual(len(commits), 1)
+
+    def test_reads_see_pending_writes(self):
+        import sqlite3
+        self.store.insert_memory(self._make_entry(content="pending write"))
+        self.assertIsNotNone(self.store.get_memory("mem_1"))
+        self.assertEqual(len(self.store.search_memories("pending")), 1)
+        other = sqlite3.connect(str(self.db_path))
+        try:
+            self.assertEqual(other.execute("SELECT COUNT(*) FROM memories").fetchone()[0], 0)
+            self.store.flush()
+            self.assertEqual(other.execute("SELECT COUNT(*) FROM memories").fetchone()[0], 1)
+        finally:
+            other.close()
+
+    def test_group_commit_size_and_interval_triggers(self):
+        import time
+        commits = self._trace_commits()
+        self.store.GROUP_COMMIT_SIZE = 5
+        for i in range(5):
+            self.store.insert_memory(self._make_entry(id=f"mem_{i}"))
+        self.assertEqual(len(commits), 1)
+        self.store.insert_memory(self._make_entry(id="mem_late"))
+        time.sleep(self.store.GROUP_COMMIT_INTERVAL * 5)
+        self.assertEqual(len(commits), 2)
+
+    def test_failed_write_rolls_back_alone(self):
+        self.store.insert_memory(self._make_entry(id="mem_1"))
+        self.assertFalse(self.store.insert_memory(self._make_entry(id="mem_1", content="duplicate")))
+        self.store.insert_memory(self._make_entry(id="mem_2", content="other content"))
+        self.store.flush()
+        self.assertEqual(self.store.get_memory("mem_1").content, "test content")
+        self.assertIsNotNone(self.store.get_memory("mem_2"))
+
+    def test_second_store_waits_for_pending_group(self):
+        """A store sharing the file waits for the other's group commit instead of failing as locked."""
+        from freechat import SQLiteMemoryStore
+        self.store.insert_memory(self._make_entry(id="mem_1"))
+        other = SQLiteMemoryStore(self.db_path)
+        try:
+            self.assertTrue(other.insert_memory(self._make_entry(id="mem_2", content="other content")))
+            other.flush()
+            self.assertIsNotNone(self.store.get_memory("mem_2"))
+        finally:
+            other.close()
+
+    def test_close_flushes_pending_writes(self):
+        from freechat import SQLiteMemoryStore
+        self.store.insert_memory(self._make_entry())
+        self.store.close()
+        reopened = SQLiteMemoryStore(self.db_path)
+        try:
+            self.assertIsNotNone(reopened.get_memory("mem_1"))
+        finally:
+            reopened.close()
+
+    def test_timer_flush_after_close_does_not_restart(self):
+        self.store.insert_memory(self._make_entry())
+        timer = self.store._flush_timer
+        self.store.close()
+        self.assertTrue(timer.finished.is_set())  # Cancelled
+        self.store._timer_flush()  # A timer that fired just as close() ran
+        self.assertIsNone(self.store._executor)
+        self.assertIsNone(self.store._flush_timer)
+
+    def test_plan_fts_query_is_syntax_safe(self):
+        plan = self.store.plan_fts_query
+        self.assertEqual(plan('What is "deploy-pipeline": NOT working?'),
+                         '"deploy"* OR "pipeline"* OR "working"*')
+        self.assertEqual(plan("the api"), '"api"')
+        self.assertEqual(plan("what is it"), '"what"* OR "is" OR "it"')  # Only stop words: keep them
+        self.assertEqual(plan("?!:-"), "")
+        self.assertEqual(plan("Python python PYTHON"), '"python"*')
+
+    def test_search_survives_chat_punctuation(self):
+        self.store.insert_memory(self._make_entry(content="The deploy pipeline runs on Fridays"))
+        with self.assertNoLogs(level='ERROR'):
+            for prompt in ("Why isn't the deploy pipeline running?", 'deploy AND "pipeline', "pipeline: OR NOT -x",
+                           "column:content deploy*", "(deploy"):
+                results = self.store.search_memories(prompt)
+                self.assertEqual([m.id for m in results], ["mem_1"], prompt)
+        self.assertEqual(self.store.search_memories("???"), [])
+
+    def test_search_ranked_by_relevance_and_value(self):
+        for i in range(20):  # bm25's IDF needs a corpus to tell terms apart
+            self.store.insert_memory(self._make_entry(id=f"filler_{i}", content=f"Unrelated filler note {i}"))
+        self.store.insert_memory(self._make_entry(id="weak", importance=10,
+                                 content="Meeting notes: lunch menu, parking, and one pipeline remark"))
+        strong = self._make_entry(id="strong", importance=1, content="Deploy pipeline: deploy steps for the pipeline")
+        strong.compute_value_score()
+        self.store.insert_memory(strong)
+        weak = self.store.get_memory("weak")
+        weak.compute_value_score()
+        self.store.update_memory(weak)
+        self.assertEqual([m.id for m in self.store.search_memories("deploy pipeline")], ["strong", "weak"])
+        # Without relevance, value score decides
+        self.assertEqual([m.id for m in self.store.search_memories("", limit=2)], ["weak", "strong"])
+
+    def test_whole_term_match_beats_prefix_match(self):
+        """Equal bm25 and value: the literal match ranks first even when the prefix match is newer."""
+        self.store.insert_memory(self._make_entry(id="exact", content="We deploy on Fridays"))
+        self.store.insert_memory(self._make_entry(id="prefix", content="Deployment happens after review"))
+        self.assertEqual([m.id for m in self.store.search_memories("deploy")], ["exact", "prefix"])
+        self.assertEqual([m.id for m in self.store.advanced_search("deploy")], ["exact", "prefix"])
+
+    def test_search_is_one_statement(self):
+        self.store.insert_memory(self._make_entry(content="deploy pipeline"))
+        statements = []
+        conn = self.store._get_executor().submit(self.store._get_connection).result()
+        conn.set_trace_callback(statements.append)
+        self.store.search_memories("deploy pipeline?")
+        conn.set_trace_callback(None)
+        statements = [sql for sql in statements if not sql.startswith("--")]  # Drop FTS5 internals
+        self.assertEqual(len(statements), 1)
+        self.assertIn("MATCH", statements[0])
+
+    def test_tags_read_from_column(self):
+        self.store.insert_memory(self._make_entry(content="deploy pipeline", tags=["ops, infra", "ci"]))
+        self.store.insert_memory(self._make_entry(id="mem_2", content="deploy docs", tags=["docs"]))
+        statements = []
+        conn = self.store._get_executor().submit(self.store._get_connection).result()
+        conn.set_trace_callback(statements.append)
+        results = {
+            "get": [self.store.get_memory("mem_1")],
+            "search": self.store.search_memories("deploy"),
+            "list": self.store.search_memories(""),
+            "advanced": self.store.advanced_search("deploy", tags=["ci"]),
+            "similar": self.store.find_similar("deploy pipeline"),
+        }
+        conn.set_trace_callback(None)
+        for name, memories in results.items():
+            with self.subTest(name):
+                tags = {m.id: m.tags for m in memories}
+                self.assertEqual(tags["mem_1"], ["ops, infra", "ci"])
+        self.assertFalse([sql for sql in statements if "GROUP_CONCAT" in sql or "GROUP BY m.id" in sql])
+
+    def test_tags_column_follows_updates(self):
+        self.store.insert_memory(self._make_entry(tags=["a"]))
+        entry = self.store.get_memory("mem_1")
+        entry.tags = ["b", "c"]
+        self.store.update_memory(entry)
+        self.assertEqual(self.store.get_memory("mem_1").tags, ["b", "c"])
+        self.store.insert_memory(self._make_entry(id="mem_2", tags=["d"]))  # Same content: merged
+        self.assertEqual(sorted(self.store.get_memory("mem_1").tags), ["b", "c", "d"])
+
+    def test_tags_column_filled_for_existing_databases(self):
+        import sqlite3
+        from freechat import SQLiteMemoryStore
+        self.store.insert_memory(self._make_entry(tags=["x", "y"]))
+        self.store.close()
+        with sqlite3.connect(self.db_path) as conn:  # Downgrade to the schema before memories.tags
+            conn.execute("ALTER TABLE memories DROP COLUMN tags")
+        self.store = SQLiteMemoryStore(self.db_path)
+        self.assertEqual(sorted(self.store.get_memory("mem_1").tags), ["x", "y"])
+
+    def test_non_content_updates_skip_fts(self):
+        from freechat import MemoryManager
+        mm = MemoryManager(self.db_path)
+        self.store.close()
+        self.store = mm._store
+        memory_id = mm.remember("deploy pipeline runs nightly", tags=["ops"])
+        entry = self.store.get_memory(memory_id)
+        statements = []
+        conn = self.store._get_executor().submit(self.store._get_connection).result()
+        conn.set_trace_callback(statements.append)
+        mm.touch_memories([memory_id])
+        mm.update_memory(memory_id, tags=["ops", "ci"], importance=9)
+        self.store.batch_update_compression([entry])
+        self.store.restore_memory(memory_id)
+        conn.set_trace_callback(None)
+        self.assertFalse([sql for sql in statements if "memories_fts" in sql])
+        self.assertFalse([sql for sql in statements if "UPDATE memories" in sql and "access" in sql])
+
+    def test_content_update_reindexes_fts(self):
+        self.store.insert_memory(self._make_entry(content="deploy pipeline"))
+        entry = self.store.get_memory("mem_1")
+        entry.content = "lunch menu"
+        self.store.update_memory(entry)
+        self.assertEqual(self.store.search_memories("deploy"), [])
+        self.assertEqual([m.id for m in self.store.search_memories("lunch")], ["mem_1"])
+
+    def test_access_counts_live_in_side_table(self):
+        from freechat import MemoryManager
+        mm = MemoryManager(self.db_path)
+        self.store.close()
+        self.store = mm._store
+        entry = self._make_entry(content="imported memory")
+        entry.access_count, entry.last_accessed = 3, 1000.0
+        self.store.insert_memory(entry)
+        self.store.insert_memory(self._make_entry(id="mem_2", content="other memory"))
+        self.assertEqual(self.store.get_memory("mem_1").access_count, 3)
+        mm.touch_memories(["mem_1", "missing"])
+        mm.touch_memory("mem_1")
+        touched = self.store.get_memory("mem_1")
+        self.assertEqual(touched.access_count, 5)
+        self.assertGreater(touched.last_accessed, 1000.0)
+        self.assertEqual([m.id for m in self.store.get_recent_memories()], ["mem_1"])
+        mm.update_memory("mem_1", content="imported memory, edited")
+        self.assertEqual(self.store.get_memory("mem_1").access_count, 5)
+
+    def test_legacy_fts_trigger_is_replaced(self):
+        import sqlite3
+        from freechat import SQLiteMemoryStore
+        self.store.close()
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("""CREATE TRIGGER memories_au AFTER UPDATE ON memories BEGIN
+                INSERT INTO memories_fts(memories_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+                INSERT INTO memories_fts(rowid, content) VALUES (new.rowid, new.content);
+            END""")
+        self.store = SQLiteMemoryStore(self.db_path)
+        with sqlite3.connect(self.db_path) as conn:
+            triggers = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+        self.assertNotIn("memories_au", triggers)
+        self.assertIn("memories_content_au", triggers)
+
+    def test_reusable_after_close(self):
+        self.store.insert_memory(self._make_entry())
+        self.store.close()
+        self.assertIsNotNone(self.store.get_memory("mem_1"))
+
     def test_init_creates_db(self):
         self.assertTrue(self.db_path.exists())
 
@@ -1390,7 +2564,7 @@ class TestSQLiteMemoryStore(unittest.TestCase):
 
     def test_clear_all(self):
         self.store.insert_memory(self._make_entry())
-        self.store.insert_memory(self._make_entry(id="mem_2"))
+        self.store.insert_memory(self._make_entry(id="mem_2", content="other content"))
         count = self.store.clear_all_memories()
         self.assertEqual(count, 2)
         self.assertIsNone(self.store.get_memory("mem_1"))
@@ -1404,10 +2578,64 @@ class TestSQLiteMemoryStore(unittest.TestCase):
         archived = self.store.archive_old_memories(min_score=0.5, days_old=30)
         self.assertEqual(archived, 1)
 
+    def test_archive_uses_decayed_value(self):
+        import time
+        old = self._make_entry(id="old", content="old memory")
+        old.created_at = time.time() - 100 * 86400  # Three half-lives: 0.8 -> 0.08
+        old.value_score = 0.8
+        new = self._make_entry(id="new", content="new memory")
+        new.created_at = time.time() - 40 * 86400
+        new.value_score = 0.8
+        self.store.insert_memory(old)
+        self.store.insert_memory(new)
+        self.assertEqual(self.store.archive_old_memories(min_score=0.3, days_old=30), 1)
+        self.assertEqual([m.id for m in self.store.search_memories("")], ["new"])
+
+    def test_listings_rank_by_decayed_value(self):
+        import time
+        stale = self._make_entry(id="stale", content="stale but once valuable")
+        stale.created_at = time.time() - 60 * 86400  # 0.9 -> 0.225
+        stale.value_score = 0.9
+        fresh = self._make_entry(id="fresh", content="fresh and middling")
+        fresh.value_score = 0.5
+        for entry in (stale, fresh):
+            self.store.insert_memory(entry)
+        self.assertEqual([m.id for m in self.store.search_memories("")], ["fresh", "stale"])
+        self.assertEqual([m.id for m in self.store.advanced_search("", min_score=0.3)], ["fresh"])
+        loaded = self.store.get_memory("stale")
+        self.assertEqual(loaded.value_score, 0.9)  # Stored undecayed
+        self.assertAlmostEqual(loaded.decayed_value(), 0.225, places=3)
+        self.assertEqual([m.id for m in self.store.search_memories("valuable middling")], ["fresh", "stale"])
+
+    def test_value_key_filled_for_existing_databases(self):
+        import sqlite3
+        import time
+        from freechat import SQLiteMemoryStore
+        stale = self._make_entry(id="stale", content="stale")
+        stale.created_at, stale.value_score = time.time() - 60 * 86400, 0.9
+        fresh = self._make_entry(id="fresh", content="fresh")
+        fresh.value_score = 0.5
+        for entry in (stale, fresh):
+            self.store.insert_memory(entry)
+        self.store.close()
+        with sqlite3.connect(self.db_path) as conn:  # Downgrade to value_score ordering
+            conn.execute("DROP INDEX idx_memories_active_value")
+            conn.execute("DROP INDEX idx_memories_active_category_value")
+            conn.execute("ALTER TABLE memories DROP COLUMN value_key")
+            conn.execute("CREATE INDEX idx_memories_active_value ON memories(branch, value_score DESC) WHERE is_archived = 0")
+        self.store = SQLiteMemoryStore(self.db_path)
+        self.assertEqual([m.id for m in self.store.search_memories("")], ["fresh", "stale"])
+        self.store.close()
+        with sqlite3.connect(self.db_path) as conn:
+            keys = dict(conn.execute("SELECT id, value_key FROM memories"))
+            index_sql = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'idx_memories_active_value'").fetchone()[0]
+        self.assertAlmostEqual(keys["stale"], stale.value_key)
+        self.assertIn("value_key", index_sql)
+
     def test_get_all_categories(self):
         self.store.insert_memory(self._make_entry(category="knowledge"))
-        self.store.insert_memory(self._make_entry(id="mem_2", category="knowledge"))
-        self.store.insert_memory(self._make_entry(id="mem_3", category="preference"))
+        self.store.insert_memory(self._make_entry(id="mem_2", content="content 2", category="knowledge"))
+        self.store.insert_memory(self._make_entry(id="mem_3", content="content 3", category="preference"))
         cats = self.store.get_all_categories()
         cat_dict = dict(cats)
         self.assertEqual(cat_dict["knowledge"], 2)
@@ -1423,6 +2651,11 @@ class TestSQLiteMemoryStore(unittest.TestCase):
         result = SQLiteMemoryStore._escape_fts5_query(['test"quote'])
         self.assertIn('""', result)
 
+    def test_escape_fts5_query_prefixes(self):
+        from freechat import SQLiteMemoryStore
+        self.assertEqual(SQLiteMemoryStore._escape_fts5_query(["deploy", "ci"], prefix_min_length=4), '"deploy"* OR "ci"')
+        self.assertEqual(SQLiteMemoryStore.plan_fts_query('deploy "ci"'), '"deploy"* OR "ci"')
+
     def test_batch_update_compression(self):
         import time as time_mod
         entry = self._make_entry()
@@ -1470,8 +2703,8 @@ class TestSQLiteMemoryStore(unittest.TestCase):
 
     def test_get_related_memories(self):
         self.store.insert_memory(self._make_entry(tags=["python", "code"]))
-        self.store.insert_memory(self._make_entry(id="mem_2", tags=["python", "tutorial"]))
-        self.store.insert_memory(self._make_entry(id="mem_3", tags=["java"]))
+        self.store.insert_memory(self._make_entry(id="mem_2", content="content 2", tags=["python", "tutorial"]))
+        self.store.insert_memory(self._make_entry(id="mem_3", content="content 3", tags=["java"]))
         related = self.store.get_related_memories("mem_1")
         # mem_2 shares "python" tag
         self.assertTrue(any(r.id == "mem_2" for r in related))
@@ -1495,6 +2728,196 @@ class TestSQLiteMemoryStore(unittest.TestCase):
         store2.close()
 
 
+class TestVectorIndex(unittest.TestCase):
+    """Test VectorIndex and semantic recall in SQLiteMemoryStore"""
+
+    def setUp(self):
+        import tempfile
+        from freechat import SQLiteMemoryStore
+        self.temp_dir = tempfile.mkdtemp()
+        self.db_path = Path(self.temp_dir) / "test_vectors.db"
+        self.store = SQLiteMemoryStore(self.db_path, semantic=True)
+
+    def tearDown(self):
+        import shutil
+        self.store.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def _insert(self, id, content, branch=None):
+        from freechat import MemoryEntry
+        self.store.insert_memory(MemoryEntry(id=id, content=content, category="test", branch=branch))
+
+    def _ids(self, query, **kwargs):
+        return [m.id for m in self.store.search_memories(query, **kwargs)]
+
+    def test_embedding_is_deterministic_unit_vector(self):
+        from freechat import VectorIndex
+        vector = VectorIndex.embed("The deployment pipeline runs nightly")
+        self.assertEqual(len(vector), VectorIndex.DIM)
+        self.assertAlmostEqual(sum(x * x for x in vector), 1.0, places=4)
+        self.assertEqual(vector, VectorIndex.from_blob(VectorIndex.to_blob(VectorIndex.embed("The deployment pipeline runs nightly"))))
+        self.assertFalse(any(VectorIndex.embed("?!")))
+
+    def test_index_add_replace_remove(self):
+        import freechat
+        from freechat import VectorIndex
+        for use_numpy in (True, False):
+            with self.subTest(use_numpy=use_numpy), \
+                    patch('freechat.np', freechat.np if use_numpy else None):
+                index = VectorIndex()
+                index.add("a", VectorIndex.embed("kubernetes cluster"))
+                index.add("b", VectorIndex.embed("lunch at noon"))
+                self.assertEqual(index.search(VectorIndex.embed("kubernetes"), 5)[0][0], "a")
+                index.add("a", VectorIndex.embed("dinner at seven"))
+                self.assertEqual(index.search(VectorIndex.embed("kubernetes"), 5), [])
+                index.remove("b")
+                index.add("c", VectorIndex.embed("lunch at noon"))
+                self.assertEqual(len(index), 2)
+                self.assertEqual([key for key, _ in index.search(VectorIndex.embed("lunch"), 5)], ["c"])
+
+    def test_recall_without_shared_literal_terms(self):
+        self._insert("mem_deploy", "The deployment pipeline runs nightly on Hetzner")
+        self._insert("mem_k8s", "Kubernetes cluster lives in eu-west")
+        self._insert("mem_lunch", "Lunch is at noon")
+        self.assertEqual(self._ids("deploying"), ["mem_deploy"])
+        self.assertEqual(self._ids("kubernets config"), ["mem_k8s"])
+        self.assertEqual(self._ids("release train"), [])
+
+    def test_semantic_hits_obey_filters(self):
+        self._insert("mem_global", "The deployment pipeline runs nightly")
+        self._insert("mem_branch", "The deployment pipeline runs hourly", branch="feature/x")
+        self.assertEqual(self._ids("deploying"), ["mem_global"])
+        self.assertEqual(self._ids("deploying", branch="feature/x"), ["mem_branch"])
+        self.assertEqual([m.id for m in self.store.advanced_search("deploying", category="other")], [])
+
+    def test_fusion_keeps_literal_matches_first(self):
+        self._insert("mem_stem", "Deployment happens after review")
+        self._insert("mem_exact", "We deploy on Fridays")
+        self.assertEqual(self._ids("deploy"), ["mem_exact", "mem_stem"])
+
+    def test_vectors_follow_updates_and_deletes(self):
+        from freechat import MemoryEntry
+        self._insert("mem_1", "Lunch is at noon")
+        self.store.update_memory(MemoryEntry(id="mem_1", content="Kubernetes cluster lives in eu-west", category="test"))
+        self.assertEqual(self._ids("kubernets"), ["mem_1"])
+        self.assertEqual(self._ids("lunches"), [])
+        self.store.delete_memory("mem_1")
+        self.assertEqual(self._ids("kubernets"), [])
+        self.store.flush()
+        with self.store._read() as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM memory_vectors").fetchone()[0], 0)
+
+    def test_missing_vectors_are_backfilled(self):
+        from freechat import SQLiteMemoryStore
+        self.store.close()
+        plain = SQLiteMemoryStore(self.db_path)
+        from freechat import MemoryEntry
+        plain.insert_memory(MemoryEntry(id="mem_old", content="Kubernetes cluster lives in eu-west", category="test"))
+        self.assertEqual(plain.search_memories("kubernets"), [])
+        plain.close()
+        self.store = SQLiteMemoryStore(self.db_path, semantic=True)
+        self.assertEqual(self._ids("kubernets"), ["mem_old"])
+        self.store.flush()
+        with self.store._read() as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM memory_vectors").fetchone()[0], 1)
+
+
+class TestMinHash(unittest.TestCase):
+    """Test MinHash signatures and near-duplicate lookup"""
+
+    def setUp(self):
+        import tempfile
+        from freechat import MemoryManager
+        self.temp_dir = tempfile.mkdtemp()
+        self.mm = MemoryManager(Path(self.temp_dir) / "test_minhash.db")
+        self.store = self.mm._store
+
+    def tearDown(self):
+        import shutil
+        self.mm.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_signature_ignores_order_and_case(self):
+        from freechat import MinHash
+        a = MinHash.signature(MinHash.shingles("User prefers Python over JavaScript"))
+        b = MinHash.signature(MinHash.shingles("over javascript, python: user PREFERS"))
+        self.assertEqual(len(a), MinHash.NUM_PERM)
+        self.assertEqual(a, b)
+        self.assertEqual(len(MinHash.band_keys(a)), MinHash.BANDS)
+        self.assertEqual(MinHash.band_keys(MinHash.signature(MinHash.shingles("?!"))), [])
+
+    def test_signature_agreement_tracks_jaccard(self):
+        from freechat import MinHash
+        a = MinHash.shingles(" ".join(f"w{i}" for i in range(40)))
+        b = MinHash.shingles(" ".join(f"w{i}" for i in range(10, 50)))  # Jaccard 0.6
+        sig_a, sig_b = MinHash.signature(a), MinHash.signature(b)
+        agreement = sum(x == y for x, y in zip(sig_a, sig_b)) / MinHash.NUM_PERM
+        self.assertAlmostEqual(MinHash.jaccard(a, b), 0.6)
+        self.assertAlmostEqual(agreement, 0.6, delta=0.2)
+
+    def test_find_similar_matches_reordered_near_duplicates(self):
+        near = self.mm.remember("The deployment pipeline runs nightly on the build server")
+        self.mm.remember("The build server is rebooted weekly")
+        self.mm.remember("Lunch is at noon")
+        similar = self.mm.find_similar("on the build server the deployment pipeline runs nightly!")
+        self.assertEqual([m.id for m in similar], [near])
+        self.assertEqual(self.mm.find_similar("deployment pipeline"), [])
+
+    def test_find_similar_is_deterministic(self):
+        ids = [self.mm.remember(f"python async code review checklist {word}") for word in ("one", "two", "three")]
+        first = [m.id for m in self.mm.find_similar("python async code review checklist", threshold=0.5)]
+        self.assertEqual(first, sorted(ids))
+        self.assertEqual([m.id for m in self.mm.find_similar("python async code review checklist", threshold=0.5)], first)
+
+    def test_find_similar_follows_updates_and_deletes(self):
+        memory_id = self.mm.remember("Lunch is at noon every day")
+        self.mm.update_memory(memory_id, content="Standup is at nine every day")
+        self.assertEqual(self.mm.find_similar("Lunch is at noon every day"), [])
+        self.assertEqual([m.id for m in self.mm.find_similar("every day standup is at nine")], [memory_id])
+        self.mm.forget(memory_id)
+        self.assertEqual(self.mm.find_similar("Standup is at nine every day"), [])
+
+    def test_memories_without_lsh_keys_are_indexed(self):
+        from freechat import SQLiteMemoryStore
+        import sqlite3
+        memory_id = self.mm.remember("Backups are copied to the NAS hourly")
+        self.store.close()
+        with sqlite3.connect(self.store._db_path) as conn:  # As if stored before memory_lsh existed
+            conn.execute("DELETE FROM memory_lsh")
+        self.mm._store = self.store = SQLiteMemoryStore(self.store._db_path)
+        self.assertEqual([m.id for m in self.mm.find_similar("backups are copied to the NAS hourly")], [memory_id])
+
+    def test_dedupe_on_remember(self):
+        from freechat import MemoryManager
+        self.mm.close()
+        self.mm = MemoryManager(Path(self.temp_dir) / "test_minhash.db", dedupe=True)
+        first = self.mm.remember("User prefers Python over JavaScript")
+        self.assertEqual(self.mm.remember("user prefers python over javascript."), first)
+        self.assertEqual(self.mm._store.get_memory(first).access_count, 1)
+        self.assertNotEqual(self.mm.remember("User prefers Python over JavaScript", branch="feature/x"), first)
+        self.assertNotEqual(self.mm.remember("User prefers Rust"), first)
+        self.assertEqual(self.mm.get_stats()['total_memories'], 3)
+
+    def test_dedupe_finds_match_behind_other_branches(self):
+        """Closer matches on other branches do not hide the near-duplicate on the target branch."""
+        from freechat import MemoryManager
+        self.mm.close()
+        self.mm = MemoryManager(Path(self.temp_dir) / "test_minhash.db", dedupe=True)
+        text = "User prefers Python over JavaScript for scripting tasks"
+        for i in range(6):
+            self.mm.remember(text, branch=f"feature/{i}")
+        own = self.mm.remember(text + " today", branch="main")
+        self.assertEqual(self.mm.remember(text, branch="main"), own)
+        self.assertEqual(self.mm.get_stats()['total_memories'], 7)
+        similar = self.mm._store.find_similar(text, branch="main")
+        self.assertEqual([m.id for m in similar], [own])
+        self.assertEqual(self.mm._store.find_similar(text, branch=None), [])
+
+    def test_no_near_dedupe_by_default(self):
+        first = self.mm.remember("User prefers Python over JavaScript")
+        self.assertNotEqual(self.mm.remember("User prefers Python over JavaScript."), first)
+
+
 class TestMemoryManagerExtended(unittest.TestCase):
     """Test extended MemoryManager methods"""
 
@@ -1579,6 +3002,75 @@ class TestMemoryManagerExtended(unittest.TestCase):
         self.assertEqual(stats['total_memories'], 2)
         mm2.close()
 
+    def test_export_streams_every_branch_as_ndjson(self):
+        import json
+        self.mm.remember("archived memory")
+        self.mm._store.archive_old_memories(min_score=2.0, days_old=-1)
+        self.mm.remember("global memory", tags=["a"])
+        self.mm.remember("branch memory", branch="feature/x")
+        long_text = "long memory " * 40
+        compressed = self.mm.remember(long_text)
+        entry = self.mm._store.get_memory(compressed)
+        entry.content_compressed = "long memory... [compressed]"
+        self.mm._store.batch_update_compression([entry])
+
+        export_path = Path(self.temp_dir) / "export.ndjson"
+        self.assertEqual(self.mm.export_memories(export_path), 4)
+        lines = export_path.read_text(encoding="utf-8").splitlines()
+        items = {item["content"]: item for item in map(json.loads, lines)}
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(items["branch memory"]["branch"], "feature/x")
+        self.assertEqual(items["global memory"]["tags"], ["a"])
+        self.assertIn("archived memory", items)
+        self.assertEqual(items[long_text]["content_compressed"], "long memory... [compressed]")
+
+    def test_import_reads_older_json_exports(self):
+        import json
+        export_path = Path(self.temp_dir) / "export.json"
+        export_path.write_text(json.dumps({"memories": [
+            {"content": "memory 1", "tags": ["a"], "branch": "main"},
+            {"content": "memory 2", "importance": 8},
+        ], "export_time": 0}, indent=2), encoding="utf-8")
+        self.assertEqual(self.mm.import_memories(export_path), 2)
+        self.assertEqual(self.mm.recall(query="", branch="main")[0].tags, ["a"])
+
+    def test_import_batches_in_one_transaction(self):
+        from unittest import mock
+        from freechat import MemoryManager, SQLiteMemoryStore
+        for i in range(7):
+            self.mm.remember(f"memory number {i}", tags=[f"t{i}"], branch="main" if i % 2 else None)
+        export_path = Path(self.temp_dir) / "export.ndjson"
+        self.mm.export_memories(export_path)
+
+        mm2 = MemoryManager(Path(self.temp_dir) / "import.db")
+        self.addCleanup(mm2.close)
+        mm2.remember("memory number 3", importance=2, branch="main")  # Already present: only accessed
+        statements, progress = [], []
+        conn = mm2._store._get_executor().submit(mm2._store._get_connection).result()
+        conn.set_trace_callback(statements.append)
+        with mock.patch.object(SQLiteMemoryStore, "IMPORT_BATCH_SIZE", 3):
+            self.assertEqual(mm2.import_memories(export_path, progress.append), 6)
+        conn.set_trace_callback(None)
+        self.assertEqual(progress, [3, 6, 7])
+        self.assertEqual(len([sql for sql in statements if sql.startswith("COMMIT")]), 1)
+        existing = mm2.recall(query="memory number 3", branch="main")[0]
+        self.assertEqual((existing.importance, existing.access_count, existing.tags), (5, 1, ["t3"]))
+        self.assertEqual(mm2.get_stats()['total_memories'], 7)
+        self.assertEqual([m.content for m in mm2.find_similar("memory number 5")], ["memory number 5"])
+        self.assertEqual(mm2.import_memories(export_path), 0)
+        self.assertEqual(len(mm2.recall(query="number", branch="main")), 3)  # Batches reached FTS
+        mm2.remember("written after the import")
+        self.assertEqual(len(mm2.recall(query="written")), 1)  # memories_ai is back
+
+    def test_import_with_bad_line_stores_nothing(self):
+        export_path = Path(self.temp_dir) / "export.ndjson"
+        export_path.write_text('{"content": "memory 1"}\n{"content": "memory 2"}\nnot json\n', encoding="utf-8")
+        with self.assertLogs(level="ERROR"):
+            self.assertEqual(self.mm.import_memories(export_path), 0)
+        self.assertEqual(self.mm.get_stats()['total_memories'], 0)
+        self.mm.remember("memory 1")
+        self.assertEqual(len(self.mm.recall(query="memory")), 1)
+
     def test_get_categories(self):
         self.mm.remember("a", category="knowledge")
         self.mm.remember("b", category="knowledge")
@@ -1645,6 +3137,212 @@ class TestMemoryManagerExtended(unittest.TestCase):
         self.assertIn("compressed", result)
 
 
+class TestContentHashDedupe(unittest.TestCase):
+    """Test exact-duplicate suppression by content hash"""
+
+    def setUp(self):
+        import tempfile
+        from freechat import MemoryManager, BranchMemoryManager
+        self.temp_dir = tempfile.mkdtemp()
+        self.db_path = Path(self.temp_dir) / "test_hash.db"
+        self.mm = MemoryManager(self.db_path)
+        self.store = self.mm._store
+
+    def tearDown(self):
+        import shutil
+        self.mm.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_hash_normalizes_case_and_whitespace(self):
+        from freechat import SQLiteMemoryStore
+        self.assertEqual(SQLiteMemoryStore.content_hash("User  prefers\nPython "),
+                         SQLiteMemoryStore.content_hash("user prefers python"))
+        self.assertNotEqual(SQLiteMemoryStore.content_hash("user prefers python"),
+                            SQLiteMemoryStore.content_hash("user prefers python."))
+
+    def test_duplicate_remember_bumps_existing(self):
+        first = self.mm.remember("User prefers Python", importance=3, tags=["lang"])
+        again = self.mm.remember("user prefers  python", importance=7, tags=["prefs"])
+        self.assertEqual(again, first)
+        entry = self.store.get_memory(first)
+        self.assertEqual(entry.access_count, 1)
+        self.assertEqual(entry.importance, 7)
+        self.assertEqual(sorted(entry.tags), ["lang", "prefs"])
+        self.assertEqual(self.mm.get_stats()['total_memories'], 1)
+
+    def test_duplicate_remember_raises_value(self):
+        import time
+        from freechat import MemoryEntry
+        old = MemoryEntry(id="mem_old", content="User prefers Python", importance=5,
+                          created_at=time.time() - 90 * 86400)
+        old.compute_value_score()
+        self.store.insert_memory(old)
+        self.mm.remember("User prefers Rust", importance=5)
+        self.assertNotEqual(self.store.get_top_memories(limit=1)[0].id, "mem_old")
+
+        self.assertEqual(self.mm.remember("user prefers python", importance=6), "mem_old")
+        top = self.store.get_top_memories(limit=1)[0]
+        self.assertEqual(top.id, "mem_old")
+        self.assertGreater(top.decayed_value(), old.value_score)
+        self.assertEqual(self.store.archive_old_memories(min_score=old.value_score / 2, days_old=30), 0)
+
+    def test_duplicate_restores_archived_memory(self):
+        first = self.mm.remember("User prefers Python")
+        self.assertEqual(self.store.archive_old_memories(min_score=2.0, days_old=-1), 1)
+        self.assertEqual(self.mm.remember("User prefers Python"), first)
+        self.assertEqual(self.mm.get_stats()['archived_memories'], 0)
+
+    def test_branches_are_separate(self):
+        first = self.mm.remember("User prefers Python")
+        self.assertNotEqual(self.mm.remember("User prefers Python", branch="feature/x"), first)
+        self.assertEqual(self.mm.get_stats()['total_memories'], 2)
+
+    def test_repeated_import_and_merge_do_not_multiply(self):
+        from freechat import BranchMemoryManager
+        self.mm.remember("memory 1", branch="feature/a")
+        self.mm.remember("memory 2", branch="feature/a")
+        bm = BranchMemoryManager(self.mm)
+        self.assertEqual(bm.merge_branch_memories("feature/a", "main"), 2)
+        self.assertEqual(bm.merge_branch_memories("feature/a", "main"), 0)
+        self.mm.remember("memory 3", branch="feature/a")
+        self.assertEqual(bm.merge_branch_memories("feature/a", "main"), 1)
+        self.assertEqual(len(self.mm.recall(query="", branch="main")), 3)
+
+        export_path = Path(self.temp_dir) / "export.json"
+        self.mm.remember("global memory")
+        self.mm.export_memories(export_path)
+        self.assertEqual(self.mm.import_memories(export_path), 0)
+        self.assertEqual(self.mm.get_stats()['total_memories'], 7)
+
+    def test_edit_into_existing_content_fails(self):
+        """The conflict is detected up front and reported through duplicate_of, not as a database error."""
+        first = self.mm.remember("User prefers Python")
+        other = self.mm.remember("User prefers Rust")
+        self.assertEqual(self.mm.duplicate_of(other, "user prefers python"), first)
+        with self.assertNoLogs(level="ERROR"):
+            self.assertFalse(self.mm.update_memory(other, content="User prefers Python"))
+        self.assertIsNone(self.mm.duplicate_of(first, "User prefers Python"))
+        self.assertTrue(self.mm.update_memory(first, content="User prefers  PYTHON"))
+
+    def test_existing_duplicates_are_merged_once(self):
+        import sqlite3
+        from freechat import SQLiteMemoryStore
+        self.mm.close()
+        with sqlite3.connect(self.db_path) as conn:  # Downgrade to the schema before content hashes
+            conn.execute("DROP INDEX idx_memories_branch_hash")
+            conn.execute("ALTER TABLE memories DROP COLUMN content_hash")
+            for i, (content, branch, accessed) in enumerate([
+                    ("Deploy on Fridays", None, 100.0), ("deploy on  fridays", None, 300.0),
+                    ("Deploy on Fridays", "feature/x", None), ("Lunch at noon", None, None)]):
+                conn.execute("INSERT INTO memories (id, content, category, branch, created_at, updated_at,"
+                             " accessed_at, access_count, importance) VALUES (?, ?, 'test', ?, ?, ?, ?, 2, ?)",
+                             (f"mem_{i}", content, branch, i, i, accessed, 3 + i))
+                conn.execute("INSERT INTO memory_tags VALUES (?, ?)", (f"mem_{i}", f"tag{i}"))
+        self.store = self.mm._store = SQLiteMemoryStore(self.db_path)
+        self.assertEqual(self.store.get_stats()['total_memories'], 3)
+        kept = self.store.get_memory("mem_0")
+        self.assertIsNone(self.store.get_memory("mem_1"))
+        self.assertEqual((kept.access_count, kept.last_accessed, kept.importance), (4, 300.0, 4))
+        self.assertEqual(sorted(kept.tags), ["tag0", "tag1"])
+        self.assertEqual(self.mm.remember("DEPLOY ON FRIDAYS"), "mem_0")
+
+
+class TestMemoryQueryPlans(unittest.TestCase):
+    """Test that the hot memory reads are served by the idx_memories_active_* indexes"""
+
+    def setUp(self):
+        import tempfile
+        from freechat import MemoryManager
+        self.temp_dir = tempfile.mkdtemp()
+        self.db_path = Path(self.temp_dir) / "test_plans.db"
+        self.mm = MemoryManager(self.db_path)
+        self.store = self.mm._store
+        for i in range(20):
+            self.mm.remember(f"memory number {i}", category=["work", "personal"][i % 2],
+                             tags=["ops"] if i % 3 else [])
+        self.mm.touch_memories([m.id for m in self.mm.recall(limit=5)])
+
+    def tearDown(self):
+        import shutil
+        self.mm.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def _plan(self, call) -> str:
+        """Run call() and return the EXPLAIN QUERY PLAN of its last SELECT, one step per line."""
+        statements = []
+        conn = self.store._get_executor().submit(self.store._get_connection).result()
+        conn.set_trace_callback(statements.append)
+        try:
+            call()
+        finally:
+            conn.set_trace_callback(None)
+        selects = [sql for sql in statements if sql.lstrip().upper().startswith("SELECT")]
+        explain = lambda: conn.execute("EXPLAIN QUERY PLAN " + selects[-1]).fetchall()
+        return "\n".join(row[3] for row in self.store._get_executor().submit(explain).result())
+
+    def assertIndexScan(self, plan: str, index: str):
+        self.assertIn(f"USING INDEX {index} (", plan)
+        self.assertNotIn("USE TEMP B-TREE FOR ORDER BY", plan)
+        self.assertNotIn("SCAN m\n", plan + "\n")
+
+    def test_list_uses_active_value_index(self):
+        plan = self._plan(lambda: self.store.search_memories("", branch=None))
+        self.assertIndexScan(plan, "idx_memories_active_value")
+        plan = self._plan(lambda: self.store.search_memories("", branch="feature"))
+        self.assertIndexScan(plan, "idx_memories_active_value")
+
+    def test_filtered_advanced_search_uses_active_value_index(self):
+        plan = self._plan(lambda: self.store.advanced_search("", min_importance=3, min_score=0.1))
+        self.assertIndexScan(plan, "idx_memories_active_value")
+
+    def test_category_list_uses_category_value_index(self):
+        plan = self._plan(lambda: self.store.search_memories("", category="work"))
+        self.assertIndexScan(plan, "idx_memories_active_category_value")
+
+    def test_recent_reads_both_access_indexes(self):
+        plan = self._plan(lambda: self.store.get_recent_memories(5))
+        self.assertIn("USING INDEX idx_memory_access_touched", plan)
+        self.assertIn("USING INDEX idx_memories_active_accessed", plan)
+        self.assertNotIn("SCAN m\n", plan + "\n")
+
+    def test_recent_order_matches_last_access(self):
+        import time
+        recent = self.mm.get_recent_memories(limit=20)
+        self.assertEqual(len(recent), 5)  # Only touched memories have an access time
+        self.assertEqual([m.last_accessed for m in recent],
+                         sorted((m.last_accessed for m in recent), reverse=True))
+        oldest = recent[-1]
+        self.store.archive_old_memories(min_score=2.0, days_old=-1)
+        self.mm.restore(oldest.id)
+        self.mm.touch_memories([oldest.id])
+        self.assertEqual(self.mm.get_recent_memories(limit=1)[0].id, oldest.id)
+        self.assertLessEqual(self.mm.get_recent_memories(limit=1)[0].last_accessed, time.time())
+
+    def test_categories_use_covering_index(self):
+        plan = self._plan(self.store.get_all_categories)
+        self.assertIn("USING COVERING INDEX idx_memories_active_category", plan)
+
+    def test_related_probes_category_and_tag_indexes(self):
+        memory_id = self.mm.recall(limit=1)[0].id
+        plan = self._plan(lambda: self.store.get_related_memories(memory_id))
+        self.assertIn("USING INDEX idx_memories_active_category (category=?", plan)
+        self.assertIn("USING INDEX idx_memory_tags_tag (tag=?)", plan)
+        self.assertNotIn("SCAN m\n", plan + "\n")
+
+    def test_superseded_indexes_dropped_on_open(self):
+        import sqlite3
+        from freechat import MemoryManager
+        self.mm.close()
+        with sqlite3.connect(self.db_path) as conn:  # An index set from before the active_* ones
+            conn.execute("CREATE INDEX idx_memories_value ON memories(value_score DESC)")
+        self.mm = MemoryManager(self.db_path)
+        self.store = self.mm._store
+        with sqlite3.connect(self.db_path) as conn:
+            names = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        self.assertNotIn("idx_memories_value", names)
+        self.assertIn("idx_memories_active_value", names)
+
+
 class TestBranchMemoryManagerExtended(unittest.TestCase):
     """Test BranchMemoryManager merge/sync methods"""
 
@@ -2030,6 +3728,21 @@ class TestOpenAIProvider(unittest.TestCase):
         cost = p.calculate_cost(1000, 500, "unknown-model")
         self.assertIsNone(cost)
 
+    def test_get_models_keeps_context_length(self):
+        from freechat import OpenAIProvider
+        p = OpenAIProvider("key", "https://openrouter.ai/api/v1", "openrouter")
+        response = MagicMock()
+        response.json.return_value = {"data": [
+            {"id": "meta/llama-3-8b", "context_length": 8192, "pricing": {"prompt": "0", "completion": "0"}},
+            {"id": "mystery/model"},
+        ]}
+        p.http = MagicMock()
+        p.http.get = AsyncMock(return_value=response)
+        _, models = asyncio.run(p.get_models())
+        self.assertEqual(models, ["meta/llama-3-8b", "mystery/model"])
+        self.assertEqual(p.context_length("meta/llama-3-8b"), 8192)
+        self.assertIsNone(p.context_length("mystery/model"))
+
 
 class TestGeminiProvider(unittest.TestCase):
     """Test GeminiProvider class"""
@@ -2187,12 +3900,372 @@ class TestTUIOutputBuffer(unittest.TestCase):
         self.assertIn("AI: ", all_text)
         self.assertIn("response", all_text)
 
+    def test_cursor_follows_bottom(self):
+        """Cursor sits on the last line unless the view is scrolled back."""
+        for i in range(30):
+            self.buf.append_raw(f"line {i}\n")
+        self.assertEqual(self.buf.get_cursor_position().y, 30)
+        self.buf.scroll(-10, window_height=5)
+        self.assertEqual(self.buf.get_cursor_position().y, 15)
+        self.buf.scroll_to_bottom()
+        self.assertEqual(self.buf.get_cursor_position().y, 30)
+
+
+class TestScrollback(unittest.TestCase):
+    """Test disk-backed scrollback for the TUI buffer."""
+
+    def setUp(self):
+        import tempfile
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = Path(self.temp_dir) / "scrollback" / "test.jsonl"
+        self.store = ScrollbackStore(self.path)
+
+    def tearDown(self):
+        import shutil
+        self.store.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def _text(self, buf):
+        return "".join(t[1] for t in buf.get_formatted_text())
+
+    def test_store_roundtrip(self):
+        """Pages are appended to disk and read back by offset."""
+        self.assertFalse(self.path.exists())
+        first = self.store.append([('class:user-label', 'You: '), ('', 'hello\n')])
+        second = self.store.append([('', 'second page')])
+        self.assertEqual((first, second), (0, 1))
+        self.assertEqual(self.store.read(1), [('', 'second page')])
+        self.assertEqual(self.store.read(0)[0], ('class:user-label', 'You: '))
+
+    def test_store_close_removes_file(self):
+        self.store.append([('', 'x')])
+        self.assertTrue(self.path.exists())
+        self.store.close()
+        self.assertFalse(self.path.exists())
+        self.assertEqual(len(self.store), 0)
+
+    def test_eviction_spills_to_disk(self):
+        """Fragments over the cap are spilled instead of discarded."""
+        buf = TUIOutputBuffer(max_history=10, scrollback=self.store)
+        for i in range(50):
+            buf.append_raw(f"line {i}\n")
+        self.assertLessEqual(len(buf._history), 10)
+        self.assertGreater(len(self.store), 0)
+        self.assertNotIn("line 0\n", self._text(buf))
+        self.assertIn("line 49\n", self._text(buf))
+
+    def test_scroll_pages_older_output_back_in(self):
+        """Scrolling past the in-memory window pages content back from disk."""
+        buf = TUIOutputBuffer(max_history=10, scrollback=self.store, max_paged_pages=3)
+        for i in range(100):
+            buf.append_raw(f"line {i}\n")
+        for _ in range(100):
+            buf.scroll(-5, window_height=5)
+            self.assertLessEqual(len(buf._paged), 3)
+        self.assertIn("line 0\n", self._text(buf))
+        self.assertEqual(buf.get_cursor_position().y, 0)
+        # Paging back down returns to the live tail and releases the pages.
+        for _ in range(100):
+            buf.scroll(5, window_height=5)
+        self.assertIsNone(buf._scroll_top)
+        self.assertEqual(len(buf._paged), 0)
+        self.assertIn("line 99\n", self._text(buf))
+
+    def test_scrolled_view_stays_stable_while_spilling(self):
+        """New output spilling old lines does not move a scrolled-back view."""
+        buf = TUIOutputBuffer(max_history=10, scrollback=self.store)
+        for i in range(10):
+            buf.append_raw(f"line {i}\n")
+        buf.scroll(-3, window_height=5)
+        top = buf.get_cursor_position().y
+        for i in range(10, 20):
+            buf.append_raw(f"line {i}\n")
+        self.assertEqual(buf.get_cursor_position().y, top)
+        self.assertIn("line 0\n", self._text(buf))
+
+    def test_clear_truncates_scrollback(self):
+        buf = TUIOutputBuffer(max_history=10, scrollback=self.store)
+        for i in range(50):
+            buf.append_raw(f"line {i}\n")
+        buf.clear()
+        self.assertEqual(len(self.store), 0)
+        self.assertEqual(self.path.stat().st_size, 0)
+
+    def test_find_jumps_into_scrollback(self):
+        """A match spilled to disk is paged back in and placed at the top of the view."""
+        buf = TUIOutputBuffer(max_history=10, scrollback=self.store, max_paged_pages=3)
+        for i in range(100):
+            buf.append_raw(f"line {i}\n")
+        matches = buf.find("line 7")
+        self.assertEqual(matches, [7] + list(range(70, 80)))
+        buf.jump_to_line(matches[0], window_height=5)
+        view = self._text(buf)
+        view_lines = view.split("\n")
+        self.assertEqual(view_lines[buf.get_cursor_position().y + 1], "line 7")
+
+    def test_find_in_live_window(self):
+        buf = TUIOutputBuffer(max_history=10, scrollback=self.store)
+        for i in range(100):
+            buf.append_raw(f"line {i}\n")
+        matches = buf.find("line 98")
+        buf.jump_to_line(matches[0], window_height=8)
+        self.assertEqual(len(buf._paged), 0)
+        view_lines = self._text(buf).split("\n")
+        self.assertEqual(view_lines[buf.get_cursor_position().y + 2], "line 98")
+
+    def test_find_spilled_line_read_from_disk(self):
+        """Spilled lines keep only page postings in memory and are verified from scrollback."""
+        buf = TUIOutputBuffer(max_history=10, scrollback=self.store)
+        buf.append_raw("needle in the ")
+        buf.append_raw("haystack\n")
+        for i in range(200):
+            buf.append_raw(f"line {i}\n")
+        self.assertNotIn(0, buf._index._lines)
+        self.assertLess(len(buf._index), 15)
+        self.assertNotIn(0, {n for lines in buf._index._postings.values() for n in lines})
+        self.assertEqual(buf.find("NEEDLE IN THE HAYSTACK"), [0])
+        self.assertEqual(buf.find("line 123"), [124])
+        self.assertEqual(buf.find("line 1"), [2] + list(range(11, 21)) + list(range(101, 201)))
+
+    def test_short_find_query_stays_in_memory(self):
+        """Queries without trigrams never read scrollback from disk."""
+        buf = TUIOutputBuffer(max_history=10, scrollback=self.store)
+        for i in range(200):
+            buf.append_raw(f"line {i}\n")
+        with patch.object(self.store, 'read', wraps=self.store.read) as read:
+            self.assertEqual(buf.find("19"), list(range(190, 200)))
+        read.assert_not_called()
+
+    def test_find_line_spanning_several_pages(self):
+        """A line split over several spilled pages is stitched back, reading each page once."""
+        buf = TUIOutputBuffer(max_history=10, scrollback=self.store)
+        buf.append_raw("intro\n")
+        for word in ("alpha ", "beta ", "gamma ", "delta\n"):
+            buf._append([('', word)])
+        for i in range(50):
+            buf.append_raw(f"line {i}\n")
+        with patch.object(self.store, 'read', wraps=self.store.read) as read:
+            self.assertEqual(buf.find("alpha beta gamma delta"), [1])
+        pages = [call.args[0] for call in read.call_args_list]
+        self.assertEqual(len(pages), len(set(pages)))
+        self.assertEqual(buf.find("beta gamma"), [1])
+
+    def test_truncated_lines_leave_index(self):
+        """Without scrollback, evicted lines are no longer found."""
+        buf = TUIOutputBuffer(max_history=10)
+        for i in range(50):
+            buf.append_raw(f"line {i}\n")
+        self.assertEqual(buf.find("line 3"), [])
+        self.assertEqual(buf.find("line 49"), [49])
+        self.assertLess(len(buf._index), 15)
+
+
+class TestTranscriptIndex(unittest.TestCase):
+    """Test the trigram index behind /find."""
+
+    def test_lines_split_across_chunks(self):
+        index = TranscriptIndex()
+        for chunk in ["Hel", "lo wor", "ld\nsecond ", "line\nthird"]:
+            index.add_text(chunk)
+        self.assertEqual(index.search("hello world"), [0])
+        self.assertEqual(index.search("LINE"), [1])
+        # The unfinished last line is searchable too.
+        self.assertEqual(index.search("third"), [2])
+
+    def test_short_query_without_trigrams(self):
+        index = TranscriptIndex()
+        index.add_text("ab\ncd\nab cd\n")
+        self.assertEqual(index.search("ab"), [0, 2])
+        self.assertEqual(index.search(""), [])
+
+    def test_trigram_candidates_verified(self):
+        """Lines containing every trigram but not the phrase are rejected."""
+        index = TranscriptIndex()
+        index.add_text("abcd bcde\nabcde\n")
+        self.assertEqual(index.search("abcde"), [1])
+
+    def test_remove_lines_before(self):
+        index = TranscriptIndex()
+        for i in range(10):
+            index.add_text(f"entry {i}\n")
+        index.remove_lines_before(5)
+        self.assertEqual(index.search("entry"), [5, 6, 7, 8, 9])
+        self.assertNotIn(0, {n for lines in index._postings.values() for n in lines})
+
+    def test_spilled_lines_searched_through_reader(self):
+        """Spilled lines drop their text and are verified through the page reader."""
+        index = TranscriptIndex()
+        for i in range(10):
+            index.add_text(f"entry {i}\n")
+        index.spill_lines_before(5, 0)
+        self.assertEqual(len(index), 5)
+        pages = {0: {i: f"Entry {i}" for i in range(5)}}
+        self.assertEqual(index.search("entry 3", pages.get), [3])
+        self.assertEqual(index.search("entry", pages.get), list(range(10)))
+        self.assertEqual(index.search("entry"), [5, 6, 7, 8, 9])
+
+
+class TestFramePacer(unittest.TestCase):
+    """Test adaptive frame pacing for streaming redraws."""
+
+    def test_defaults(self):
+        """Pacer starts from the configured interval and threshold."""
+        pacer = FramePacer(interval=0.05, threshold=128)
+        self.assertEqual(pacer.interval, 0.05)
+        self.assertEqual(pacer.threshold, 128)
+        self.assertAlmostEqual(pacer.fps, 20.0)
+
+    def test_slow_frames_reduce_frame_rate(self):
+        """Expensive terminal writes widen the interval and grow the threshold."""
+        pacer = FramePacer(interval=0.05, threshold=128)
+        for _ in range(20):
+            pacer.record_frame(render_time=0.005, write_time=0.04)
+        self.assertGreater(pacer.interval, 0.05)
+        self.assertGreater(pacer.threshold, 128)
+        self.assertLessEqual(pacer.interval, FramePacer.MAX_INTERVAL)
+        self.assertLessEqual(pacer.threshold, FramePacer.MAX_THRESHOLD)
+
+    def test_fast_frames_increase_frame_rate(self):
+        """Cheap frames shrink the interval down to the floor."""
+        pacer = FramePacer(interval=0.05, threshold=128)
+        for _ in range(20):
+            pacer.record_frame(render_time=0.0005, write_time=0.0001)
+        self.assertAlmostEqual(pacer.interval, FramePacer.MIN_INTERVAL)
+        self.assertLess(pacer.threshold, 128)
+        self.assertGreaterEqual(pacer.threshold, FramePacer.MIN_THRESHOLD)
+
+    def test_should_invalidate_throttles(self):
+        """Redraws are only due once per interval."""
+        pacer = FramePacer(interval=0.05, threshold=128)
+        self.assertTrue(pacer.should_invalidate(now=10.0))
+        self.assertFalse(pacer.should_invalidate(now=10.01))
+        self.assertTrue(pacer.should_invalidate(now=10.06))
+
+    def test_mark_invalidated_spaces_next_frame(self):
+        """A forced redraw postpones the next throttled one."""
+        pacer = FramePacer(interval=0.05, threshold=128)
+        pacer.mark_invalidated(now=5.0)
+        self.assertFalse(pacer.should_invalidate(now=5.02))
+
+    def test_attach_measures_render_cycle(self):
+        """Render hooks feed measurements back into the pacer."""
+        from prompt_toolkit import Application
+        app = Application()
+        pacer = FramePacer()
+        pacer.attach(app)
+        app.before_render.fire()
+        app.output.flush()
+        app.after_render.fire()
+        self.assertEqual(pacer.frames, 1)
+
+
+class TestRenderProfiler(unittest.TestCase):
+    """Test render profiler statistics."""
+
+    def test_disabled_records_nothing(self):
+        profiler = RenderProfiler()
+        profiler.record_formatted(10, 0.01)
+        profiler.record_stream_chunks(5)
+        self.assertEqual(profiler.fragments, 0)
+        self.assertEqual(profiler.stream_chunks_per_second, 0)
+
+    def test_records_formatted_and_stream_rates(self):
+        profiler = RenderProfiler()
+        profiler.enabled = True
+        profiler.record_formatted(42, 0.002)
+        profiler.record_stream_chunks(3)
+        profiler.record_stream_chunks(4)
+        self.assertEqual(profiler.fragments, 42)
+        self.assertAlmostEqual(profiler.stream_chunks_per_second, 7 / RenderProfiler.RATE_WINDOW)
+
+    def test_rates_expire_after_window(self):
+        profiler = RenderProfiler()
+        profiler.enabled = True
+        import time
+        profiler._stream_chunks.append((time.monotonic() - 10, 100))
+        self.assertEqual(profiler.stream_chunks_per_second, 0)
+        self.assertEqual(len(profiler._stream_chunks), 0)
+
+    def test_attach_measures_render_cycle(self):
+        from prompt_toolkit import Application
+        app = Application()
+        profiler = RenderProfiler()
+        profiler.enabled = True
+        profiler.attach(app)
+        app.before_render.fire()
+        app.after_render.fire()
+        app.on_invalidate.fire()
+        self.assertGreater(profiler.frame_time, 0)
+        self.assertGreater(profiler.invalidations_per_second, 0)
+
+    def test_monitor_loop_lag_stops_when_disabled(self):
+        import asyncio
+        profiler = RenderProfiler()
+        profiler.enabled = True
+
+        async def run():
+            task = asyncio.create_task(profiler.monitor_loop_lag())
+            await asyncio.sleep(0.15)
+            profiler.enabled = False
+            await asyncio.wait_for(task, timeout=1)
+
+        asyncio.run(run())
+        self.assertGreaterEqual(profiler.loop_lag, 0)
+
+    def test_overlay_text_lists_metrics(self):
+        text = "".join(t[1] for t in RenderProfiler().get_overlay_text())
+        for label in ("Frame time", "Fragments", "Invalidations", "Loop lag", "Stream chunks"):
+            self.assertIn(label, text)
+
+
+class TestBandwidthBudget(unittest.TestCase):
+    """Test terminal byte metering and redraw budget."""
+
+    def test_budget_blocks_until_refilled(self):
+        budget = BandwidthBudget(bytes_per_second=1000)
+        budget.frame_bytes = 500
+        budget.consume(1000, now=budget._last_refill)
+        self.assertFalse(budget.should_invalidate(now=budget._last_refill + 0.1))
+        self.assertTrue(budget.should_invalidate(now=budget._last_refill + 0.5))
+
+    def test_bucket_capped_at_one_second(self):
+        budget = BandwidthBudget(bytes_per_second=1000)
+        start = budget._last_refill
+        budget.should_invalidate(now=start + 60)
+        self.assertEqual(budget._tokens, 1000)
+
+    def test_huge_frames_still_drawn_once_bucket_full(self):
+        budget = BandwidthBudget(bytes_per_second=100)
+        budget.frame_bytes = 10000
+        self.assertTrue(budget.should_invalidate())
+
+    def test_response_bytes(self):
+        budget = BandwidthBudget()
+        budget.consume(50)
+        budget.start_response()
+        budget.consume(20)
+        budget.consume(5)
+        self.assertEqual(budget.response_bytes, 25)
+        self.assertEqual(budget.bytes_written, 75)
+
+    def test_attach_meters_output_and_frames(self):
+        from prompt_toolkit import Application
+        app = Application()
+        budget = BandwidthBudget()
+        budget.attach(app)
+        app.before_render.fire()
+        app.output.write("héllo")
+        app.output.write_raw("\x1b[0m")
+        app.after_render.fire()
+        self.assertEqual(budget.bytes_written, 10)
+        self.assertLess(budget.frame_bytes, 256)
+
 
 class TestTUIIntegration(unittest.TestCase):
     """Test TUI integration with FreeChatApp."""
 
     def setUp(self):
-        self.test_config_dir = Path("test_config")
+        self.test_config_dir = _portable_config_dir()
         self.test_config_dir.mkdir(exist_ok=True)
         config_content = """
 [general]
@@ -2219,10 +4292,7 @@ prompt = "You are a test assistant"
         self.app.session_messages = []
 
     def tearDown(self):
-        if self.test_config_dir.exists():
-            for file in self.test_config_dir.glob('*'):
-                file.unlink()
-            self.test_config_dir.rmdir()
+        _reset_config_dir(self.test_config_dir)
 
     def test_output_property_returns_console_before_tui(self):
         """output property returns console when TUI is not active."""
@@ -2358,6 +4428,51 @@ prompt = "You are a test assistant"
         with self.app.output.status("loading"):
             pass  # Should not raise
 
+    def test_find_command_highlights_and_reports(self):
+        """/find highlights matches in the chat pane and reports them in the footer."""
+        import asyncio
+        self.app._tui_buffer.append_raw("alpha beta\ngamma\nbeta again\n")
+        pt_app = self.app._build_tui_layout()
+        asyncio.run(self.app._handle_command("/find Beta"))
+        self.assertEqual(self.app._find_matches, [0, 2])
+        self.assertEqual(self.app._find_pos, 1)
+        highlighted = [t[1] for t in self.app._tui_buffer.get_formatted_text() if 'search-match' in t[0]]
+        self.assertEqual(highlighted, ["beta", "beta"])
+        footer = pt_app.layout.container.content.children[3]
+        self.assertIn("2/2", "".join(t[1] for t in footer.content.text()))
+        self.app._find_step(-1)
+        self.assertEqual(self.app._find_pos, 0)
+        asyncio.run(self.app._handle_command("/find"))
+        self.assertFalse(any('search-match' in t[0] for t in self.app._tui_buffer.get_formatted_text()))
+
+    def test_find_dispatch_keeps_view_on_match(self):
+        """Submitting /find leaves the chat view on the match instead of scrolling to the bottom."""
+        import asyncio
+        self.app._tui_buffer.append_raw("needle\n" + "filler\n" * 100)
+        self.app._build_tui_layout()
+        asyncio.run(self.app._tui_dispatch("/find needle"))
+        self.assertIsNotNone(self.app._tui_buffer._scroll_top)
+        asyncio.run(self.app._tui_dispatch("/help"))
+        self.assertIsNone(self.app._tui_buffer._scroll_top)
+
+    def test_find_highlight_spans_fragments(self):
+        buf = self.app._tui_buffer
+        buf.append_raw("stre")
+        buf.append_formatted("class:ai-label", "aming")
+        buf.find("streaming")
+        matched = [t for t in buf.get_formatted_text() if 'search-match' in t[0]]
+        self.assertEqual("".join(t[1] for t in matched), "streaming")
+        self.assertIn("class:ai-label", matched[1][0])
+
+    def test_find_is_incremental_while_typing(self):
+        self.app._tui_buffer.append_raw("needle in a haystack\n")
+        pt_app = self.app._build_tui_layout()
+        input_buffer = pt_app.layout.current_buffer
+        input_buffer.text = "/find nee"
+        self.assertEqual(self.app._find_matches, [0])
+        input_buffer.text = "/find zzz"
+        self.assertEqual(self.app._find_matches, [])
+
     def test_header_shows_model_info(self):
         """TUI header displays current model, prompt, cost, session."""
         from prompt_toolkit import Application
@@ -2370,7 +4485,7 @@ class TestDebugMode(unittest.TestCase):
     """Test debug mode functionality."""
 
     def setUp(self):
-        self.test_config_dir = Path("test_config")
+        self.test_config_dir = _portable_config_dir()
         self.test_config_dir.mkdir(exist_ok=True)
         config_content = """
 [general]
@@ -2389,10 +4504,7 @@ prompt = "You are a test assistant"
             f.write(prompts_content)
 
     def tearDown(self):
-        if self.test_config_dir.exists():
-            for file in self.test_config_dir.glob('*'):
-                file.unlink()
-            self.test_config_dir.rmdir()
+        _reset_config_dir(self.test_config_dir)
 
     def _make_app(self, debug=False):
         import freechat
@@ -2482,6 +4594,66 @@ prompt = "You are a test assistant"
         pt_app = app._build_tui_layout()
         self.assertIsNotNone(pt_app)
 
+    def test_debug_header_shows_frame_rate(self):
+        app = self._make_app(debug=True)
+        pt_app = app._build_tui_layout()
+        header = pt_app.layout.container.content.children[0]
+        text = "".join(t[1] for t in header.content.text())
+        self.assertIn("fps", text)
+
+    def test_low_bandwidth_layout(self):
+        from prompt_toolkit.output import ColorDepth
+        app = self._make_app(debug=False)
+        app.low_bandwidth = True
+        app.low_bandwidth_palette = "mono"
+        pt_app = app._build_tui_layout()
+        self.assertEqual(app._chat_window.right_margins, [])
+        self.assertEqual(pt_app.color_depth, ColorDepth.DEPTH_1_BIT)
+
+    def test_default_layout_keeps_scrollbar(self):
+        app = self._make_app(debug=False)
+        self.assertFalse(app.low_bandwidth)
+        app._build_tui_layout()
+        self.assertEqual(len(app._chat_window.right_margins), 1)
+
+    def test_low_bandwidth_palette_strips_truecolor(self):
+        app = self._make_app(debug=False)
+        app._tui_buffer.set_color_system("standard")
+        app._tui_buffer.print("[#ff8800]orange[/#ff8800]")
+        styles = " ".join(t[0] for t in app._tui_buffer.get_formatted_text())
+        self.assertNotIn("#ff8800", styles)
+
+    def test_low_bandwidth_batches_stream_redraws(self):
+        app = self._make_app(debug=False)
+        app.low_bandwidth = True
+        app._tui_active = True
+        app._tui_app = MagicMock()
+        app._bandwidth.consume(app._bandwidth.bytes_per_second * 2)
+        app._stream_buffer.append("chunk")
+        app._flush_stream_buffer()
+        app._tui_app.invalidate.assert_not_called()
+        app._stream_buffer.append("final")
+        app._flush_stream_buffer(force_invalidate=True)
+        app._tui_app.invalidate.assert_called_once()
+
+    def test_debug_render_toggles_profiler(self):
+        app = self._make_app(debug=False)
+        app._toggle_debug(["render"])
+        self.assertTrue(app._render_profiler.enabled)
+        self.assertFalse(app.debug)
+        app._toggle_debug(["render"])
+        self.assertFalse(app._render_profiler.enabled)
+
+    def test_chat_render_feeds_profiler(self):
+        app = self._make_app(debug=False)
+        pt_app = app._build_tui_layout()
+        app._render_profiler.enabled = True
+        app._tui_buffer.append_raw("hello\n")
+        body = pt_app.layout.container.content.children[1]
+        chat_window = body.children[0]
+        chat_window.content.text()
+        self.assertGreater(app._render_profiler.fragments, 0)
+
 
 if __name__ == '__main__':
     unittest.main()